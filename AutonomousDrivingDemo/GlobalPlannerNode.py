@@ -1,12 +1,18 @@
+import time
 from enum import Enum, auto
 from multiprocessing.connection import Connection
+from pathlib import Path
 from typing import Any, Optional
 
 import numpy as np
 import numpy.typing as npt
 from PySide6.QtCore import QObject, QThread, Signal, Slot
 
-from .global_planner.hybrid_a_star import Node, hybrid_a_star
+from .global_planner.bidirectional_hybrid_a_star import bidirectional_hybrid_a_star
+from .global_planner.hybrid_a_star import Node, anytime_hybrid_a_star
+from .global_planner.repair_trajectory import repair_trajectory
+from .global_planner.roadmap import Roadmap
+from .MapServerNode import _read_map
 from .modeling.Car import Car
 from .modeling.Obstacles import Obstacles
 from .utils.ProcessWithPipe import ProcessWithPipe
@@ -14,16 +20,27 @@ from .utils.ProcessWithPipe import ProcessWithPipe
 
 class _ParentMsgType(Enum):
     PLAN = auto()
+    REPAIR = auto()
     CANCEL = auto()
 
 
 class _WorkerMsgType(Enum):
     DISPLAY_SEGMENTS = auto()
     TRAJECTORY = auto()
-
-
-def _worker_process(pipe: Connection, segment_collection_size: int) -> None:
+    IMPROVED_TRAJECTORY = auto()
+    REPAIRED_TRAJECTORY = auto()
+
+
+def _worker_process(
+    pipe: Connection,
+    segment_collection_size: int,
+    time_limit_s: Optional[float],
+    refine: bool,
+    bidirectional: bool,
+    roadmap_map_file: Optional[Path],
+) -> None:
     # use multiprocessing to bypass the GIL to prevent GUI freezes
+    roadmap = Roadmap(Obstacles(_read_map(roadmap_map_file))) if roadmap_map_file is not None else None
     while True:
         match pipe.recv():
             case _ParentMsgType.CANCEL:
@@ -33,8 +50,11 @@ def _worker_process(pipe: Connection, segment_collection_size: int) -> None:
                     continue
 
                 display_segments: list[npt.NDArray[np.floating[Any]]] = []
+                refining = False
 
                 def callback(node: Node) -> bool:
+                    if refining:  # the explored nodes are only displayed before the first trajectory is found
+                        return pipe.poll()
                     display_segments.append(node.get_plot_trajectory())
                     if len(display_segments) < segment_collection_size:
                         return False
@@ -44,19 +64,70 @@ def _worker_process(pipe: Connection, segment_collection_size: int) -> None:
                     display_segments.clear()
                     return False
 
-                trajectory = hybrid_a_star(start, goal, obstacles, callback)
+                if roadmap is not None or bidirectional:
+                    if roadmap is not None:
+                        trajectory = roadmap.plan(start, goal, obstacles, callback)
+                    else:
+                        trajectory = bidirectional_hybrid_a_star(start, goal, obstacles, callback)
+                    trajectories = iter(()) if trajectory is None else iter((trajectory,))
+                else:
+                    deadline = time.monotonic() + time_limit_s if time_limit_s is not None else None
+                    trajectories = anytime_hybrid_a_star(start, goal, obstacles, callback, deadline)
+                for trajectory in trajectories:
+                    if pipe.poll():
+                        break
+                    msg_type = _WorkerMsgType.IMPROVED_TRAJECTORY if refining else _WorkerMsgType.TRAJECTORY
+                    pipe.send((msg_type, trajectory))
+                    refining = True
+                    if not refine:
+                        break
+                if not refining and not pipe.poll():
+                    pipe.send((_WorkerMsgType.TRAJECTORY, None))
+            case _ParentMsgType.REPAIR, trajectory, collided_range, obstacles, min_start_index:
+                if pipe.poll():  # discard outdated data
+                    continue
+                trajectory = repair_trajectory(
+                    trajectory, collided_range, obstacles, min_start_index, lambda _: pipe.poll()
+                )
                 if not pipe.poll():
-                    pipe.send((_WorkerMsgType.TRAJECTORY, trajectory))
+                    pipe.send((_WorkerMsgType.REPAIRED_TRAJECTORY, trajectory))
 
 
 class GlobalPlannerNode(QObject):
     finished = Signal()
     trajectory = Signal(np.ndarray)
+    improved_trajectory = Signal(np.ndarray)
+    repaired_trajectory = Signal(np.ndarray)  # None if the repair fails
     display_segments = Signal(list)
 
-    def __init__(self, segment_collection_size: int, parent: Optional[QObject] = None) -> None:
+    def __init__(
+        self,
+        segment_collection_size: int,
+        time_limit_s: Optional[float] = None,
+        refine: bool = False,
+        bidirectional: bool = False,
+        roadmap_map_file: Optional[Path] = None,
+        parent: Optional[QObject] = None,
+    ) -> None:
+        """
+        time_limit_s: the time limit to find the first trajectory, see the `deadline` of `anytime_hybrid_a_star`
+        refine: if True, keep refining the trajectory after the first one is found, and emit `improved_trajectory`
+        bidirectional: if True, plan with `bidirectional_hybrid_a_star`, while `time_limit_s` and `refine` are ignored
+        roadmap_map_file: if given, plan with the `Roadmap` of the map file, which is built in the worker process
+            if it is not cached yet, while the other options of the planner are ignored
+        """
         super().__init__(parent)
-        self._worker = ProcessWithPipe(_worker_process, args=(segment_collection_size,), parent=self)
+        self._worker = ProcessWithPipe(
+            _worker_process,
+            args=(
+                segment_collection_size,
+                time_limit_s,
+                refine,
+                bidirectional,
+                roadmap_map_file,
+            ),
+            parent=self,
+        )
         self._worker.recv.connect(self._worker_recv)
 
     @Slot()
@@ -72,6 +143,17 @@ class GlobalPlannerNode(QObject):
         goal = np.array([goal_state.x, goal_state.y, goal_state.yaw])
         self._worker.send((_ParentMsgType.PLAN, start, goal, obstacles))
 
+    @Slot(np.ndarray, tuple, Obstacles, int)
+    def repair(
+        self,
+        trajectory: npt.NDArray[np.floating[Any]],
+        collided_range: tuple[int, int],
+        obstacles: Obstacles,
+        min_start_index: int,
+    ) -> None:
+        "Replan only the collided part of the trajectory, see `repair_trajectory`"
+        self._worker.send((_ParentMsgType.REPAIR, trajectory, collided_range, obstacles, min_start_index))
+
     @Slot()
     def cancel(self) -> None:
         self._worker.send(_ParentMsgType.CANCEL)
@@ -85,3 +167,7 @@ class GlobalPlannerNode(QObject):
                 self.trajectory.emit(trajectory)
                 if trajectory is not None:
                     self.finished.emit()
+            case _WorkerMsgType.IMPROVED_TRAJECTORY, trajectory:
+                self.improved_trajectory.emit(trajectory)
+            case _WorkerMsgType.REPAIRED_TRAJECTORY, trajectory:
+                self.repaired_trajectory.emit(trajectory)
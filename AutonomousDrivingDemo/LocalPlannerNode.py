@@ -13,6 +13,7 @@ from .utils.ProcessWithPipe import ProcessWithPipe
 
 class _ParentMsgType(Enum):
     TRAJECTORY = auto()
+    REPAIRED_TRAJECTORY = auto()
     STATE = auto()
     BRAKE = auto()
     CANCEL = auto()
@@ -27,6 +28,8 @@ def _worker_process(pipe: Connection, delta_time_s: float) -> None:
                 mpc = None
             case _ParentMsgType.TRAJECTORY, trajectory:
                 mpc = ModelPredictiveControl(trajectory)
+            case _ParentMsgType.REPAIRED_TRAJECTORY, trajectory:
+                mpc = mpc.repaired(trajectory) if mpc is not None else ModelPredictiveControl(trajectory)
             case _ParentMsgType.BRAKE:
                 if mpc is not None:
                     mpc.brake()
@@ -70,6 +73,11 @@ class LocalPlannerNode(QObject):
         else:
             self._worker.send(_ParentMsgType.BRAKE)
 
+    @Slot(np.ndarray)
+    def repair_trajectory(self, trajectory: npt.NDArray[np.floating[Any]]) -> None:
+        "Follow the repaired trajectory, which has the same part as the current one before the car, and stop braking"
+        self._worker.send((_ParentMsgType.REPAIRED_TRAJECTORY, trajectory))
+
     @Slot()
     def brake(self) -> None:
         self._worker.send(_ParentMsgType.BRAKE)
@@ -18,7 +18,7 @@ from .CarSimulationNode import CarSimulationNode
 from .constants import *
 from .GlobalPlannerNode import GlobalPlannerNode
 from .LocalPlannerNode import LocalPlannerNode, LocalPlanningTrajectories
-from .MapServerNode import MapServerNode
+from .MapServerNode import MAP_FILE, READ_FROM_FILE, MapServerNode
 from .modeling.Car import Car
 from .modeling.Obstacles import Obstacles
 from .plotting.CarItem import CarItem
@@ -30,10 +30,26 @@ SIMULATION_PUBLISH_INTERVAL = 0.05  # [s]
 
 LOCAL_PLANNER_UPDATE_INTERVAL = 0.1  # [s]
 
+GLOBAL_PLANNER_TIME_LIMIT: Optional[float] = None  # [s] time limit to find the first trajectory, None for no limit
+GLOBAL_PLANNER_REFINE = False  # keep refining the trajectory after the first one is found
+# search from both the start and the goal instead of the time limit and refining, which expands fewer nodes
+# to reach the goals in narrow spaces, see `demo/global_planning_benchmark.py`
+GLOBAL_PLANNER_BIDIRECTIONAL = False
+# plan on a roadmap of the map file precomputed once and cached on disk, see `global_planner/roadmap.py`,
+# which only takes effect if the map is read from the file
+GLOBAL_PLANNER_ROADMAP = False
+# [m] an improved trajectory is only followed when the car is still this close to its start
+IMPROVED_TRAJECTORY_MAX_START_DISTANCE = 1.0
+
 DASHBOARD_HISTORY_SIZE = 500
 
 REPLAN_MAX_SPEED = 5 / 3.6  # [m/s]
 
+# repair the collided part of the trajectory instead of replanning the whole one, if the car can still stop before
+# the collided part, where the car brakes until the repaired trajectory arrives
+REPAIR_TRAJECTORY = True
+REPAIR_MIN_LEAD_DISTANCE = 2.0  # [m] the repaired part starts at least this far after the stopping point of the car
+
 
 class _CustomViewBox(pg.ViewBox):
     sigMouseDrag = Signal(MouseDragEvent)
@@ -64,6 +80,8 @@ class MainWindow(QMainWindow):
         self._measured_steers: deque[float] = deque([0.0], maxlen=DASHBOARD_HISTORY_SIZE)
         self._measured_timestamps: deque[float] = deque([0.0], maxlen=DASHBOARD_HISTORY_SIZE)
         self._brake_trajectory: Optional[npt.NDArray[np.floating[Any]]] = None
+        self._trajectory: Optional[npt.NDArray[np.floating[Any]]] = None  # the global trajectory being followed
+        self._repair_min_start_index: Optional[int] = None  # `min_start_index` of the pending repair
         self._local_planning = False
         self._minx = self._maxx = self._miny = self._maxy = 0.0
 
@@ -141,6 +159,10 @@ class MainWindow(QMainWindow):
         )
         self._global_planner_node = GlobalPlannerNode(
             segment_collection_size=GLOBAL_PLANNER_SEGMENT_COLLECTION_SIZE,
+            time_limit_s=GLOBAL_PLANNER_TIME_LIMIT,
+            refine=GLOBAL_PLANNER_REFINE,
+            bidirectional=GLOBAL_PLANNER_BIDIRECTIONAL,
+            roadmap_map_file=MAP_FILE if GLOBAL_PLANNER_ROADMAP and READ_FROM_FILE else None,
         )
         self._local_planner_node = LocalPlannerNode(
             delta_time_s=LOCAL_PLANNER_DELTA_TIME,
@@ -152,20 +174,22 @@ class MainWindow(QMainWindow):
         self._car_simulation_node.measured_state.connect(self._local_planner_node.set_state)
         self._car_simulation_node.measured_state.connect(self._map_server_node.update)
         self._car_simulation_node.measured_state.connect(self._update_measured_state)
+        self._car_simulation_node.measured_state.connect(self._trajectory_collision_checking_node.update_state)
         self._global_planner_node.display_segments.connect(self._update_global_planner_display_segments)
         self._global_planner_node.finished.connect(self._car_simulation_node.resume)
         self._global_planner_node.trajectory.connect(self._local_planner_node.set_trajectory)
         self._global_planner_node.trajectory.connect(self._trajectory_collision_checking_node.set_trajectory)
         self._global_planner_node.trajectory.connect(self._update_global_planning_result)
+        self._global_planner_node.improved_trajectory.connect(self._update_improved_global_planning_result)
+        self._global_planner_node.repaired_trajectory.connect(self._update_repaired_global_planning_result)
         self._local_planner_node.control_sequence.connect(self._car_simulation_node.set_control_sequence)
         self._local_planner_node.local_planning_trajectories.connect(self._update_local_planning_trajectories)
         self._map_server_node.inited.connect(self._inited)
-        self._map_server_node.known_obstacle_coordinates_updated.connect(
+        self._map_server_node.known_obstacles_updated.connect(
             self._trajectory_collision_checking_node.set_known_obstacles
         )
         self._map_server_node.known_obstacle_coordinates_updated.connect(self._update_known_obstacle_coordinates)
         self._map_server_node.new_obstacle_coordinates.connect(self._trajectory_collision_checking_node.check_collision)
-        self._trajectory_collision_checking_node.collided.connect(self._local_planner_node.brake)
         self._trajectory_collision_checking_node.collided.connect(self._trajectory_collided)
         self.braked.connect(self._global_planner_node.cancel)
         self.braked.connect(self._local_planner_node.brake)
@@ -206,12 +230,15 @@ class MainWindow(QMainWindow):
         self._reference_points_item.setData([], [])
         self._local_planning = False
         self._brake_trajectory = None
+        self._trajectory = None
+        self._repair_min_start_index = None
         self.canceled.emit()
 
     @Slot()
     def brake(self) -> None:
         self._goal_unreachable_item.setVisible(False)
         self._clear_global_planner_display_segments()
+        self._repair_min_start_index = None
         self.braked.emit()
 
     @Slot(MouseDragEvent)
@@ -251,7 +278,7 @@ class MainWindow(QMainWindow):
         start = self._measured_state
         if abs(start.velocity) > REPLAN_MAX_SPEED and self._brake_trajectory is not None:
             start = self._brake_trajectory
-        self.set_goal.emit(start, self._goal_state, Obstacles(self._map_server_node.known_obstacle_coordinates))
+        self.set_goal.emit(start, self._goal_state, self._map_server_node.known_obstacles)
 
     def _inited(self) -> None:
         self._known_obstacles_item.setData(*self._map_server_node.known_obstacle_coordinates.T)
@@ -265,11 +292,36 @@ class MainWindow(QMainWindow):
         )
         self.set_state.emit(self._map_server_node.generate_random_initial_state())
 
-    @Slot()
-    def _trajectory_collided(self) -> None:
+    def _min_start_index(self, end_index: int) -> Optional[int]:
+        """
+        The index of the trajectory that the repaired part should start after, i.e. `REPAIR_MIN_LEAD_DISTANCE` after
+        the stopping point of the car, or None if it is beyond `end_index`, i.e. the car can't stop in time
+        """
+        if self._trajectory is None or self._brake_trajectory is None:
+            return None
+        trajectory = self._trajectory[: end_index + 1]
+        stop_index = int(np.argmin(np.linalg.norm(trajectory[:, :2] - self._brake_trajectory[-1, :2], axis=1)))
+        distances = np.cumsum(np.linalg.norm(np.diff(trajectory[stop_index:, :2], axis=0), axis=1))
+        lead = int(np.searchsorted(distances, REPAIR_MIN_LEAD_DISTANCE)) + 1
+        return stop_index + lead if stop_index + lead <= end_index else None
+
+    def _brake_and_replan(self) -> None:
+        self._repair_min_start_index = None
+        self._local_planner_node.brake()
         self._trajectory_item.setVisible(False)
         self._global_plan()
 
+    @Slot(tuple)
+    def _trajectory_collided(self, collided_range: tuple[int, int]) -> None:
+        if REPAIR_TRAJECTORY and (min_start_index := self._min_start_index(collided_range[0])) is not None:
+            # the car doesn't follow the collided trajectory any more, and stops before `min_start_index`
+            self._local_planner_node.brake()
+            self._repair_min_start_index = min_start_index
+            obstacles = self._map_server_node.known_obstacles
+            self._global_planner_node.repair(self._trajectory, collided_range, obstacles, min_start_index)
+        else:
+            self._brake_and_replan()
+
     @Slot(list)
     def _update_global_planner_display_segments(self, display_segments: list[npt.NDArray[np.floating[Any]]]) -> None:
         connects = [np.ones(len(segment), dtype=bool) for segment in display_segments]
@@ -291,6 +343,7 @@ class MainWindow(QMainWindow):
     def _update_global_planning_result(self, trajectory: Optional[np.ndarray]) -> None:
         self._clear_global_planner_display_segments()
 
+        self._trajectory = trajectory
         if trajectory is not None:
             self._trajectory_item.setData(*trajectory.T[:2])
             self._trajectory_item.setVisible(True)
@@ -298,6 +351,37 @@ class MainWindow(QMainWindow):
         else:
             self._goal_unreachable_item.setVisible(True)
 
+    @Slot(np.ndarray)
+    def _update_improved_global_planning_result(self, trajectory: npt.NDArray[np.floating[Any]]) -> None:
+        # the improved trajectory still starts from where the planning started, so it is only followed
+        # when the car hasn't moved far away from there
+        state = self._measured_state
+        if (
+            not self._local_planning
+            or abs(state.velocity) > REPLAN_MAX_SPEED
+            or np.hypot(trajectory[0, 0] - state.x, trajectory[0, 1] - state.y) > IMPROVED_TRAJECTORY_MAX_START_DISTANCE
+        ):
+            return
+        self._trajectory = trajectory
+        self._local_planner_node.set_trajectory(trajectory)
+        self._trajectory_collision_checking_node.set_trajectory(trajectory)
+        self._trajectory_item.setData(*trajectory.T[:2])
+
+    @Slot(np.ndarray)
+    def _update_repaired_global_planning_result(self, trajectory: Optional[npt.NDArray[np.floating[Any]]]) -> None:
+        min_start_index, self._repair_min_start_index = self._repair_min_start_index, None
+        if not self._local_planning or min_start_index is None:  # braked or replanned while repairing
+            return
+        # the part before `min_start_index` is kept, so the car must still be able to stop before it
+        if trajectory is None or self._min_start_index(min_start_index) is None:
+            self._brake_and_replan()
+            return
+        # the repaired trajectory keeps the part before the car, so the local planner continues from where it is
+        self._trajectory = trajectory
+        self._local_planner_node.repair_trajectory(trajectory)
+        self._trajectory_collision_checking_node.set_trajectory(trajectory)
+        self._trajectory_item.setData(*trajectory.T[:2])
+
     @Slot(np.ndarray)
     def _update_known_obstacle_coordinates(self, known_obstacle_coordinates: npt.NDArray[np.floating[Any]]) -> None:
         self._known_obstacles_item.setData(*known_obstacle_coordinates.T)
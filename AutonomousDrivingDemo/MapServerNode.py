@@ -15,6 +15,7 @@ from .modeling.Obstacles import Obstacles
 READ_FROM_FILE = True
 MAP_FILE = Path(__file__).absolute().parent / "map.png"
 METER_PER_PIXEL = 0.1
+SAMPLE_BATCH_SIZE = 16  # number of random initial states sampled and checked at once
 
 
 def _generate_obstacles() -> npt.NDArray[np.floating[Any]]:
@@ -37,10 +38,10 @@ def _generate_obstacles() -> npt.NDArray[np.floating[Any]]:
     return np.vstack((np.concatenate(ox), np.concatenate(oy))).T
 
 
-def _read_map() -> npt.NDArray[np.floating[Any]]:
-    src = cv.imread(str(MAP_FILE), cv.IMREAD_GRAYSCALE)
+def _read_map(map_file: Path = MAP_FILE) -> npt.NDArray[np.floating[Any]]:
+    src = cv.imread(str(map_file), cv.IMREAD_GRAYSCALE)
     if src is None:
-        raise FileNotFoundError(f"Cannot read map file: {MAP_FILE}")
+        raise FileNotFoundError(f"Cannot read map file: {map_file}")
     src = cv.threshold(src, 127, 255, cv.THRESH_BINARY)[1]
     H, W = src.shape[:2]
     boundary = np.array([[0, 0], [W, 0], [W, H], [0, H]])
@@ -66,6 +67,7 @@ def _read_map() -> npt.NDArray[np.floating[Any]]:
 
 class MapServerNode(QObject):
     known_obstacle_coordinates_updated = Signal(np.ndarray)
+    known_obstacles_updated = Signal(Obstacles)
     new_obstacle_coordinates = Signal(np.ndarray)
     inited = Signal()
 
@@ -75,6 +77,7 @@ class MapServerNode(QObject):
     @Slot()
     def init(self) -> None:
         self._known_obstacle_coordinates = coords = _read_map() if READ_FROM_FILE else _generate_obstacles()
+        self._known_obstacles = Obstacles(coords)
         xmin, ymin, xmax, ymax = coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max()
         self._bounding_box = (xmin, ymin, xmax, ymax)
         self._unknown_obstacle_coordinates = np.random.uniform(
@@ -84,17 +87,23 @@ class MapServerNode(QObject):
         self._havent_discovered = np.ones(len(self._unknown_obstacle_coordinates), dtype=bool)
         self.inited.emit()
         self.known_obstacle_coordinates_updated.emit(self._known_obstacle_coordinates)
+        self.known_obstacles_updated.emit(self._known_obstacles)
 
     @property
     def known_obstacle_coordinates(self) -> npt.NDArray[np.floating[Any]]:
         return self._known_obstacle_coordinates
 
+    @property
+    def known_obstacles(self) -> Obstacles:
+        "The index of the known obstacles, which is appended to instead of rebuilt when new obstacles are discovered"
+        return self._known_obstacles
+
     @property
     def unknown_obstacle_coordinates(self) -> npt.NDArray[np.floating[Any]]:
         return self._unknown_obstacle_coordinates
 
     def _lidar_scan(self, x: float, y: float) -> None:
-        ids = np.array(self._unknown_obstacles.kd_tree.query_ball_point((x, y), Car.SCAN_RADIUS))
+        ids = np.array(self._unknown_obstacles.query_ball_point((x, y), Car.SCAN_RADIUS))
         if ids.size == 0:
             return
         ids: np.ndarray = ids[self._havent_discovered[ids]]
@@ -102,9 +111,11 @@ class MapServerNode(QObject):
             return
         self._havent_discovered[ids] = False
         new_obstacle_coordinates = self._unknown_obstacle_coordinates[ids]
-        self._known_obstacle_coordinates = np.vstack((self._known_obstacle_coordinates, new_obstacle_coordinates))
+        self._known_obstacles = self._known_obstacles.appended(new_obstacle_coordinates)
+        self._known_obstacle_coordinates = self._known_obstacles.coordinates
         self.new_obstacle_coordinates.emit(new_obstacle_coordinates)
         self.known_obstacle_coordinates_updated.emit(self._known_obstacle_coordinates)
+        self.known_obstacles_updated.emit(self._known_obstacles)
 
     @Slot(float, Car)
     def update(self, timestamp_s: float, state: Car) -> None:
@@ -117,7 +128,8 @@ class MapServerNode(QObject):
 
     def generate_random_initial_state(self) -> Car:
         obstacles = Obstacles(np.vstack((self._known_obstacle_coordinates, self._unknown_obstacle_coordinates)))
-        state = np.random.uniform((0, 0, -np.pi), (MAP_WIDTH, MAP_HEIGHT, np.pi))
-        while Car(*state).check_collision(obstacles):
-            state = np.random.uniform((0, 0, -np.pi), (MAP_WIDTH, MAP_HEIGHT, np.pi))
-        return Car(*state)
+        while True:
+            states = np.random.uniform((0, 0, -np.pi), (MAP_WIDTH, MAP_HEIGHT, np.pi), (SAMPLE_BATCH_SIZE, 3))
+            free = np.flatnonzero(~Car.check_collision_batch(states, obstacles))
+            if len(free):
+                return Car(*states[free[0]])
@@ -3,63 +3,171 @@ from typing import Any, Optional
 import numpy as np
 import numpy.typing as npt
 from PySide6.QtCore import QObject, Signal, Slot
-from scipy.spatial import KDTree
 
 from .modeling.Car import Car
 from .modeling.Obstacles import Obstacles
 
 DISCARD_FIRST_N = 5
+SWEPT_RASTER_RESOLUTION = 0.25  # [m] resolution of the raster of the cells swept by the trajectory
+SWEPT_RASTER_CHUNK_SIZE = 256  # number of poses rasterized at once, to bound the memory of the temporaries
+PROGRESS_SEARCH_RANGE = 40  # number of poses ahead of the progress searched for the nearest one to the car
 
 
 class TrajectoryCollisionChecker:
+    """
+    Precomputes the raster of the footprints swept along the trajectory, where each cell holds the first and the last
+    indices of the poses that may overlap it, or -1 if none. An obstacle in a cell that no pose covers is skipped with
+    a single array lookup, and only the poses between the indices of the covered cells are checked exactly.
+    The poses before the progress of the car are not checked any more, so the cost shrinks as the car moves on.
+    """
+
     def __init__(self, trajectory: npt.NDArray[np.floating[Any]]) -> None:
-        assert trajectory.ndim == 2 and trajectory.shape[1] == 3, "trajectory must be 2D array having [[x, y, yaw]]"
+        assert (
+            trajectory.ndim == 2 and trajectory.shape[1] == 4
+        ), "trajectory must be 2D array having [[x, y, yaw, direction]]"
         self._trajectory = trajectory
+        self._progress = 0
+
+        res = SWEPT_RASTER_RESOLUTION
+        r = int(np.ceil(Car.COLLISION_RADIUS / res)) + 1  # radius of the window of cells around the center of a pose
+        c, s = np.cos(trajectory[:, 2]), np.sin(trajectory[:, 2])
+        centers = trajectory[:, :2] + Car.BACK_TO_CENTER * np.column_stack((c, s))
+        self._min = (centers.min(axis=0) if len(centers) else np.zeros(2)) - r * res
+        size = (centers.max(axis=0) if len(centers) else np.zeros(2)) + r * res - self._min
+        self._shape = (int(size[1] / res) + 1, int(size[0] / res) + 1)
+
+        offsets = np.arange(-r, r + 1)
+        di, dj = (a.ravel() for a in np.meshgrid(offsets, offsets, indexing="ij"))
+        cells, indices = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+        for start in range(0, len(trajectory), SWEPT_RASTER_CHUNK_SIZE):
+            chunk = slice(start, start + SWEPT_RASTER_CHUNK_SIZE)
+            ci, cj = self._cells(centers[chunk])
+            i, j = ci[:, None] + di, cj[:, None] + dj
+            # an obstacle within a cell is at most half of a cell diagonal away from the center of the cell
+            dx = self._min[0] + (j + 0.5) * res - centers[chunk, 0, None]
+            dy = self._min[1] + (i + 0.5) * res - centers[chunk, 1, None]
+            local_x, local_y = dx * c[chunk, None] + dy * s[chunk, None], dy * c[chunk, None] - dx * s[chunk, None]
+            distance = np.hypot(
+                np.maximum(np.abs(local_x) - Car.COLLISION_LENGTH / 2, 0.0),
+                np.maximum(np.abs(local_y) - Car.COLLISION_WIDTH / 2, 0.0),
+            )
+            covered = distance <= res * np.sqrt(2) / 2
+            cells.append(np.ravel_multi_index((i[covered], j[covered]), self._shape))
+            indices.append(np.broadcast_to(np.arange(start, start + len(ci))[:, None], covered.shape)[covered])
+        cells, indices = np.concatenate(cells, dtype=np.intp), np.concatenate(indices, dtype=np.intp)
+
+        # the cells are in the order of the indices of the poses, so their first and last occurrences are kept
+        self._first = np.full(self._shape, -1, dtype=np.intp)
+        self._last = np.full(self._shape, -1, dtype=np.intp)
+        unique, first = np.unique(cells, return_index=True)
+        self._first.flat[unique] = indices[first]
+        unique, last = np.unique(cells[::-1], return_index=True)
+        self._last.flat[unique] = indices[::-1][last]
+
+    def _cells(self, xy: npt.NDArray[np.floating[Any]]) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        ij = np.floor((xy - self._min) / SWEPT_RASTER_RESOLUTION).astype(np.intp)
+        return ij[:, 1], ij[:, 0]
+
+    def covered_indices(
+        self, coordinates: npt.NDArray[np.floating[Any]]
+    ) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        """
+        The first and the last indices of the poses whose footprints may cover each of the obstacles, or -1 if none.
+        The first one is a lower bound of the index of the first collision, e.g. to decide how urgently to brake.
+        """
+        i, j = self._cells(coordinates)
+        inside = (0 <= i) & (i < self._shape[0]) & (0 <= j) & (j < self._shape[1])
+        first, last = np.full(len(coordinates), -1, dtype=np.intp), np.full(len(coordinates), -1, dtype=np.intp)
+        first[inside], last[inside] = self._first[i[inside], j[inside]], self._last[i[inside], j[inside]]
+        return first, last
+
+    @property
+    def progress(self) -> int:
+        return self._progress
 
-        # Calculate the trajectory of the center of the car, instead of the center of the rear axle
-        xy, yaw = trajectory[:, :2], trajectory[:, 2]
-        cy, sy = np.cos(yaw), np.sin(yaw)
-        xy = (xy.T + [Car.BACK_TO_CENTER * cy, Car.BACK_TO_CENTER * sy]).T
-        self._trajectory_kd_tree = KDTree(xy)
+    def update_progress(self, x: float, y: float) -> None:
+        """
+        move the progress forward to the nearest pose to the car within `PROGRESS_SEARCH_RANGE` poses ahead,
+        but not past the next direction changing pose
+        """
+        # the poses after a direction change may drive back close to the car, e.g. in a three-point turn,
+        # so they are only searched once the progress has reached the direction changing pose
+        poses = self._trajectory[self._progress : self._progress + PROGRESS_SEARCH_RANGE + 1]
+        if len(poses) < 2:
+            return
+        if len(changes := np.flatnonzero(poses[2:, 3] != poses[1, 3])):
+            poses = poses[: changes[0] + 2]
+        self._progress += int(np.argmin(np.hypot(poses[:, 0] - x, poses[:, 1] - y)))
+
+    def keep_progress(self, checker: "TrajectoryCollisionChecker") -> None:
+        "continue from the progress of the checker of the old trajectory, if the poses up to it are unchanged"
+        n = checker.progress + 1
+        if n <= len(self._trajectory) and np.allclose(self._trajectory[:n], checker._trajectory[:n]):
+            self._progress = checker.progress
 
-    def check(self, obstacles: Obstacles) -> bool:
-        indices = self._trajectory_kd_tree.query_ball_tree(obstacles.kd_tree, Car.COLLISION_RADIUS)
-        for i, ids in enumerate(indices):
-            if not ids:
-                continue
-            if Car(*self._trajectory[i]).check_collision(obstacles.coordinates[ids]):
-                return True
-        return False
+    def check(self, obstacles: Obstacles) -> Optional[tuple[int, int]]:
+        """
+        returns the indices of the first and the last collided poses of the trajectory after the progress,
+        or None if collision-free
+        """
+        first, last = self.covered_indices(obstacles.coordinates)
+        if not (covered := last >= self._progress).any():
+            return None
+        lo, hi = max(first[covered].min(), self._progress), last[covered].max()
+        obstacles = Obstacles(obstacles.coordinates[covered])
+        # the poses are checked in the order of the distance ahead, stopping at the first collided one
+        collided = np.flatnonzero(
+            Car.check_collision_batch(self._trajectory[lo : hi + 1, :3], obstacles, early_stop=True)
+        )
+        if not len(collided):
+            return None
+        first_collided = lo + int(collided[0])
+        # then backwards from the end, stopping at the last collided one
+        collided = np.flatnonzero(
+            Car.check_collision_batch(self._trajectory[first_collided : hi + 1, :3][::-1], obstacles, early_stop=True)
+        )
+        return first_collided, hi - int(collided[0])
 
 
 class TrajectoryCollisionCheckingNode(QObject):
-    collided = Signal()
+    collided = Signal(tuple)  # the indices of the first and the last collided poses of the trajectory
 
     def __init__(self, parent: Optional[QObject] = None) -> None:
         super().__init__(parent)
         self._checker: Optional[TrajectoryCollisionChecker] = None
-        self._known_obstacles: Optional[npt.NDArray[np.floating[Any]]] = None
+        self._known_obstacles: Optional[Obstacles] = None
 
     @Slot(np.ndarray)
     def set_trajectory(self, trajectory: Optional[npt.NDArray[np.floating[Any]]]) -> None:
         if trajectory is None:
             self._checker = None
             return
-        self._checker = TrajectoryCollisionChecker(trajectory[DISCARD_FIRST_N:, :3])
-        if self._known_obstacles is None:
-            return
-        self.check_collision(self._known_obstacles)
+        checker = TrajectoryCollisionChecker(trajectory[DISCARD_FIRST_N:])
+        if self._checker is not None:  # e.g. the repaired trajectory keeps the part that the car has passed
+            checker.keep_progress(self._checker)
+        self._checker = checker
+        if self._known_obstacles is not None:
+            self._check_collision(self._known_obstacles)
 
-    @Slot(np.ndarray)
-    def set_known_obstacles(self, known_obstacles) -> None:
+    @Slot(float, Car)
+    def update_state(self, timestamp_s: float, state: Car) -> None:
+        if self._checker is not None:
+            self._checker.update_progress(state.x, state.y)
+
+    @Slot(Obstacles)
+    def set_known_obstacles(self, known_obstacles: Obstacles) -> None:
         self._known_obstacles = known_obstacles
 
     @Slot(np.ndarray)
     def check_collision(self, obstacle_coordinates: npt.NDArray[np.floating[Any]]) -> None:
-        if self._checker is None:
-            return
-        if self._checker.check(Obstacles(obstacle_coordinates)):
-            self.collided.emit()
+        "check the trajectory against the newly discovered obstacles only"
+        if self._checker is not None:
+            self._check_collision(Obstacles(obstacle_coordinates))
+
+    def _check_collision(self, obstacles: Obstacles) -> None:
+        if (collided_range := self._checker.check(obstacles)) is not None:
+            first, last = collided_range
+            self.collided.emit((first + DISCARD_FIRST_N, last + DISCARD_FIRST_N))
 
     @Slot()
     def cancel(self) -> None:
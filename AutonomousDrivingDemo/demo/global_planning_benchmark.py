@@ -0,0 +1,82 @@
+import time
+from collections.abc import Callable, Iterator
+from functools import cache
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from ..global_planner.bidirectional_hybrid_a_star import bidirectional_hybrid_a_star
+from ..global_planner.hybrid_a_star import Node, hybrid_a_star
+from ..global_planner.roadmap import Roadmap
+from ..MapServerNode import _read_map
+from ..modeling.Obstacles import Obstacles
+from .utils.generate_car import generate_car
+from .utils.generate_obstacle_coordnates import generate_obstacle_coordnates
+
+NUM_RANDOM_MAPS = 6
+NUM_PLANS_PER_MAP_FILE = 4
+MAP_FILES = ("map.png", "map2.png")
+
+
+@cache
+def _roadmap(obstacles: Obstacles) -> Roadmap:
+    return Roadmap(obstacles)
+
+
+ENGINES: dict[str, Callable[..., Optional[npt.NDArray[np.floating[Any]]]]] = {
+    "hybrid_a_star": hybrid_a_star,
+    "bidirectional": bidirectional_hybrid_a_star,
+    "roadmap": lambda start, goal, obstacles, cancel_callback: _roadmap(obstacles).plan(
+        start, goal, obstacles, cancel_callback
+    ),
+}
+
+
+def _scenarios() -> Iterator[tuple[str, Obstacles, npt.NDArray[np.floating[Any]], npt.NDArray[np.floating[Any]]]]:
+    for seed in range(NUM_RANDOM_MAPS):
+        np.random.seed(seed)
+        obstacles = Obstacles(generate_obstacle_coordnates())
+        yield f"random{seed}", obstacles, generate_car(obstacles), generate_car(obstacles)
+    for map_file in MAP_FILES:
+        obstacles = Obstacles(_read_map(Path(__file__).absolute().parent.parent / map_file))
+        np.random.seed(0)
+        for i in range(NUM_PLANS_PER_MAP_FILE):
+            yield f"{map_file}[{i}]", obstacles, generate_car(obstacles), generate_car(obstacles)
+
+
+def main() -> None:
+    print(f"{'scenario':<12}" + "".join(f"{name:>32}" for name in ENGINES))
+    total_times, total_expansions = dict.fromkeys(ENGINES, 0.0), dict.fromkeys(ENGINES, 0)
+    for scenario, obstacles, start, goal in _scenarios():
+        _roadmap(obstacles)  # the roadmap is built offline
+        for engine in ENGINES.values():  # warm up the caches of each engine in the same way
+            engine(start, goal, obstacles, None)
+        row = f"{scenario:<12}"
+        for name, engine in ENGINES.items():
+            expansions = 0
+
+            def count(_: Node) -> bool:
+                nonlocal expansions
+                expansions += 1
+                return False
+
+            t = time.perf_counter()
+            trajectory = engine(start, goal, obstacles, count)
+            elapsed = time.perf_counter() - t
+            total_times[name] += elapsed
+            total_expansions[name] += expansions
+            length = np.nan
+            if trajectory is not None:
+                length = np.linalg.norm(np.diff(trajectory[:, :2], axis=0), axis=1).sum()
+            row += f"{elapsed * 1000:>9.1f}ms {expansions:>6d}nodes {length:>6.1f}m"
+        print(row)
+    row = f"{'total':<12}"
+    for name in ENGINES:
+        row += f"{total_times[name] * 1000:>9.1f}ms {total_expansions[name]:>6d}nodes {'':>7}"
+    print(row)
+
+
+if __name__ == "__main__":
+    main()
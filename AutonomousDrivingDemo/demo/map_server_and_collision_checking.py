@@ -7,7 +7,6 @@ from matplotlib.backend_bases import MouseEvent
 
 from ..MapServerNode import MapServerNode
 from ..modeling.Car import Car
-from ..modeling.Obstacles import Obstacles
 from .utils.plot_car import plot_car
 
 
@@ -16,7 +15,7 @@ def main(fig: plt.Figure, ax: plt.Axes) -> None:
     map_server_node.init()
     car = Car(0, 0, 0)
     map_server_node.update(0.0, car)
-    known_obstacles = Obstacles(map_server_node.known_obstacle_coordinates)
+    known_obstacles = map_server_node.known_obstacles
 
     ax.cla()
     ax.grid()
@@ -47,7 +46,7 @@ def main(fig: plt.Figure, ax: plt.Axes) -> None:
     def known_obstacle_coordinates_updated(known_obstacle_coordinates: npt.NDArray[np.floating]) -> None:
         nonlocal known_obstacles
         known_obstacles_artist.set_data(*known_obstacle_coordinates.T)
-        known_obstacles = Obstacles(known_obstacle_coordinates)
+        known_obstacles = map_server_node.known_obstacles
         plt.draw()
 
     map_server_node.known_obstacle_coordinates_updated.connect(known_obstacle_coordinates_updated)
@@ -0,0 +1,54 @@
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+
+from ..MapServerNode import _read_map
+from ..modeling.Car import Car
+from ..modeling.ObstacleIndex import OBSTACLE_INDEX_BACKENDS
+from ..modeling.Obstacles import Obstacles
+
+MAP_FILES = ("map.png", "map2.png")
+NUM_SINGLE_QUERIES = 2000  # number of radius queries issued one by one, like `Car.check_collision`
+NUM_BATCH_QUERIES = 100000  # number of radius queries or box queries issued in one batch
+REPEATS = 5  # the best time of this many runs is reported
+
+
+def _best_time(f: Callable[[], object]) -> float:
+    best = np.inf
+    for _ in range(REPEATS):
+        t = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main() -> None:
+    columns = ("build", f"{NUM_SINGLE_QUERIES} single", f"{NUM_BATCH_QUERIES} ball", f"{NUM_BATCH_QUERIES} box")
+    print(f"{'map':<10}{'backend':<12}" + "".join(f"{column:>16}" for column in columns))
+    for map_file in MAP_FILES:
+        coordinates = _read_map(Path(__file__).absolute().parent.parent / map_file)
+        rng = np.random.default_rng(0)
+        centers = rng.uniform(coordinates.min(axis=0), coordinates.max(axis=0), (NUM_BATCH_QUERIES, 2))
+        # the axis-aligned bounding boxes of the car at random yaws
+        c, s = np.abs(np.cos(yaws := rng.uniform(-np.pi, np.pi, NUM_BATCH_QUERIES))), np.abs(np.sin(yaws))
+        half_length, half_width = Car.COLLISION_LENGTH / 2, Car.COLLISION_WIDTH / 2
+        half_extents = np.column_stack((half_length * c + half_width * s, half_length * s + half_width * c))
+        mins, maxs = centers - half_extents, centers + half_extents
+
+        for backend in OBSTACLE_INDEX_BACKENDS:
+            obstacles = Obstacles(coordinates, backend)
+            times = (
+                _best_time(lambda: Obstacles(coordinates, backend)),
+                _best_time(
+                    lambda: [obstacles.query_ball_point(c, Car.COLLISION_RADIUS) for c in centers[:NUM_SINGLE_QUERIES]]
+                ),
+                _best_time(lambda: obstacles.query_ball_point(centers, Car.COLLISION_RADIUS)),
+                _best_time(lambda: obstacles.query_box(mins, maxs)),
+            )
+            print(f"{map_file:<10}{backend:<12}" + "".join(f"{t * 1000:>14.2f}ms" for t in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,14 @@ import numpy.typing as npt
 from ...modeling.Car import Car
 from ...modeling.Obstacles import Obstacles
 
+SAMPLE_BATCH_SIZE = 16  # number of states sampled and checked at once
+
 
 def generate_car(obstacles: Obstacles) -> npt.NDArray[np.floating[Any]]:
     coords = obstacles.coordinates
     minx, maxx, miny, maxy = coords[:, 0].min(), coords[:, 0].max(), coords[:, 1].min(), coords[:, 1].max()
-    state = np.random.uniform((minx, miny, -np.pi), (maxx, maxy, np.pi))
-    while Car(*state).check_collision(obstacles):
-        state = np.random.uniform((minx, miny, -np.pi), (maxx, maxy, np.pi))
-    return state
+    while True:
+        states = np.random.uniform((minx, miny, -np.pi), (maxx, maxy, np.pi), (SAMPLE_BATCH_SIZE, 3))
+        free = np.flatnonzero(~Car.check_collision_batch(states, obstacles))
+        if len(free):
+            return states[free[0]]
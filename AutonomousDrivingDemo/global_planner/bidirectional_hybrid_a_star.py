@@ -0,0 +1,278 @@
+from collections.abc import Callable
+from itertools import islice
+from typing import Any, Literal, Optional
+
+import numpy as np
+import numpy.typing as npt
+from rsplan import Path as RSPath
+from rsplan.planner import _solve_path as solve_rspath
+
+from ..constants import *
+from ..modeling.Car import Car
+from ..modeling.ConfigurationSpace import ConfigurationSpace
+from ..modeling.Obstacles import ObstacleGrid, Obstacles
+from ..utils.PriorityQueue import PriorityQueue
+from ..utils.SupportsBool import SupportsBool
+from ..utils.wrap_angle import wrap_angle
+from .hybrid_a_star import _configuration_space_cache, hybrid_a_star
+from .hybrid_a_star_common import (
+    BACKWARDS_COST,
+    H_DIST_COST,
+    H_YAW_COST,
+    MOTION_DIRECTIONS,
+    MOTION_DISTANCE,
+    MOTION_STEER_COSTS,
+    MOTION_STEERS,
+    MOTIONS,
+    REEDS_SHEPP_MAX_DISTANCE,
+    RS_SEGMENT_STEERS,
+    STEER_CHANGE_COST,
+    SWITCH_DIRECTION_COST,
+    YAW_GRID_RESOLUTION,
+    Node,
+    NodeArena,
+    SimplePath,
+    calc_rspath_cost,
+    heuristic_cache,
+    join_segments,
+    prepare_start,
+    transform_motions,
+)
+
+MEET_DISTANCE = REEDS_SHEPP_MAX_DISTANCE  # [m] the nodes of the other tree within this distance are tried to connect to
+MEET_RS_ATTEMPTS = 1  # number of the cheapest nodes of the other tree to try the Reeds-Shepp paths to
+# maximum number of times to try the Reeds-Shepp paths to the same node, which is likely to fail again if failed before
+MEET_MAX_ATTEMPTS_PER_NODE = 3
+
+
+class _SearchTree:
+    """
+    One of the two trees of `bidirectional_hybrid_a_star`, which grows forward from the start if `sign` is 1,
+    or backward from the goal if `sign` is -1, where the car drives each motion in the opposite direction.
+    The cost of a node is the cost of driving between the root and the node, and the heuristic is to the other root.
+    """
+
+    def __init__(
+        self,
+        sign: Literal[1, -1],
+        root: npt.NDArray[np.floating[Any]],
+        direction: Literal[1, 0, -1],
+        steer: float,
+        heuristic_grid: ObstacleGrid,
+        target: npt.NDArray[np.floating[Any]],
+    ) -> None:
+        self.sign = sign
+        self.root_direction, self.root_steer = direction, steer
+        self.target = target
+        self._heuristic_grid = heuristic_grid
+        self._directions = sign * MOTION_DIRECTIONS  # the directions that the car drives the motions
+        self._distance_costs = np.where(self._directions == 1, MOTION_DISTANCE, MOTION_DISTANCE * BACKWARDS_COST)
+
+        self.nodes = NodeArena()
+        self.best: dict[int, int] = {}
+        # the cheapest node ending in each [i, j] of the grid, to find the nodes to connect to from the other tree
+        self.cell_nodes = np.full(heuristic_grid.grid.shape, -1, dtype=np.intp)
+        self.meet_attempts: dict[int, int] = {}  # node -> number of the Reeds-Shepp paths tried to it
+        self.pq = PriorityQueue()
+        self.add(np.array([0.0]), -1, root[None], np.array([NodeArena.START]))
+
+    def calc_ijk(self, poses: npt.NDArray[np.floating[Any]]) -> tuple[npt.NDArray[np.intp], ...]:
+        grid = self._heuristic_grid
+        i = ((poses[:, 1] - grid.miny) / grid.resolution).astype(np.intp)
+        j = ((poses[:, 0] - grid.minx) / grid.resolution).astype(np.intp)
+        k = (wrap_angle(poses[:, 2], zero_to_2pi=True) // YAW_GRID_RESOLUTION).astype(np.intp)
+        return i, j, k
+
+    def direction_and_steer(self, node: int) -> tuple[Literal[1, 0, -1], float]:
+        "The direction and the steer that the car drives the motion of the node with"
+        if (motion := self.nodes.motion[node]) == NodeArena.START:
+            return self.root_direction, self.root_steer
+        return self._directions[motion], MOTION_STEERS[motion]
+
+    def add(
+        self,
+        cost: npt.NDArray[np.floating[Any]],
+        parent: int,
+        poses: npt.NDArray[np.floating[Any]],
+        motions: npt.NDArray[np.integer[Any]],
+    ) -> None:
+        "Add the nodes that are cheaper than the visited ones of the same grid cells, in the order of `MOTIONS`"
+        N, M = self._heuristic_grid.grid.shape
+        i, j, k = self.calc_ijk(poses)
+        inside = (0 <= i) & (i < N) & (0 <= j) & (j < M)
+        cost, poses, motions, i, j, k = cost[inside], poses[inside], motions[inside], i[inside], j[inside], k[inside]
+        cells = np.ravel_multi_index((i, j, k), (N, M, int(2 * np.pi / YAW_GRID_RESOLUTION)))
+
+        keep: list[int] = []
+        kept_costs: dict[int, float] = {}
+        for index, (cell, c) in enumerate(zip(cells.tolist(), cost.tolist())):
+            old_cost = kept_costs.get(cell)
+            if old_cost is None and (old := self.best.get(cell)) is not None:
+                old_cost = self.nodes.cost[old]
+            if old_cost is None or c < old_cost:
+                kept_costs[cell] = c
+                keep.append(index)
+
+        h_cost = H_DIST_COST * self._heuristic_grid.grid[i[keep], j[keep]]
+        h_cost = h_cost + H_YAW_COST * np.abs(wrap_angle(self.target[2] - poses[keep, 2]))
+        ids = self.nodes.add(cost[keep], h_cost, parent, cells[keep], poses[keep], motions[keep])
+        for node, cell, ci, cj in zip(ids, cells[keep].tolist(), i[keep].tolist(), j[keep].tolist()):
+            self.best[cell] = node
+            self.pq.push(self.nodes.h_cost[node] + self.nodes.cost[node], self.nodes.cost[node], node, cell)
+            if (old := self.cell_nodes[ci, cj]) < 0 or self.nodes.cost[node] < self.nodes.cost[old]:
+                self.cell_nodes[ci, cj] = node
+
+    def expand(self, cur: int, configuration_space: ConfigurationSpace) -> None:
+        "Add the nodes of the collision-free motions from the current node"
+        trajectories = transform_motions(*self.nodes.pose[cur])
+        collided = configuration_space.check_collision_batch(trajectories.reshape(-1, 3))
+        motions = np.flatnonzero(~collided.reshape(len(MOTIONS), -1).any(axis=1))
+
+        # the transition between the motion of the current node and the motions of its children is the same
+        # in both directions, since the car drives them in the opposite order in the backward tree
+        direction, steer = self.direction_and_steer(cur)
+        switch_direction_cost = np.where(
+            (direction != 0) & (self._directions[motions] != direction), SWITCH_DIRECTION_COST, 0.0
+        )
+        steer_change_cost = STEER_CHANGE_COST * np.abs(MOTION_STEERS[motions] - steer)
+        cost = self.nodes.cost[cur] + self._distance_costs[motions] + switch_direction_cost
+        cost = cost + steer_change_cost + MOTION_STEER_COSTS[motions]
+        self.add(cost, cur, trajectories[motions, -1], motions)
+
+    def meeting_candidates(self, pose: npt.NDArray[np.floating[Any]]) -> list[int]:
+        "The `MEET_RS_ATTEMPTS` nodes around the pose with the lowest estimated total cost through them"
+        (i,), (j,), _ = self.calc_ijk(pose[None])
+        r = int(MEET_DISTANCE / self._heuristic_grid.resolution)
+        window = self.cell_nodes[max(i - r, 0) : i + r + 1, max(j - r, 0) : j + r + 1]
+        candidates = window[window >= 0]
+        candidates = candidates[[self.meet_attempts.get(node, 0) < MEET_MAX_ATTEMPTS_PER_NODE for node in candidates]]
+        distance = np.linalg.norm(self.nodes.pose[candidates, :2] - pose[:2], axis=1)
+        candidates, distance = candidates[distance <= MEET_DISTANCE], distance[distance <= MEET_DISTANCE]
+        estimate = H_DIST_COST * distance
+        estimate += H_YAW_COST * np.abs(wrap_angle(self.nodes.pose[candidates, 2] - pose[2]))
+        estimate += self.nodes.cost[candidates]
+        return candidates[np.argsort(estimate, kind="stable")[:MEET_RS_ATTEMPTS]].tolist()
+
+    def get_node(self, node: int) -> Node:
+        "Build the `Node` of the id for `cancel_callback`"
+        nodes = self.nodes
+        N, M = self._heuristic_grid.grid.shape
+        ijk = tuple(map(int, np.unravel_index(nodes.cell[node], (N, M, int(2 * np.pi / YAW_GRID_RESOLUTION)))))
+        direction, steer = self.direction_and_steer(node)
+        if (parent := nodes.parent[node]) < 0:
+            return Node(SimplePath(ijk, nodes.pose[node, None], direction, steer), 0.0, float(nodes.h_cost[node]), None)
+        trajectory = transform_motions(*nodes.pose[parent])[nodes.motion[node]]
+        path = SimplePath(ijk, trajectory, direction, steer)
+        return Node(path, float(nodes.cost[node]), float(nodes.h_cost[node]), nodes.pose[parent])
+
+    def segments(self, node: int) -> list[npt.NDArray[np.floating[Any]]]:
+        """
+        The trajectory between the root and the node in the driving order, excluding the root,
+        i.e. from the start to the node for the forward tree, and from the node to the goal for the backward tree
+
+        returns [[[x(m), y(m), yaw(rad), direction(1, -1)]]]
+        """
+        nodes, segments = self.nodes, []
+        while (parent := nodes.parent[node]) >= 0:
+            trajectory = transform_motions(*nodes.pose[parent])[nodes.motion[node]]
+            if self.sign == -1:  # the car drives the motion from the node back to its parent
+                trajectory = np.vstack((trajectory[-2::-1], nodes.pose[parent]))
+            direction, _ = self.direction_and_steer(node)
+            segments.append(np.hstack((trajectory, np.full_like(trajectory[:, :1], direction))))
+            node = parent
+        return segments[::-1] if self.sign == 1 else segments
+
+
+def bidirectional_hybrid_a_star(
+    start: npt.NDArray[np.floating[Any]],
+    goal: npt.NDArray[np.floating[Any]],
+    obstacles: Obstacles,
+    cancel_callback: Optional[Callable[[Node], SupportsBool]] = None,
+) -> Optional[npt.NDArray[np.floating[Any]]]:
+    """
+    Same as `hybrid_a_star`, but grows one tree forward from the start and one backward from the goal alternately,
+    and joins them with a Reeds-Shepp path when a node is expanded near the nodes of the other tree. It saves the
+    expansions around the goal when the goal is hard to reach from the nearby poses, e.g. a narrow parking spot.
+
+    returns [[x(m), y(m), yaw(rad), direction(1, -1)]]
+    """
+    assert start.shape == (3,) or (
+        len(start.shape) == 2 and start.shape[1] == 4
+    ), "Start must be a 1D array of shape (3) representing [x, y, yaw] or a 2D array of shape (N, 4) representing [x, y, yaw, velocity]"
+    assert goal.shape == (3,), "Goal must be a 1D array of shape (3) representing [x, y, yaw]"
+
+    if Car(*goal).check_collision(obstacles):
+        return None
+    if start.shape == (3,) and Car(*start).check_collision(obstacles):
+        # the backward tree can't reach a collided start, while the forward search can leave it
+        return hybrid_a_star(start, goal, obstacles, cancel_callback)
+
+    configuration_space = _configuration_space_cache.configuration_space(obstacles)
+    start_trajectory, start_direction, start_steer = prepare_start(start)
+    start_pose = start_trajectory[-1, :3]
+    grid_key, grid = heuristic_cache.obstacle_grid(obstacles)
+    forward = _SearchTree(
+        1, start_pose, start_direction, start_steer, heuristic_cache.distance_heuristic(grid_key, grid, goal[:2]), goal
+    )
+    backward = _SearchTree(
+        -1, goal, 0, 0.0, heuristic_cache.distance_heuristic(grid_key, grid, start_pose[:2]), start_pose
+    )
+
+    def connect(forward_node: int, backward_node: int) -> Optional[RSPath]:
+        "The cheapest collision-free Reeds-Shepp path from the forward node to the backward node"
+        direction, steer = forward.direction_and_steer(forward_node)
+        next_direction, next_steer = backward.direction_and_steer(backward_node)
+
+        def calc_cost(path: RSPath) -> float:
+            cost = calc_rspath_cost(path, direction, steer)
+            if next_direction != 0:  # continue to drive the motion of the backward node
+                last = path.segments[-1]
+                cost += SWITCH_DIRECTION_COST if last.direction != next_direction else 0.0
+                cost += STEER_CHANGE_COST * abs(next_steer - RS_SEGMENT_STEERS[last.type])
+            return cost
+
+        pathes = solve_rspath(
+            tuple(forward.nodes.pose[forward_node]),
+            tuple(backward.nodes.pose[backward_node]),
+            Car.TARGET_MIN_TURNING_RADIUS,
+            MOTION_RESOLUTION,
+        )
+        # the first collision-free path in the order of the cost is the cheapest one
+        for path in sorted(pathes, key=calc_cost):
+            poses = np.column_stack(path.coordinates_tuple())
+            if not configuration_space.check_collision_batch(poses, early_stop=True).any():
+                return path
+        return None
+
+    def traceback_path(forward_node: int, backward_node: int, path: RSPath) -> npt.NDArray[np.floating[Any]]:
+        if start_trajectory.shape[1] == 4:
+            segments = [start_trajectory]
+        else:
+            segments = [np.hstack((start_trajectory, np.full_like(start_trajectory[:, :1], start_direction)))]
+        segments += forward.segments(forward_node)
+        # RSPath contains the start point, so we skip it using islice
+        segments.append([[p.x, p.y, p.yaw, p.driving_direction] for p in islice(path.waypoints(), 1, None)])
+        segments += backward.segments(backward_node)
+        return join_segments(segments)
+
+    tree, other = forward, backward
+    while forward.pq or backward.pq:
+        if not tree.pq:  # the other tree may still reach a node to connect to
+            tree, other = other, tree
+        _, _, cur = tree.pq.pop()
+        if cancel_callback is not None and cancel_callback(tree.get_node(cur)):
+            return None  # canceled
+
+        pose = tree.nodes.pose[cur]
+        candidates = other.meeting_candidates(pose)
+        if np.linalg.norm(pose[:2] - other.nodes.pose[0, :2]) <= REEDS_SHEPP_MAX_DISTANCE:
+            candidates.append(0)  # the root of the other tree, i.e. the start or the goal
+        for node in dict.fromkeys(candidates):
+            other.meet_attempts[node] = other.meet_attempts.get(node, 0) + 1
+            forward_node, backward_node = (cur, node) if tree is forward else (node, cur)
+            if (path := connect(forward_node, backward_node)) is not None:
+                return traceback_path(forward_node, backward_node, path)
+
+        tree.expand(cur, configuration_space)
+        tree, other = other, tree
+    return None
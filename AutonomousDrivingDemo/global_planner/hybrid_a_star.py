@@ -1,99 +1,218 @@
-import heapq
+import time
 from collections.abc import Callable, Generator
+from functools import cache
 from itertools import islice, product
 from typing import Any, Literal, NamedTuple, Optional
 
 import numpy as np
 import numpy.typing as npt
-from rsplan import Path as RSPath
 from rsplan.planner import _solve_path as solve_rspath
 
 from ..constants import *
 from ..modeling.Car import Car
-from ..modeling.Obstacles import ObstacleGrid, Obstacles
+from ..modeling.ClearanceMap import ClearanceMap
+from ..modeling.ConfigurationSpace import ConfigurationSpace
+from ..modeling.Obstacles import Obstacles
+from ..utils.cached_array import cached_array
+from ..utils.PriorityQueue import BucketPriorityQueue, PriorityQueue
 from ..utils.SupportsBool import SupportsBool
 from ..utils.wrap_angle import wrap_angle
-
-XY_GRID_RESOLUTION = 1.0  # [m]
-YAW_GRID_RESOLUTION = np.deg2rad(15.0)  # [rad]
-MOTION_DISTANCE = XY_GRID_RESOLUTION * 1.5  # [m] path interpolate distance
-NUM_STEER_COMMANDS = 10  # number of steer command
-
-REEDS_SHEPP_MAX_DISTANCE = 10.0  # maximum distance to use Reeds-Shepp path
-
-SWITCH_DIRECTION_COST = 25.0  # switch direction cost
-BACKWARDS_COST = 4.0  # backward movement cost
-STEER_CHANGE_COST = 3.0  # steer angle change cost
-STEER_COST = 1.5  # steer angle cost per distance
-H_DIST_COST = 2.0  # Heuristic distance cost
-H_YAW_COST = 3.0 / np.deg2rad(45)  # Heuristic yaw difference cost
-H_COLLISION_COST = 1e4  # collision cost when calculating heuristic
+from .hybrid_a_star_common import (
+    BACKWARDS_COST,
+    H_DIST_COST,
+    H_YAW_COST,
+    MOTION_DIRECTIONS,
+    MOTION_DISTANCE_COSTS,
+    MOTION_STEER_COSTS,
+    MOTION_STEERS,
+    MOTION_STEP_DISTANCES,
+    MOTION_STEPS,
+    MOTIONS,
+    REEDS_SHEPP_MAX_DISTANCE,
+    RS_SEGMENT_STEERS,
+    STEER_CHANGE_COST,
+    STEER_COST,
+    SWITCH_DIRECTION_COST,
+    XY_GRID_RESOLUTION,
+    YAW_GRID_RESOLUTION,
+    Node,
+    NodeArena,
+    SimplePath,
+    calc_rspath_cost,
+    heuristic_cache,
+    join_segments,
+    prepare_start,
+    transform_motions,
+)
 
 # if True, return the Reeds-Shepp path immediately when it is found
 # otherwise, continue the A* search to find a better path (may be much slower)
 RETURN_RS_PATH_IMMEDIATELY = True
 
-STEER_COMMANDS = np.unique(
-    np.concatenate([np.linspace(-Car.TARGET_MAX_STEER, Car.TARGET_MAX_STEER, NUM_STEER_COMMANDS), [0.0]])
-)
-
-
-MOVEMENTS = tuple((di, dj, np.sqrt(di**2 + dj**2)) for di in (-1, 0, 1) for dj in (-1, 0, 1) if di or dj)
-
-
-def _distance_heuristic(grid: ObstacleGrid, goal_xy: npt.ArrayLike) -> ObstacleGrid:
-    "Dijkstra's algorithm to calculate the distance from each grid cell to the goal"
-    H, W = grid.grid.shape
-    dist = np.full((H, W), H_COLLISION_COST)
-    ij = grid.calc_index(goal_xy)
-    dist[ij] = 0
-    pq = [(0, ij)]
-    while pq:
-        d, (i, j) = heapq.heappop(pq)
-        if d > dist[i, j]:
-            continue
-        for di, dj, cost in MOVEMENTS:
-            ni, nj = i + di, j + dj
-            if 0 <= ni < H and 0 <= nj < W and not grid.grid[ni, nj] and d + cost < dist[ni, nj]:
-                dist[ni, nj] = d + cost
-                heapq.heappush(pq, (d + cost, (ni, nj)))
-    return ObstacleGrid(grid.minx, grid.maxx, grid.miny, grid.maxy, grid.resolution, dist)
-
-
-class SimplePath(NamedTuple):
-    ijk: tuple[int, int, int]  # grid index
-    trajectory: npt.NDArray[np.floating[Any]]  # [[x(m), y(m), yaw(rad)]]
-    direction: Literal[1, 0, -1]  # direction, 1 forward, -1 backward, 0 initial
-    steer: float  # [rad], [-TARGET_MAX_STEER, TARGET_MAX_STEER]
-
-
-class Node(NamedTuple):
-    path: SimplePath | RSPath
-    cost: float
-    h_cost: float
-    parent: Optional["Node"]
-
-    def __lt__(self, other: "Node") -> bool:
-        return (self.h_cost + self.cost, self.cost) < (other.h_cost + other.cost, other.cost)
-
-    def get_plot_trajectory(self) -> npt.NDArray[np.floating[Any]]:
-        "Get the trajectory coordinates for visualization"
-        trajectory = (
-            np.array([[p.x, p.y] for p in self.path.waypoints()])
-            if isinstance(self.path, RSPath)
-            else self.path.trajectory[:, :2]
+# if True, use the maximum of the holonomic heuristic and the obstacle-free Reeds-Shepp cost to the goal,
+# where the latter is looked up from a precomputed table over the pose relative to the goal.
+# It greatly reduces the expanded nodes when searching for a better path, but when the Reeds-Shepp path is
+# returned immediately, it only delays the expansion of the nodes near the goal where the Reeds-Shepp path is tried
+NON_HOLONOMIC_HEURISTIC = not RETURN_RS_PATH_IMMEDIATELY
+NON_HOLONOMIC_HEURISTIC_RANGE = 20.0  # [m] the table covers relative poses within this range in both x and y
+NON_HOLONOMIC_HEURISTIC_RESOLUTION = XY_GRID_RESOLUTION  # [m]
+
+# if True, transform the precomputed motion primitives of all the motions of a node at once and check their collisions
+# in one batch, otherwise simulate and check each motion step by step with `Car.update` and `Car.check_collision`
+VECTORIZED_EXPANSION = True
+
+# "kd_tree": check each pose with the KD-tree of the obstacles and the exact rectangle test
+# "clearance_map": check with a `ClearanceMap` first, which gives the same result but only runs the exact test
+#                  when the clearance is ambiguous, and skips the motion steps within the free distance of a node
+# "configuration_space": check with a `ConfigurationSpace` first, which gives the same result but only runs the exact
+#                        test for the poses marked as occupied in the precomputed bitmap of their yaw bin
+COLLISION_CHECKER: Literal["kd_tree", "clearance_map", "configuration_space"] = "configuration_space"
+CLEARANCE_MAP_RESOLUTION = 0.2  # [m]
+CONFIGURATION_SPACE_RESOLUTION = 0.2  # [m]
+CONFIGURATION_SPACE_YAW_RESOLUTION = YAW_GRID_RESOLUTION  # [rad]
+
+# "heap": the open list is a binary heap of (total cost, cost, node id)
+# "bucket": the open list is a `BucketPriorityQueue` with the total cost quantized by `OPEN_LIST_BUCKET_WIDTH`,
+#           which pops the nodes in the same order, but only keeps the cheapest bucket as a heap
+OPEN_LIST: Literal["heap", "bucket"] = "heap"
+OPEN_LIST_BUCKET_WIDTH = 5.0
+
+# the heuristic weights of the searches of `anytime_hybrid_a_star` after the first trajectory is found,
+# where each search continues until the cheapest Reeds-Shepp path is popped instead of returning the first one,
+# and only yields the trajectory if it is cheaper than the previous one
+ANYTIME_HEURISTIC_WEIGHTS = (2.0, 1.5, 1.0)
+# number of the nodes with the lowest total cost within `REEDS_SHEPP_MAX_DISTANCE` to the goal to try
+# the Reeds-Shepp path from, when the deadline is reached before any trajectory is found
+ANYTIME_RS_ATTEMPTS = 10
+
+# [m] and [rad], the resolutions to quantize the poses relative to the goal, where the nodes of the same quantized pose
+# don't try the Reeds-Shepp paths again once one of them failed within a search, or 0 to try all of them
+RSPATH_MEMO_XY_RESOLUTION = 0.1
+RSPATH_MEMO_YAW_RESOLUTION = np.deg2rad(1.0)
+
+
+def _compute_non_holonomic_heuristic_table() -> npt.NDArray[np.floating[Any]]:
+    "returns cost[i][j][k] of the cheapest Reeds-Shepp path from the pose of the cell to the origin"
+    half = round(NON_HOLONOMIC_HEURISTIC_RANGE / NON_HOLONOMIC_HEURISTIC_RESOLUTION)
+    n = 2 * half + 1
+    K = int(2 * np.pi / YAW_GRID_RESOLUTION)
+    centers = np.arange(-half, half + 1) * NON_HOLONOMIC_HEURISTIC_RESOLUTION
+    table = np.zeros((n, n, K))
+    # the cost model is symmetric when mirrored along the x axis, i.e. cost(x, y, yaw) == cost(x, -y, -yaw),
+    # so only the half with y >= 0 is solved
+    for i, j, k in product(range(half, n), range(n), range(K)):
+        if i == half and j == half and k == 0:
+            continue  # already at the origin
+        pathes = solve_rspath(
+            (centers[j], centers[i], k * YAW_GRID_RESOLUTION),
+            (0.0, 0.0, 0.0),
+            Car.TARGET_MIN_TURNING_RADIUS,
+            MOTION_RESOLUTION,
         )
-        if self.parent is not None:
-            trajectory = np.vstack((self.parent.path.trajectory[-1, :2], trajectory))
-        return trajectory
+        # the initial steer of a node is unknown, so the first segment is assumed to keep it
+        table[i, j, k] = min(calc_rspath_cost(p, 0, RS_SEGMENT_STEERS[p.segments[0].type]) for p in pathes)
+        table[n - 1 - i, j, -k % K] = table[i, j, k]
+    return table
+
+
+@cache
+def _non_holonomic_heuristic_table() -> npt.NDArray[np.floating[Any]]:
+    """
+    The obstacle-free Reeds-Shepp costs to the goal, which only depend on the turning radius and the cost
+    constants, so they are computed once and cached on disk.
+
+    returns cost[i][j][k], where i, j, k are the indices of y, x, yaw of the pose in the frame of the goal
+    """
+    key = (
+        Car.TARGET_MIN_TURNING_RADIUS,
+        SWITCH_DIRECTION_COST,
+        BACKWARDS_COST,
+        STEER_CHANGE_COST,
+        STEER_COST,
+        Car.TARGET_MAX_STEER,
+        NON_HOLONOMIC_HEURISTIC_RANGE,
+        NON_HOLONOMIC_HEURISTIC_RESOLUTION,
+        YAW_GRID_RESOLUTION,
+    )
+    table = cached_array("non_holonomic_heuristic", key, _compute_non_holonomic_heuristic_table)
+    table.flags.writeable = False
+    return table
+
+
+def _non_holonomic_heuristic(pose: npt.ArrayLike, goal: npt.NDArray[np.floating[Any]]) -> float:
+    "Look up the obstacle-free Reeds-Shepp cost from the pose to the goal, 0 if the pose is out of the table"
+    table = _non_holonomic_heuristic_table()
+    x, y, yaw = pose
+    dx, dy = x - goal[0], y - goal[1]
+    c, s = np.cos(goal[2]), np.sin(goal[2])
+    n, _, K = table.shape
+    i = round((dy * c - dx * s) / NON_HOLONOMIC_HEURISTIC_RESOLUTION) + n // 2
+    j = round((dx * c + dy * s) / NON_HOLONOMIC_HEURISTIC_RESOLUTION) + n // 2
+    if not (0 <= i < n and 0 <= j < n):
+        return 0.0
+    k = round(wrap_angle(yaw - goal[2], zero_to_2pi=True) / YAW_GRID_RESOLUTION) % K
+    return float(table[i, j, k])
+
+
+class _ConfigurationSpaceCache:
+    """
+    The configuration space of the latest obstacles kept in memory. When the obstacles are the latest ones with a few
+    more appended within the same range, e.g. the newly discovered obstacles when replanning, the space is updated
+    with `ConfigurationSpace.with_obstacles` instead of dilating all the yaw bins again and writing the disk cache.
+    """
+
+    def __init__(self) -> None:
+        self._latest: Optional[ConfigurationSpace] = None
+
+    def configuration_space(self, obstacles: Obstacles) -> ConfigurationSpace:
+        coordinates, latest = obstacles.coordinates, self._latest
+        if latest is not None:
+            old = latest.obstacles.coordinates
+            n = len(old)
+            if n == len(coordinates) and np.array_equal(coordinates, old):
+                return latest
+            if n < len(coordinates) and np.array_equal(coordinates[:n], old):
+                added = coordinates[n:]
+                # the range of the space is determined by the obstacles, so it must not change
+                if (added.min(axis=0) >= old.min(axis=0)).all() and (added.max(axis=0) <= old.max(axis=0)).all():
+                    self._latest = latest.with_obstacles(obstacles, added)
+                    return self._latest
+        self._latest = ConfigurationSpace(obstacles, CONFIGURATION_SPACE_RESOLUTION, CONFIGURATION_SPACE_YAW_RESOLUTION)
+        return self._latest
+
+
+_configuration_space_cache = _ConfigurationSpaceCache()
+
+
+class _SearchResult(NamedTuple):
+    trajectory: npt.NDArray[np.floating[Any]]  # [[x(m), y(m), yaw(rad), direction(1, -1)]]
+    cost: float
 
 
-def hybrid_a_star(
+def _hybrid_a_star(
     start: npt.NDArray[np.floating[Any]],
     goal: npt.NDArray[np.floating[Any]],
     obstacles: Obstacles,
     cancel_callback: Optional[Callable[[Node], SupportsBool]] = None,
-) -> Optional[npt.NDArray[np.floating[Any]]]:
+    deadline: Optional[float] = None,
+    heuristic_weight: float = 1.0,
+    return_rs_path_immediately: bool = True,
+    non_holonomic_heuristic: bool = False,
+    cost_bound: float = np.inf,
+    resume_after_deadline: bool = False,
+) -> Optional[_SearchResult]:
+    """
+    `hybrid_a_star` with more options, which also returns the cost of the trajectory:
+
+    - deadline: the `time.monotonic()` to return the cheapest trajectory found so far, or to try the Reeds-Shepp paths
+      from the `ANYTIME_RS_ATTEMPTS` nodes with the lowest total cost if no trajectory is found yet
+    - heuristic_weight: the total cost of a node is `cost + heuristic_weight * h_cost`
+    - return_rs_path_immediately: same as `RETURN_RS_PATH_IMMEDIATELY`
+    - non_holonomic_heuristic: same as `NON_HOLONOMIC_HEURISTIC`
+    - cost_bound: only the nodes cheaper than it are searched, e.g. the cost of a known trajectory
+    - resume_after_deadline: if no trajectory is found at the deadline, continue the same search without the deadline
+      instead of returning None
+    """
     assert start.shape == (3,) or (
         len(start.shape) == 2 and start.shape[1] == 4
     ), "Start must be a 1D array of shape (3) representing [x, y, yaw] or a 2D array of shape (N, 4) representing [x, y, yaw, velocity]"
@@ -105,193 +224,378 @@ def hybrid_a_star(
     start_is_point = start.shape == (3,)
     start_collided = Car(*start).check_collision(obstacles) if start_is_point else False
 
-    # Downsample the obstacle map to a grid
-    obstacle_grid = obstacles.downsampling_to_grid(
-        XY_GRID_RESOLUTION, min(Car.COLLISION_LENGTH, Car.COLLISION_WIDTH) / 2
+    clearance_map = ClearanceMap(obstacles, CLEARANCE_MAP_RESOLUTION) if COLLISION_CHECKER == "clearance_map" else None
+    configuration_space = (
+        _configuration_space_cache.configuration_space(obstacles)
+        if COLLISION_CHECKER == "configuration_space"
+        else None
     )
+    collision_checker = clearance_map or configuration_space
+
+    def check_collision(x: float, y: float, yaw: float) -> bool:
+        if collision_checker is not None:
+            return collision_checker.check_collision(x, y, yaw)
+        return Car(x, y, yaw).check_collision(obstacles)
+
+    def check_collisions(poses: npt.NDArray[np.floating[Any]], early_stop: bool = False) -> npt.NDArray[np.bool_]:
+        if collision_checker is not None:
+            return collision_checker.check_collision_batch(poses, early_stop)
+        return Car.check_collision_batch(poses, obstacles, early_stop)
+
+    def free_distance(x: float, y: float, yaw: float) -> float:
+        "The distance that the car can move from the pose without collision, poses within it needn't be checked"
+        return clearance_map.free_distance(x, y, yaw) if clearance_map is not None else 0.0
+
+    # Downsample the obstacle map to a grid
+    grid_key, obstacle_grid = heuristic_cache.obstacle_grid(obstacles)
 
     # Precompute the distance to the goal from each grid cell, where the distance will be used as a heuristic
-    heuristic_grid = _distance_heuristic(obstacle_grid, goal[:2])
+    heuristic_grid = heuristic_cache.distance_heuristic(grid_key, obstacle_grid, goal[:2])
     N, M = heuristic_grid.grid.shape
     K = int(2 * np.pi / YAW_GRID_RESOLUTION)
 
-    # Used to record the path and cost for each grid cell at A* search stage,
-    # where dp[y][x][yaw] is the Node object for the grid cell (x, y) with yaw angle yaw
-    dp = np.full((N, M, K), None, dtype=Node)
+    # Nodes of the A* search, and the id of the node with the lowest cost for each visited grid cell [i, j, k],
+    # which only grow with the number of nodes instead of the size of the grid
+    nodes = NodeArena()
+    best: dict[int, int] = {}
 
     def calc_ijk(x: float, y: float, yaw: float) -> tuple[int, int, int]:
-        "[x, y, yaw] -> [i, j, k] for dp"
+        "[x, y, yaw] -> [i, j, k] of the grid"
         i, j = heuristic_grid.calc_index([x, y])
         k = int(wrap_angle(yaw, zero_to_2pi=True) // YAW_GRID_RESOLUTION)
         return i, j, k
 
-    def generate_neighbour(cur: Node, direction: int, steer: float) -> Optional[Node]:
-        "Generate a neighbour node of the current node, given the direction and steer angle"
-
-        # Simulate the car movement for MOTION_DISTANCE, with a interval of MOTION_RESOLUTION,
-        # check if the car will collide with the obstacles during the movement
-        car = Car(*cur.path.trajectory[-1, :3], velocity=float(direction), steer=steer)
+    def simulate_motion(
+        pose: npt.NDArray[np.floating[Any]], motion: int, check: bool
+    ) -> Optional[npt.NDArray[np.floating[Any]]]:
+        """
+        Simulate the car movement for MOTION_DISTANCE from the pose, with a interval of MOTION_RESOLUTION,
+        returns None if `check` and the car will collide with the obstacles during the movement
+        """
+        direction, steer = MOTIONS[motion]
+        car = Car(*pose, velocity=float(direction), steer=steer)
+        free = free_distance(car.x, car.y, car.yaw) if check else np.inf
         trajectory = []
-        for _ in range(int(MOTION_DISTANCE / MOTION_RESOLUTION)):
+        for distance in MOTION_STEP_DISTANCES:
             car.update(MOTION_RESOLUTION)
-            if not start_collided and car.check_collision(obstacles):
+            if distance > free and check_collision(car.x, car.y, car.yaw):
                 return None
             trajectory.append([car.x, car.y, car.yaw])
-
-        i, j, k = calc_ijk(car.x, car.y, car.yaw)
-        if not (0 <= i < N and 0 <= j < M):
-            print(f"Out of grid, please add more obstacles to fill the boundary: {i=} {j=}")
-            return None
-
-        # Calculate the cost from the start to this neighbour node
-        distance_cost = MOTION_DISTANCE if direction == 1 else MOTION_DISTANCE * BACKWARDS_COST
-        switch_direction_cost = (
-            SWITCH_DIRECTION_COST if cur.path.direction != 0 and direction != cur.path.direction else 0.0
+        return np.array(trajectory)
+
+    def node_trajectory(node: int) -> npt.NDArray[np.floating[Any]]:
+        "Regenerate the trajectory of a node of `MOTIONS` from the end pose of its parent"
+        parent_pose = nodes.pose[nodes.parent[node]]
+        if VECTORIZED_EXPANSION:
+            return transform_motions(*parent_pose)[nodes.motion[node]]
+        return simulate_motion(parent_pose, nodes.motion[node], check=False)
+
+    def get_node(node: int) -> Node:
+        "Build the `Node` of the id for `cancel_callback`"
+        parent, motion = nodes.parent[node], nodes.motion[node]
+        if motion == NodeArena.RSPATH:
+            path = nodes.rspaths[node]
+        elif motion == NodeArena.START:
+            path = start_path
+        else:
+            direction, steer = MOTIONS[motion]
+            ijk = np.unravel_index(nodes.cell[node], (N, M, K))
+            path = SimplePath(tuple(map(int, ijk)), node_trajectory(node), direction, steer)
+        parent_pose = nodes.pose[parent] if parent >= 0 else None
+        return Node(path, float(nodes.cost[node]), float(nodes.h_cost[node]), parent_pose)
+
+    def node_direction_and_steer(node: int) -> tuple[Literal[1, 0, -1], float]:
+        if nodes.motion[node] == NodeArena.START:
+            return start_path.direction, start_path.steer
+        return MOTIONS[nodes.motion[node]]
+
+    def add_neighbours(cur: int, poses: npt.NDArray[np.floating[Any]], motions: npt.NDArray[np.intp]) -> list[int]:
+        """
+        Add the neighbour nodes of the current node from the end poses of their collision-free motions,
+        returns the ids of the nodes that are cheaper than the visited ones of the same grid cells
+        """
+        i = ((poses[:, 1] - heuristic_grid.miny) / heuristic_grid.resolution).astype(np.intp)
+        j = ((poses[:, 0] - heuristic_grid.minx) / heuristic_grid.resolution).astype(np.intp)
+        if not (inside := (0 <= i) & (i < N) & (0 <= j) & (j < M)).all():
+            for out_i, out_j in zip(i[~inside], j[~inside]):
+                print(f"Out of grid, please add more obstacles to fill the boundary: i={out_i} j={out_j}")
+            poses, motions, i, j = poses[inside], motions[inside], i[inside], j[inside]
+        k = (wrap_angle(poses[:, 2], zero_to_2pi=True) // YAW_GRID_RESOLUTION).astype(np.intp)
+
+        # Calculate the cost from the start to the neighbour nodes
+        direction, steer = node_direction_and_steer(cur)
+        switch_direction_cost = np.where(
+            (direction != 0) & (MOTION_DIRECTIONS[motions] != direction), SWITCH_DIRECTION_COST, 0.0
         )
-        steer_change_cost = STEER_CHANGE_COST * abs(steer - cur.path.steer)
-        steer_cost = STEER_COST * abs(steer) * MOTION_DISTANCE
-        cost = cur.cost + distance_cost + switch_direction_cost + steer_change_cost + steer_cost
-
-        # Calculate the heuristic cost from this neighbour node to the goal
-        h_dist_cost = H_DIST_COST * heuristic_grid.grid[i, j]
-        h_yaw_cost = H_YAW_COST * abs(wrap_angle(goal[2] - car.yaw))
-        h_cost = h_dist_cost + h_yaw_cost
-
-        return Node(SimplePath((i, j, k), np.array(trajectory), direction, steer), cost, h_cost, cur)
-
-    def generate_neighbours(cur: Node) -> Generator[Node, None, None]:
+        steer_change_cost = STEER_CHANGE_COST * np.abs(MOTION_STEERS[motions] - steer)
+        cost = nodes.cost[cur] + MOTION_DISTANCE_COSTS[motions] + switch_direction_cost
+        cost = cost + steer_change_cost + MOTION_STEER_COSTS[motions]
+
+        # Calculate the heuristic cost from the neighbour nodes to the goal
+        h_cost = H_DIST_COST * heuristic_grid.grid[i, j] + H_YAW_COST * np.abs(wrap_angle(goal[2] - poses[:, 2]))
+        if non_holonomic_heuristic:
+            h_cost = np.maximum(h_cost, [_non_holonomic_heuristic(pose, goal) for pose in poses])
+
+        # Only keep the nodes that are cheaper than the visited ones of the same grid cells, in the order of `MOTIONS`
+        cells = np.ravel_multi_index((i, j, k), (N, M, K))
+        keep: list[int] = []
+        kept_costs: dict[int, float] = {}
+        for index, (cell, c) in enumerate(zip(cells.tolist(), cost.tolist())):
+            old_cost = kept_costs.get(cell)
+            if old_cost is None and (old := best.get(cell)) is not None:
+                old_cost = nodes.cost[old]
+            if c < cost_bound and (old_cost is None or c < old_cost):
+                kept_costs[cell] = c
+                keep.append(index)
+        ids = nodes.add(cost[keep], h_cost[keep], cur, cells[keep], poses[keep], motions[keep])
+        for node, cell in zip(ids, cells[keep].tolist()):
+            best[cell] = node
+        return list(ids)
+
+    def generate_neighbours(cur: int) -> list[int]:
         "Generate all possible neighbours of the current node"
         nonlocal start_collided
-        for direction, steer in product([1, -1], STEER_COMMANDS):
-            if (res := generate_neighbour(cur, direction, steer)) is not None:
-                yield res
+        pose = nodes.pose[cur]
+        if VECTORIZED_EXPANSION:
+            trajectories = transform_motions(*pose)
+            collided = np.zeros((len(MOTIONS), MOTION_STEPS), dtype=bool)
+            if not start_collided and (unchecked := MOTION_STEP_DISTANCES > free_distance(*pose)).any():
+                poses = trajectories[:, unchecked].reshape(-1, 3)
+                collided[:, unchecked] = check_collisions(poses).reshape(len(MOTIONS), -1)
+            motions = np.flatnonzero(~collided.any(axis=1))
+            poses = trajectories[motions, -1]
+        else:
+            motions, poses = [], []
+            for motion in range(len(MOTIONS)):
+                if (trajectory := simulate_motion(pose, motion, check=not start_collided)) is not None:
+                    motions.append(motion)
+                    poses.append(trajectory[-1])
+            motions, poses = np.array(motions, dtype=np.intp), np.array(poses).reshape(-1, 3)
         start_collided = False
+        return add_neighbours(cur, poses, motions)
+
+    # the quantized poses relative to the goal, with the direction and the steer of the nodes,
+    # from which no collision-free Reeds-Shepp path was found, so they are not tried again from the nearby nodes
+    rspath_failures: set[tuple[int, int, int, int, float]] = set()
 
-    def generate_rspath(node: Node) -> Optional[Node]:
+    def generate_rspath(node: int) -> Optional[int]:
         """
         Try to generate a Path from the current node directly to the goal using Reeds-Shepp curves,
         which will speed up the search process when the node is close to the goal and heuristics
         are not enough to guide the search.
         """
 
-        def check(path: RSPath) -> bool:
-            for x, y, yaw in zip(*path.coordinates_tuple()):
-                if Car(x, y, yaw).check_collision(obstacles):
-                    return False
-            return True
-
-        def calc_rspath_cost(path: RSPath) -> float:
-            """
-            Same logic to calculate the cost of a path in the `generate_neighbour` above, except that:
-
-            1. the heuristic cost is 0, since the Reeds-Shepp path is directly from the current node to the goal.
-            2. the cost of the path is calculated as the sum of the cost of each segment in the path.
-            """
-            last_direction = node.path.direction
-            last_steer = node.path.steer
-
-            distance_cost = 0.0
-            switch_direction_cost = 0.0
-            steer_change_cost = 0.0
-            steer_cost = 0.0
-            for segment in path.segments:
-                length = abs(segment.length)
-                distance_cost += length if segment.direction == 1 else length * BACKWARDS_COST
-                if last_direction != 0 and segment.direction != last_direction:
-                    switch_direction_cost += SWITCH_DIRECTION_COST
-                last_direction = segment.direction
-                steer = {"left": Car.TARGET_MAX_STEER, "right": -Car.TARGET_MAX_STEER, "straight": 0.0}[segment.type]
-                steer_change_cost += STEER_CHANGE_COST * abs(steer - last_steer)
-                last_steer = steer
-                steer_cost += STEER_COST * abs(steer) * length
-            return distance_cost + switch_direction_cost + steer_change_cost + steer_cost
-
-        # generate all possible Reeds-Shepp pathes
-        pathes = solve_rspath(
-            tuple(node.path.trajectory[-1, :3]), tuple(goal), Car.TARGET_MIN_TURNING_RADIUS, MOTION_RESOLUTION
-        )
-
-        # filter out the pathes that collide with the obstacles
-        pathes = filter(check, pathes)
-
-        # calculate the cost of each path
-        pathes = ((path, calc_rspath_cost(path)) for path in pathes)
+        memo_key = None
+        if RSPATH_MEMO_XY_RESOLUTION > 0:
+            x, y = nodes.pose[node, :2] - goal[:2]
+            c, s = np.cos(goal[2]), np.sin(goal[2])
+            memo_key = (
+                round((x * c + y * s) / RSPATH_MEMO_XY_RESOLUTION),
+                round((y * c - x * s) / RSPATH_MEMO_XY_RESOLUTION),
+                round(wrap_angle(nodes.pose[node, 2] - goal[2]) / RSPATH_MEMO_YAW_RESOLUTION),
+                *node_direction_and_steer(node),
+            )
+            if memo_key in rspath_failures:
+                return None
 
-        # return the path with the minimum cost
-        if (ret := min(pathes, key=lambda t: t[1], default=None)) is None:
+        # generate all possible Reeds-Shepp pathes, and calculate the cost of each path
+        pathes = solve_rspath(tuple(nodes.pose[node]), tuple(goal), Car.TARGET_MIN_TURNING_RADIUS, MOTION_RESOLUTION)
+        direction, steer = node_direction_and_steer(node)
+        costs = [calc_rspath_cost(path, direction, steer) for path in pathes]
+
+        # the first collision-free path in the order of the cost is the cheapest one,
+        # where the waypoints of each path are checked in one batch
+        for i in np.argsort(costs, kind="stable"):
+            if not check_collisions(np.column_stack(pathes[i].coordinates_tuple()), early_stop=True).any():
+                path, cost = pathes[i], costs[i]
+                break
+        else:
+            if memo_key is not None:
+                rspath_failures.add(memo_key)
             return None
-        path, cost = ret
-        return Node(path, node.cost + cost, 0.0, node)
+        (rsnode,) = nodes.add(nodes.cost[node] + cost, 0.0, node, -1, goal, NodeArena.RSPATH)
+        nodes.rspaths[rsnode] = path
+        return rsnode
 
-    def traceback_path(node: Node) -> npt.NDArray[np.floating[Any]]:
+    def traceback_path(node: int) -> npt.NDArray[np.floating[Any]]:
         """
         Traceback the path from the goal to the start, to get the final trajectory
 
         returns [[x(m), y(m), yaw(rad), direction(1, -1)]]
         """
         segments = []
-        while node is not None:
-            path = node.path
-            if isinstance(path, SimplePath):
-                if path.trajectory.shape[1] == 4:
-                    segments.append(path.trajectory)
-                else:
-                    segments.append(np.hstack((path.trajectory, np.full_like(path.trajectory[:, :1], path.direction))))
-            else:
+        while node >= 0:
+            motion = nodes.motion[node]
+            if motion == NodeArena.RSPATH:
                 # RSPath contains the start point, so we skip it using islice
-                segments.append([[p.x, p.y, p.yaw, p.driving_direction] for p in islice(path.waypoints(), 1, None)])
-            node = node.parent
+                waypoints = islice(nodes.rspaths[node].waypoints(), 1, None)
+                segments.append([[p.x, p.y, p.yaw, p.driving_direction] for p in waypoints])
+            elif motion == NodeArena.START and start_path.trajectory.shape[1] == 4:
+                segments.append(start_path.trajectory)
+            else:
+                trajectory, direction = (
+                    (start_path.trajectory, start_path.direction)
+                    if motion == NodeArena.START
+                    else (node_trajectory(node), MOTIONS[motion][0])
+                )
+                segments.append(np.hstack((trajectory, np.full_like(trajectory[:, :1], direction))))
+            node = nodes.parent[node]
         segments.reverse()
-        trajectory = np.vstack(segments)
-
-        d = trajectory[:, 3]
-        d[0] = d[1] if len(d) > 1 else 1  # set the initial driving direction
-
-        # remove consecutive direction changing points
-        mask = d[:-1] != d[1:]
-        mask = np.bitwise_and(mask[:-1], mask[1:])
-        trajectory = trajectory[np.concatenate(([True], ~mask, [True]))]
-
-        return trajectory
-
-    if start_is_point:
-        start_ijk = calc_ijk(*start)
-        start_path = SimplePath(start_ijk, np.array([start]), 0, 0.0)
-    else:
-        xy = start[:, :2]
-        mask = (xy[:-1] != xy[1:]).any(axis=1)  # remove consecutive identical points
-        start = start[np.concatenate(([True], mask))]
-        start_ijk = calc_ijk(*start[-1, :3])
-        start[:, 3] = np.sign(start[0, 3])
-        steer = 0.0
-        if start.shape[0] >= 2 and (l := np.linalg.norm(start[-1, :2] - start[-2, :2])):
-            steer = np.arctan(Car.WHEEL_BASE * (start[-1, 2] - start[-2, 2]) / l)
-        start_path = SimplePath(start_ijk, start, start[0, 3], steer)
-    start_node = Node(start_path, 0.0, H_DIST_COST * heuristic_grid.grid[start_ijk[:2]], None)
-
-    dp[start_ijk] = start_node
-    pq = [start_node]
-    while pq:  # A* search (Similar to Dijkstra's algorithm, but with a heuristic cost added)
-        cur = heapq.heappop(pq)
-        if isinstance(cur.path, RSPath):
-            if cancel_callback is not None and cancel_callback(cur):
-                return None  # canceled
-            return traceback_path(cur)
+        return join_segments(segments)
+
+    start_trajectory, start_direction, start_steer = prepare_start(start)
+    start_ijk = calc_ijk(*start_trajectory[-1, :3])
+    start_path = SimplePath(start_ijk, start_trajectory, start_direction, start_steer)
+    start_h_cost = H_DIST_COST * heuristic_grid.grid[start_ijk[:2]]
+    if non_holonomic_heuristic:
+        start_h_cost = max(start_h_cost, _non_holonomic_heuristic(start_path.trajectory[-1, :3], goal))
+    start_cell = np.ravel_multi_index(start_ijk, (N, M, K))
+    (start_node,) = nodes.add(0.0, start_h_cost, -1, start_cell, start_path.trajectory[-1, :3], NodeArena.START)
+    best[start_cell] = start_node
+
+    def result(node: int) -> _SearchResult:
+        return _SearchResult(traceback_path(node), float(nodes.cost[node]))
+
+    def timeout_result() -> Optional[_SearchResult]:
+        """
+        The cheapest trajectory found so far, or try the Reeds-Shepp paths from the nodes with the lowest total cost
+        within `REEDS_SHEPP_MAX_DISTANCE` to the goal, same as the ones tried during the search
+        """
+        if best_rsnode is not None:
+            return result(best_rsnode)
+        popped = []
+        rsnodes = []
+        attempts = 0
+        while pq and attempts < ANYTIME_RS_ATTEMPTS:
+            popped.append(entry := pq.pop())
+            node = entry[2]
+            if np.linalg.norm(nodes.pose[node, :2] - goal[:2]) > REEDS_SHEPP_MAX_DISTANCE:
+                continue
+            attempts += 1
+            if (rsnode := generate_rspath(node)) is not None and nodes.cost[rsnode] < cost_bound:
+                rsnodes.append(rsnode)
+        if rsnodes:
+            return result(min(rsnodes, key=lambda node: nodes.cost[node]))
+        # put the nodes back unexpanded, so the search can be resumed,
+        # where their failed Reeds-Shepp paths are memoized and not tried again
+        for f, g, node in popped:
+            pq.push(f, g, node, int(nodes.cell[node]))
+        return None
 
-        if cur.cost > dp[cur.path.ijk].cost:
-            continue
+    # A* search (Similar to Dijkstra's algorithm, but with a heuristic cost added),
+    # where the open list is ordered by (total cost, cost), and the ties are broken by the order of the nodes.
+    # A node is keyed by its grid cell, so it is discarded when a cheaper node of the same grid cell is found
+    pq = BucketPriorityQueue(OPEN_LIST_BUCKET_WIDTH) if OPEN_LIST == "bucket" else PriorityQueue()
+    pq.push(heuristic_weight * start_h_cost, 0.0, start_node, start_cell)
+    best_rsnode: Optional[int] = None  # the cheapest Reeds-Shepp path node pushed into the open list, i.e. the last one
+    while pq:
+        if deadline is not None and time.monotonic() >= deadline:
+            if (timeout := timeout_result()) is not None or not resume_after_deadline:
+                return timeout
+            deadline = None
+
+        _, cost, cur = pq.pop()
+        if nodes.motion[cur] == NodeArena.RSPATH:
+            if cancel_callback is not None and cancel_callback(get_node(cur)):
+                return None  # canceled
+            return result(cur)
 
-        if cancel_callback is not None and cancel_callback(cur):
+        if cancel_callback is not None and cancel_callback(get_node(cur)):
             return None  # canceled
 
-        if np.linalg.norm(cur.path.trajectory[-1, :2] - goal[:2]) <= REEDS_SHEPP_MAX_DISTANCE:
-            if (rsnode := generate_rspath(cur)) is not None:
-                if RETURN_RS_PATH_IMMEDIATELY:
-                    return traceback_path(rsnode)
-                heapq.heappush(pq, rsnode)
+        if np.linalg.norm(nodes.pose[cur, :2] - goal[:2]) <= REEDS_SHEPP_MAX_DISTANCE:
+            if (rsnode := generate_rspath(cur)) is not None and nodes.cost[rsnode] < cost_bound:
+                if return_rs_path_immediately:
+                    return result(rsnode)
+                pq.push(nodes.cost[rsnode], nodes.cost[rsnode], rsnode)
+                # the nodes not cheaper than a found trajectory can't lead to a cheaper one
+                best_rsnode, cost_bound = rsnode, nodes.cost[rsnode]
 
         for neighbour in generate_neighbours(cur):
-            if dp[neighbour.path.ijk] is None or neighbour.cost < dp[neighbour.path.ijk].cost:
-                dp[neighbour.path.ijk] = neighbour
-                heapq.heappush(pq, neighbour)
+            cost, h_cost = nodes.cost[neighbour], nodes.h_cost[neighbour]
+            pq.push(heuristic_weight * h_cost + cost, cost, neighbour, int(nodes.cell[neighbour]))
     return None
+
+
+def hybrid_a_star(
+    start: npt.NDArray[np.floating[Any]],
+    goal: npt.NDArray[np.floating[Any]],
+    obstacles: Obstacles,
+    cancel_callback: Optional[Callable[[Node], SupportsBool]] = None,
+    deadline: Optional[float] = None,
+) -> Optional[npt.NDArray[np.floating[Any]]]:
+    """
+    Plan a trajectory from the start to the goal, returns None if not found or canceled by `cancel_callback`.
+    If the `time.monotonic()` reaches `deadline`, returns the best trajectory found so far instead.
+
+    returns [[x(m), y(m), yaw(rad), direction(1, -1)]]
+    """
+    result = _hybrid_a_star(
+        start,
+        goal,
+        obstacles,
+        cancel_callback,
+        deadline,
+        return_rs_path_immediately=RETURN_RS_PATH_IMMEDIATELY,
+        non_holonomic_heuristic=NON_HOLONOMIC_HEURISTIC,
+    )
+    return result.trajectory if result is not None else None
+
+
+def anytime_hybrid_a_star(
+    start: npt.NDArray[np.floating[Any]],
+    goal: npt.NDArray[np.floating[Any]],
+    obstacles: Obstacles,
+    cancel_callback: Optional[Callable[[Node], SupportsBool]] = None,
+    deadline: Optional[float] = None,
+) -> Generator[npt.NDArray[np.floating[Any]], None, None]:
+    """
+    Yield the trajectories from the start to the goal with decreasing costs, until canceled by `cancel_callback`.
+
+    The first one is from `hybrid_a_star` with `deadline`. The deadline is only a soft budget to return early:
+    it is checked before each expansion, and when it is reached before any trajectory is found, the Reeds-Shepp paths
+    are tried from up to `ANYTIME_RS_ATTEMPTS` nodes. If they all collide, the same search continues without
+    the deadline, so the first trajectory takes as long as without a deadline, plus these attempts.
+
+    Then the trajectory is refined by the searches with `ANYTIME_HEURISTIC_WEIGHTS`, where the heuristic is inflated
+    to find a trajectory quickly, and relaxed later to find a cheaper one.
+
+    yields [[x(m), y(m), yaw(rad), direction(1, -1)]]
+    """
+    canceled = False
+
+    def callback(node: Node) -> bool:
+        nonlocal canceled
+        canceled = cancel_callback is not None and bool(cancel_callback(node))
+        return canceled
+
+    result = _hybrid_a_star(
+        start,
+        goal,
+        obstacles,
+        callback,
+        deadline,
+        return_rs_path_immediately=RETURN_RS_PATH_IMMEDIATELY,
+        non_holonomic_heuristic=NON_HOLONOMIC_HEURISTIC,
+        resume_after_deadline=True,
+    )
+    if result is None:
+        return
+    yield result.trajectory
+
+    for weight in ANYTIME_HEURISTIC_WEIGHTS:
+        refined = _hybrid_a_star(
+            start,
+            goal,
+            obstacles,
+            callback,
+            heuristic_weight=weight,
+            return_rs_path_immediately=False,
+            non_holonomic_heuristic=True,
+            cost_bound=result.cost,
+        )
+        if canceled:
+            return
+        if refined is not None:  # always cheaper than the cost bound
+            result = refined
+            yield result.trajectory
@@ -0,0 +1,374 @@
+import hashlib
+from collections import OrderedDict
+from functools import cache
+from itertools import product
+from typing import Any, Literal, NamedTuple, Optional
+
+import numpy as np
+import numpy.typing as npt
+import scipy.sparse
+import scipy.sparse.csgraph
+from rsplan import Path as RSPath
+
+from ..constants import *
+from ..modeling.Car import Car
+from ..modeling.Obstacles import ObstacleGrid, Obstacles
+from ..utils.cached_array import cached_array
+from ..utils.wrap_angle import wrap_angle
+
+XY_GRID_RESOLUTION = 1.0  # [m]
+YAW_GRID_RESOLUTION = np.deg2rad(15.0)  # [rad]
+MOTION_DISTANCE = XY_GRID_RESOLUTION * 1.5  # [m] path interpolate distance
+NUM_STEER_COMMANDS = 10  # number of steer command
+
+REEDS_SHEPP_MAX_DISTANCE = 10.0  # maximum distance to use Reeds-Shepp path
+
+SWITCH_DIRECTION_COST = 25.0  # switch direction cost
+BACKWARDS_COST = 4.0  # backward movement cost
+STEER_CHANGE_COST = 3.0  # steer angle change cost
+STEER_COST = 1.5  # steer angle cost per distance
+H_DIST_COST = 2.0  # Heuristic distance cost
+H_YAW_COST = 3.0 / np.deg2rad(45)  # Heuristic yaw difference cost
+H_COLLISION_COST = 1e4  # collision cost when calculating heuristic
+OBSTACLE_GRID_RADIUS = min(Car.COLLISION_LENGTH, Car.COLLISION_WIDTH) / 2  # [m] collision radius of the heuristic grid
+
+# number of obstacle grids and distance heuristics kept in memory, so that replanning with the same obstacles
+# or with a few more obstacles appended doesn't compute them from scratch
+HEURISTIC_CACHE_SIZE = 8
+
+STEER_COMMANDS = np.unique(
+    np.concatenate([np.linspace(-Car.TARGET_MAX_STEER, Car.TARGET_MAX_STEER, NUM_STEER_COMMANDS), [0.0]])
+)
+
+
+MOTIONS = tuple(product((1, -1), STEER_COMMANDS))  # [(direction, steer)]
+MOTION_STEPS = int(MOTION_DISTANCE / MOTION_RESOLUTION)
+MOTION_STEP_DISTANCES = np.arange(1, MOTION_STEPS + 1) * MOTION_RESOLUTION  # [m] distance moved at each step
+MOTION_DIRECTIONS, MOTION_STEERS = np.array(MOTIONS).T
+MOTION_DISTANCE_COSTS = np.where(MOTION_DIRECTIONS == 1, MOTION_DISTANCE, MOTION_DISTANCE * BACKWARDS_COST)
+MOTION_STEER_COSTS = STEER_COST * np.abs(MOTION_STEERS) * MOTION_DISTANCE
+
+RS_SEGMENT_STEERS = {"left": Car.TARGET_MAX_STEER, "right": -Car.TARGET_MAX_STEER, "straight": 0.0}
+
+MOVEMENTS = tuple((di, dj, np.sqrt(di**2 + dj**2)) for di in (-1, 0, 1) for dj in (-1, 0, 1) if di or dj)
+
+
+def _rollout_motions(x: float, y: float, yaw: float) -> npt.NDArray[np.floating[Any]]:
+    """
+    Simulate every motion in `MOTIONS` from the pose [x, y, yaw] at once, which is equivalent to
+    calling `Car.update(MOTION_RESOLUTION)` for `MOTION_STEPS` times on each of them.
+
+    returns [motion][step][x(m), y(m), yaw(rad)]
+    """
+    directions, steers = np.array(MOTIONS).T
+    yaw_rates = directions / Car.WHEEL_BASE * np.tan(steers) * MOTION_RESOLUTION
+    xs, ys, yaws = np.full(len(MOTIONS), x), np.full(len(MOTIONS), y), np.full(len(MOTIONS), yaw)
+    trajectories = np.empty((len(MOTIONS), MOTION_STEPS, 3))
+    for step in range(MOTION_STEPS):
+        xs = xs + directions * np.cos(yaws) * MOTION_RESOLUTION
+        ys = ys + directions * np.sin(yaws) * MOTION_RESOLUTION
+        yaws = wrap_angle(yaws + yaw_rates)
+        trajectories[:, step] = np.column_stack((xs, ys, yaws))
+    return trajectories
+
+
+@cache
+def motion_primitives() -> npt.NDArray[np.floating[Any]]:
+    """
+    The trajectories of `MOTIONS` starting from the origin with zero yaw, which only depend on the planner
+    configuration, so they are computed once and cached on disk.
+
+    returns [motion][step][dx(m), dy(m), dyaw(rad)]
+    """
+    key = (STEER_COMMANDS, MOTION_DISTANCE, MOTION_RESOLUTION, Car.WHEEL_BASE)
+    primitives = cached_array("motion_primitives", key, lambda: _rollout_motions(0.0, 0.0, 0.0))
+    primitives.flags.writeable = False
+    return primitives
+
+
+def transform_motions(x: float, y: float, yaw: float) -> npt.NDArray[np.floating[Any]]:
+    """
+    Same as `_rollout_motions(x, y, yaw)`, but only rotates and translates the precomputed motion primitives,
+    since the motion model is invariant to the start pose.
+
+    returns [motion][step][x(m), y(m), yaw(rad)]
+    """
+    primitives = motion_primitives()
+    dx, dy, dyaw = primitives[..., 0], primitives[..., 1], primitives[..., 2]
+    c, s = np.cos(yaw), np.sin(yaw)
+    return np.stack((x + dx * c - dy * s, y + dx * s + dy * c, wrap_angle(yaw + dyaw)), axis=-1)
+
+
+def calc_rspath_cost(path: RSPath, last_direction: Literal[1, 0, -1], last_steer: float) -> float:
+    """
+    Same logic to calculate the cost of a path in the `generate_neighbours` of `hybrid_a_star`, except that:
+
+    1. the heuristic cost is 0, since the Reeds-Shepp path is directly from the current node to the goal.
+    2. the cost of the path is calculated as the sum of the cost of each segment in the path.
+    """
+    distance_cost = 0.0
+    switch_direction_cost = 0.0
+    steer_change_cost = 0.0
+    steer_cost = 0.0
+    for segment in path.segments:
+        length = abs(segment.length)
+        distance_cost += length if segment.direction == 1 else length * BACKWARDS_COST
+        if last_direction != 0 and segment.direction != last_direction:
+            switch_direction_cost += SWITCH_DIRECTION_COST
+        last_direction = segment.direction
+        steer = RS_SEGMENT_STEERS[segment.type]
+        steer_change_cost += STEER_CHANGE_COST * abs(steer - last_steer)
+        last_steer = steer
+        steer_cost += STEER_COST * abs(steer) * length
+    return distance_cost + switch_direction_cost + steer_change_cost + steer_cost
+
+
+def _grid_graph(grid: npt.NDArray[np.bool_]) -> scipy.sparse.csr_array:
+    "The 8-connected graph of the grid cells in `MOVEMENTS`, where the edges only go into the obstacle-free cells"
+    H, W = grid.shape
+    ids = np.arange(H * W).reshape(H, W)
+    sources, targets, weights = [], [], []
+    for di, dj, cost in MOVEMENTS:
+        # the cells (i, j) and (i + di, j + dj) that are both within the grid
+        source = ids[max(0, -di) : H - max(0, di), max(0, -dj) : W - max(0, dj)]
+        target = ids[max(0, di) : H - max(0, -di), max(0, dj) : W - max(0, -dj)]
+        free = ~grid.ravel()[target]
+        sources.append(source[free])
+        targets.append(target[free])
+        weights.append(np.full(np.count_nonzero(free), cost))
+    edges = (np.concatenate(weights), (np.concatenate(sources), np.concatenate(targets)))
+    return scipy.sparse.csr_array(edges, shape=(H * W, H * W))
+
+
+def _distance_heuristic(grid: ObstacleGrid, goal_xy: npt.ArrayLike) -> ObstacleGrid:
+    """
+    Dijkstra's algorithm to calculate the distance from each grid cell to the goal, where the cells that are
+    obstacles or unreachable within `H_COLLISION_COST` have the distance of `H_COLLISION_COST`.
+    """
+    H, W = grid.grid.shape
+    goal = np.ravel_multi_index(grid.calc_index(goal_xy), (H, W))
+    dist = scipy.sparse.csgraph.dijkstra(_grid_graph(grid.grid), indices=goal, limit=H_COLLISION_COST)
+    dist = np.minimum(dist, H_COLLISION_COST).reshape(H, W)
+    return ObstacleGrid(grid.minx, grid.maxx, grid.miny, grid.maxy, grid.resolution, dist)
+
+
+def _repair_distance_heuristic(
+    heuristic: ObstacleGrid, grid: npt.NDArray[np.bool_], blocked: npt.NDArray[np.bool_], goal: tuple[int, int]
+) -> ObstacleGrid:
+    """
+    Same as `_distance_heuristic` on the new `grid`, where the `blocked` cells of the old grid of `heuristic` have
+    become obstacles. The distances can only increase, and only for the cells that are not closer to the goal than
+    every blocked cell, so only these cells are searched again, starting from the cells with unchanged distances.
+    """
+    blocked = blocked.copy()
+    blocked[goal] = False  # the distance of the goal itself is always 0
+    if not blocked.any() or (min_dist := heuristic.grid[blocked].min()) >= H_COLLISION_COST:
+        return heuristic
+
+    # only the cells within the bounding box of the affected cells and their neighbours need to be searched
+    affected = heuristic.grid >= min_dist
+    rows, cols = np.flatnonzero(affected.any(axis=1)), np.flatnonzero(affected.any(axis=0))
+    window = np.s_[max(rows[0] - 1, 0) : rows[-1] + 2, max(cols[0] - 1, 0) : cols[-1] + 2]
+    graph = _grid_graph(grid[window]).tocoo()
+
+    # a virtual source connected to the unaffected cells with their distances, which may be 0 for the goal
+    window_dist, unaffected = heuristic.grid[window].ravel(), np.flatnonzero(~affected[window])
+    source = n = len(window_dist)
+    edges = (
+        np.concatenate((graph.data, window_dist[unaffected])),
+        (np.concatenate((graph.row, np.full(len(unaffected), source))), np.concatenate((graph.col, unaffected))),
+    )
+    new_dist = scipy.sparse.csgraph.dijkstra(
+        scipy.sparse.csr_array(edges, shape=(n + 1, n + 1)), indices=source, limit=H_COLLISION_COST
+    )
+    dist = heuristic.grid.copy()
+    new_dist = np.minimum(new_dist[:n], H_COLLISION_COST).reshape(dist[window].shape)
+    dist[window] = np.where(affected[window], new_dist, dist[window])
+    return heuristic._replace(grid=dist)
+
+
+class _HeuristicCache:
+    """
+    LRU cache of the obstacle grids keyed by the content of the obstacles, and the distance heuristics keyed by
+    the obstacle grid and the goal cell. When the obstacles are the cached ones with a few more appended within the
+    same range, e.g. the newly discovered obstacles when the trajectory collided, the grid and the heuristic to
+    the same goal are updated incrementally from the cached ones.
+    """
+
+    class _GridEntry(NamedTuple):
+        coordinates: npt.NDArray[np.floating[Any]]
+        grid: ObstacleGrid
+        parent: Optional[tuple[str, npt.NDArray[np.bool_]]]  # (key of the old grid, newly blocked cells)
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._grids: OrderedDict[str, _HeuristicCache._GridEntry] = OrderedDict()
+        self._heuristics: OrderedDict[tuple[str, tuple[int, int]], ObstacleGrid] = OrderedDict()
+
+    def _put(self, cache: OrderedDict, key: Any, value: Any) -> None:
+        cache[key] = value
+        while len(cache) > self._maxsize:
+            cache.popitem(last=False)
+
+    def obstacle_grid(self, obstacles: Obstacles) -> tuple[str, ObstacleGrid]:
+        "Returns the key and the grid of the obstacles downsampled by `XY_GRID_RESOLUTION` and `OBSTACLE_GRID_RADIUS`"
+        coordinates = obstacles.coordinates
+        hasher = hashlib.sha1(f"{XY_GRID_RESOLUTION}{OBSTACLE_GRID_RADIUS}{coordinates.shape}".encode())
+        hasher.update(np.ascontiguousarray(coordinates, dtype=np.float64).tobytes())
+        key = hasher.hexdigest()
+        if (entry := self._grids.get(key)) is not None:
+            self._grids.move_to_end(key)
+            return key, entry.grid
+
+        entry = None
+        for old_key, old in reversed(self._grids.items()):  # the obstacles are appended to the recent ones mostly
+            n = len(old.coordinates)
+            if n < len(coordinates) and np.array_equal(coordinates[:n], old.coordinates):
+                added = coordinates[n:]
+                old_min, old_max = old.coordinates.min(axis=0), old.coordinates.max(axis=0)
+                # the range of the grid is determined by the obstacles, so it must not change
+                if (added.min(axis=0) >= old_min).all() and (added.max(axis=0) <= old_max).all():
+                    grid = old.grid.with_obstacles(added, OBSTACLE_GRID_RADIUS)
+                    entry = self._GridEntry(coordinates, grid, (old_key, grid.grid & ~old.grid.grid))
+                break
+        if entry is None:
+            entry = self._GridEntry(
+                coordinates, obstacles.downsampling_to_grid(XY_GRID_RESOLUTION, OBSTACLE_GRID_RADIUS), None
+            )
+        entry.grid.grid.flags.writeable = False
+        self._put(self._grids, key, entry)
+        return key, entry.grid
+
+    def distance_heuristic(self, grid_key: str, grid: ObstacleGrid, goal_xy: npt.ArrayLike) -> ObstacleGrid:
+        "Same as `_distance_heuristic(grid, goal_xy)`, where `grid` is returned by `obstacle_grid` with `grid_key`"
+        goal = grid.calc_index(goal_xy)
+        if (heuristic := self._heuristics.get((grid_key, goal))) is not None:
+            self._heuristics.move_to_end((grid_key, goal))
+            return heuristic
+
+        entry = self._grids.get(grid_key)
+        if entry is not None and entry.parent is not None and (entry.parent[0], goal) in self._heuristics:
+            old_key, blocked = entry.parent
+            heuristic = _repair_distance_heuristic(self._heuristics[old_key, goal], grid.grid, blocked, goal)
+        else:
+            heuristic = _distance_heuristic(grid, goal_xy)
+        heuristic.grid.flags.writeable = False
+        self._put(self._heuristics, (grid_key, goal), heuristic)
+        return heuristic
+
+
+heuristic_cache = _HeuristicCache(HEURISTIC_CACHE_SIZE)
+
+
+class SimplePath(NamedTuple):
+    ijk: tuple[int, int, int]  # grid index
+    trajectory: npt.NDArray[np.floating[Any]]  # [[x(m), y(m), yaw(rad)]]
+    direction: Literal[1, 0, -1]  # direction, 1 forward, -1 backward, 0 initial
+    steer: float  # [rad], [-TARGET_MAX_STEER, TARGET_MAX_STEER]
+
+
+class Node(NamedTuple):
+    "A node of the search, which is only built for `cancel_callback`, since the search stores nodes in `NodeArena`"
+
+    path: SimplePath | RSPath
+    cost: float
+    h_cost: float
+    parent_pose: Optional[npt.NDArray[np.floating[Any]]]  # [x(m), y(m), yaw(rad)] at the end of the parent node
+
+    def get_plot_trajectory(self) -> npt.NDArray[np.floating[Any]]:
+        "Get the trajectory coordinates for visualization"
+        trajectory = (
+            np.array([[p.x, p.y] for p in self.path.waypoints()])
+            if isinstance(self.path, RSPath)
+            else self.path.trajectory[:, :2]
+        )
+        if self.parent_pose is not None:
+            trajectory = np.vstack((self.parent_pose[:2], trajectory))
+        return trajectory
+
+
+class NodeArena:
+    """
+    Struct-of-arrays storage of the nodes of `hybrid_a_star`, where each node is referred to by an integer id.
+    Only the end pose and the motion of a node are stored, and its trajectory is regenerated from the end pose
+    of its parent when needed, so the memory only grows with the number of nodes.
+    """
+
+    START, RSPATH = -1, -2  # special values of `motion` for the start node and the Reeds-Shepp path nodes
+
+    _ARRAYS = ("cost", "h_cost", "parent", "cell", "pose", "motion")
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self.size = 0
+        self.cost = np.empty(capacity)
+        self.h_cost = np.empty(capacity)
+        self.parent = np.empty(capacity, dtype=np.intp)  # -1 for the start node
+        self.cell = np.empty(capacity, dtype=np.intp)  # flattened grid index [i, j, k], -1 for Reeds-Shepp path nodes
+        self.pose = np.empty((capacity, 3))  # [x(m), y(m), yaw(rad)] at the end of the node
+        self.motion = np.empty(capacity, dtype=np.int8)  # index of `MOTIONS`, or `START` or `RSPATH`
+        self.rspaths: dict[int, RSPath] = {}
+
+    def add(
+        self,
+        cost: npt.ArrayLike,
+        h_cost: npt.ArrayLike,
+        parent: int,
+        cell: npt.ArrayLike,
+        pose: npt.ArrayLike,
+        motion: npt.ArrayLike,
+    ) -> range:
+        "Add the nodes with the same parent, returns their ids"
+        n = len(np.atleast_1d(cost))
+        while self.size + n > len(self.cost):
+            for name in self._ARRAYS:
+                array = getattr(self, name)
+                grown = np.empty((2 * len(array), *array.shape[1:]), dtype=array.dtype)
+                grown[: self.size] = array[: self.size]
+                setattr(self, name, grown)
+        ids = range(self.size, self.size + n)
+        self.cost[ids.start : ids.stop] = cost
+        self.h_cost[ids.start : ids.stop] = h_cost
+        self.parent[ids.start : ids.stop] = parent
+        self.cell[ids.start : ids.stop] = cell
+        self.pose[ids.start : ids.stop] = pose
+        self.motion[ids.start : ids.stop] = motion
+        self.size += n
+        return ids
+
+
+def prepare_start(
+    start: npt.NDArray[np.floating[Any]],
+) -> tuple[npt.NDArray[np.floating[Any]], Literal[1, 0, -1], float]:
+    """
+    The start of `hybrid_a_star` is either a pose [x, y, yaw], or a trajectory [[x, y, yaw, velocity]] that the car
+    is going to follow before the planned one, e.g. the braking trajectory.
+
+    returns (trajectory, direction, steer), where the trajectory is [[x, y, yaw]] for a pose, or
+    [[x, y, yaw, direction]] for a trajectory, and direction and steer are at the end of it
+    """
+    if start.shape == (3,):
+        return np.array([start]), 0, 0.0
+    xy = start[:, :2]
+    mask = (xy[:-1] != xy[1:]).any(axis=1)  # remove consecutive identical points
+    start = start[np.concatenate(([True], mask))]
+    start[:, 3] = np.sign(start[0, 3])
+    steer = 0.0
+    if start.shape[0] >= 2 and (l := np.linalg.norm(start[-1, :2] - start[-2, :2])):
+        steer = np.arctan(Car.WHEEL_BASE * (start[-1, 2] - start[-2, 2]) / l)
+    return start, start[0, 3], steer
+
+
+def join_segments(segments: list[npt.ArrayLike]) -> npt.NDArray[np.floating[Any]]:
+    """
+    Join the segments of [[x(m), y(m), yaw(rad), direction(1, 0, -1)]] from the start to the goal into the final
+    trajectory, where the initial driving direction is set and the consecutive direction changing points are removed
+    """
+    trajectory = np.vstack(segments)
+
+    d = trajectory[:, 3]
+    d[0] = d[1] if len(d) > 1 else 1  # set the initial driving direction
+
+    # remove consecutive direction changing points
+    mask = d[:-1] != d[1:]
+    mask = np.bitwise_and(mask[:-1], mask[1:])
+    return trajectory[np.concatenate(([True], ~mask, [True]))]
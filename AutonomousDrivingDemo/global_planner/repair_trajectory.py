@@ -0,0 +1,66 @@
+from collections.abc import Callable
+from typing import Any, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from ..modeling.Car import Car
+from ..modeling.Obstacles import Obstacles
+from ..utils.SupportsBool import SupportsBool
+from .hybrid_a_star import hybrid_a_star
+from .hybrid_a_star_common import Node, join_segments
+
+# [m] distances along the trajectory before the first and after the last collided pose to replan between,
+# which are tried in order until the repair succeeds
+REPAIR_MARGINS = (3.0, 6.0, 12.0)
+REPAIR_MAX_NODES = 2000  # maximum number of nodes to search for each margin
+
+
+def repair_trajectory(
+    trajectory: npt.NDArray[np.floating[Any]],
+    collided_range: tuple[int, int],
+    obstacles: Obstacles,
+    min_start_index: int = 0,
+    cancel_callback: Optional[Callable[[Node], SupportsBool]] = None,
+) -> Optional[npt.NDArray[np.floating[Any]]]:
+    """
+    Replan only the part of the trajectory around the collided poses, and keep the prefix and the suffix of it,
+    returns None if the repair fails, so that the whole trajectory should be replanned instead.
+
+    trajectory: [[x(m), y(m), yaw(rad), direction(1, -1)]]
+    collided_range: the indices of the first and the last collided poses of the trajectory
+    min_start_index: the part before this index is kept, e.g. the part that the car has passed or is about to pass
+
+    returns [[x(m), y(m), yaw(rad), direction(1, -1)]]
+    """
+    first, last = collided_range
+    if first < min_start_index:
+        return None
+    distances = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(trajectory[:, :2], axis=0), axis=1))))
+    directions = trajectory[:, 3]
+
+    for margin in REPAIR_MARGINS:
+        start_index = max(int(np.searchsorted(distances, distances[first] - margin, side="right")) - 1, min_start_index)
+        end_index = min(int(np.searchsorted(distances, distances[last] + margin)), len(trajectory) - 1)
+        goal = trajectory[end_index, :3]
+        if Car(*goal).check_collision(obstacles):
+            continue
+
+        # start from the part of the trajectory with the same direction, so the cost of switching direction is counted
+        changes = np.flatnonzero(directions[: start_index + 1] != directions[start_index])
+        run_start = changes[-1] + 1 if len(changes) else 0
+        start = trajectory[run_start : start_index + 1]
+
+        num_nodes, canceled = 0, False
+
+        def callback(node: Node) -> bool:
+            nonlocal num_nodes, canceled
+            num_nodes += 1
+            canceled = cancel_callback is not None and bool(cancel_callback(node))
+            return canceled or num_nodes > REPAIR_MAX_NODES
+
+        if (repaired := hybrid_a_star(start, goal, obstacles, callback)) is not None:
+            return join_segments([trajectory[:run_start], repaired, trajectory[end_index + 1 :]])
+        if canceled:
+            return None
+    return None
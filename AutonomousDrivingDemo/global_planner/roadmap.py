@@ -0,0 +1,380 @@
+from collections.abc import Callable
+from functools import cache
+from itertools import islice
+from typing import Any, Literal, Optional
+
+import numpy as np
+import numpy.typing as npt
+import scipy.sparse
+import scipy.sparse.csgraph
+from rsplan import Path as RSPath
+from rsplan.planner import _solve_path as solve_rspath
+
+from ..constants import *
+from ..modeling.Car import Car
+from ..modeling.ConfigurationSpace import FOOTPRINT_RADIUS, ConfigurationSpace
+from ..modeling.Obstacles import Obstacles
+from ..utils.cached_array import cached_array
+from ..utils.SupportsBool import SupportsBool
+from ..utils.wrap_angle import wrap_angle
+from .hybrid_a_star import CONFIGURATION_SPACE_RESOLUTION, CONFIGURATION_SPACE_YAW_RESOLUTION, hybrid_a_star
+from .hybrid_a_star_common import (
+    BACKWARDS_COST,
+    REEDS_SHEPP_MAX_DISTANCE,
+    STEER_CHANGE_COST,
+    STEER_COST,
+    SWITCH_DIRECTION_COST,
+    Node,
+    calc_rspath_cost,
+    join_segments,
+    prepare_start,
+)
+
+ROADMAP_XY_RESOLUTION = 2.0  # [m] spacing of the lattice
+ROADMAP_YAW_COUNT = 16  # number of the headings of the lattice
+ROADMAP_EDGE_CELLS = 3  # an edge connects two lattice nodes at most this many cells away in both x and y
+# an edge is only kept if its length is at most this many times the straight distance between its ends
+ROADMAP_MAX_DETOUR = 2.0
+ROADMAP_CONNECT_DISTANCE = 2 * ROADMAP_XY_RESOLUTION  # [m] the start and the goal are connected to the nodes within it
+ROADMAP_MAX_CONNECTIONS = 16  # maximum number of the nodes the start and the goal are connected to, the closest first
+ROADMAP_CHECK_BATCH_SIZE = 10000  # number of edges checked at once against the new obstacles
+ROADMAP_CHECK_RESOLUTION = 0.5  # [m] resolution of the grid to find the poses close to the new obstacles
+ROADMAP_CHECK_STRIDE = 4  # every this many waypoints of the edges are checked in each pass
+MAX_CACHE_ENTRIES = 4  # number of roadmaps kept in the disk cache
+
+LATTICE_YAWS = np.arange(ROADMAP_YAW_COUNT) * (2 * np.pi / ROADMAP_YAW_COUNT)
+
+
+def _compute_lattice_primitives() -> npt.NDArray[np.floating[Any]]:
+    "returns [p][start_k, di, dj, end_k, direction, cost, *waypoints.ravel()], see `_lattice_primitives`"
+    primitives, waypoints = [], []
+    offsets = range(-ROADMAP_EDGE_CELLS, ROADMAP_EDGE_CELLS + 1)
+    for start_k, di, dj, end_k in np.ndindex(ROADMAP_YAW_COUNT, len(offsets), len(offsets), ROADMAP_YAW_COUNT):
+        di, dj = offsets[di], offsets[dj]
+        if di == dj == 0:
+            continue
+        x, y = dj * ROADMAP_XY_RESOLUTION, di * ROADMAP_XY_RESOLUTION
+        pathes = solve_rspath(
+            (0.0, 0.0, LATTICE_YAWS[start_k]),
+            (x, y, LATTICE_YAWS[end_k]),
+            Car.TARGET_MIN_TURNING_RADIUS,
+            MOTION_RESOLUTION,
+        )
+        for direction in (1, -1):
+            pathes_of_direction = [
+                path
+                for path in pathes
+                if all(segment.direction == direction for segment in path.segments)
+                and path.total_length <= ROADMAP_MAX_DETOUR * np.hypot(x, y)
+            ]
+            if not pathes_of_direction:
+                continue
+            path = min(pathes_of_direction, key=lambda path: calc_rspath_cost(path, 0, 0.0))
+            primitives.append((start_k, di, dj, end_k, direction, calc_rspath_cost(path, 0, 0.0)))
+            waypoints.append(np.column_stack(path.coordinates_tuple())[1:])
+    steps = max(map(len, waypoints))
+    padded = np.array([np.pad(wp, ((0, steps - len(wp)), (0, 0)), mode="edge") for wp in waypoints])
+    return np.hstack((primitives, padded.reshape(len(padded), -1)))
+
+
+def _primitives_key() -> tuple:
+    return (
+        ROADMAP_XY_RESOLUTION,
+        ROADMAP_YAW_COUNT,
+        ROADMAP_EDGE_CELLS,
+        ROADMAP_MAX_DETOUR,
+        Car.TARGET_MIN_TURNING_RADIUS,
+        MOTION_RESOLUTION,
+        BACKWARDS_COST,
+        STEER_CHANGE_COST,
+        STEER_COST,
+    )
+
+
+@cache
+def _lattice_primitives() -> tuple[npt.NDArray[np.intp], npt.NDArray[np.floating[Any]], npt.NDArray[np.floating[Any]]]:
+    """
+    The edges of the lattice relative to their start nodes, which are the cheapest Reeds-Shepp paths without
+    switching the direction to the nearby lattice nodes, since switching is only allowed at the nodes.
+
+    returns (primitives[p][start_k, di, dj, end_k, direction], costs[p], waypoints[p][step][x(m), y(m), yaw(rad)]),
+    where the waypoints exclude the start pose, and are padded with the last pose
+    """
+    packed = cached_array("roadmap_primitives", _primitives_key(), _compute_lattice_primitives)
+    return packed[:, :5].astype(np.intp), packed[:, 5], packed[:, 6:].reshape(len(packed), -1, 3)
+
+
+def _compute_nodes(configuration_space: ConfigurationSpace) -> npt.NDArray[np.floating[Any]]:
+    "returns [[x(m), y(m), yaw(rad), i, j, k]] of the collision-free lattice nodes"
+    coordinates = configuration_space.obstacles.coordinates
+    (minx, miny), (maxx, maxy) = coordinates.min(axis=0), coordinates.max(axis=0)
+    i, j, k = np.meshgrid(
+        np.arange(int((maxy - miny) // ROADMAP_XY_RESOLUTION) + 1),
+        np.arange(int((maxx - minx) // ROADMAP_XY_RESOLUTION) + 1),
+        np.arange(ROADMAP_YAW_COUNT),
+        indexing="ij",
+    )
+    i, j, k = i.ravel(), j.ravel(), k.ravel()
+    poses = np.column_stack((minx + j * ROADMAP_XY_RESOLUTION, miny + i * ROADMAP_XY_RESOLUTION, LATTICE_YAWS[k]))
+    free = ~configuration_space.check_collision_batch(poses)
+    return np.column_stack((poses, i, j, k))[free]
+
+
+def _compute_edges(
+    configuration_space: ConfigurationSpace, nodes: npt.NDArray[np.floating[Any]]
+) -> npt.NDArray[np.intp]:
+    "returns [[source node, destination node, primitive]] of the collision-free edges"
+    primitives, _, waypoints = _lattice_primitives()
+    ijk = nodes[:, 3:].astype(np.intp)
+    lattice = np.full(ijk.max(axis=0) + 1, -1, dtype=np.intp)  # [i][j][k] -> node
+    lattice[tuple(ijk.T)] = np.arange(len(nodes))
+
+    edges = []
+    for p, (start_k, di, dj, end_k, _) in enumerate(primitives):
+        source = np.flatnonzero(ijk[:, 2] == start_k)
+        i, j = ijk[source, 0] + di, ijk[source, 1] + dj
+        inside = (0 <= i) & (i < lattice.shape[0]) & (0 <= j) & (j < lattice.shape[1])
+        source, i, j = source[inside], i[inside], j[inside]
+        destination = lattice[i, j, end_k]
+        source, destination = source[destination >= 0], destination[destination >= 0]
+
+        poses = waypoints[p] + np.column_stack((nodes[source, :2], np.zeros(len(source))))[:, None]
+        collided = configuration_space.check_collision_batch(poses.reshape(-1, 3)).reshape(poses.shape[:2])
+        free = ~collided.any(axis=1)
+        edges.append(np.column_stack((source[free], destination[free], np.full(free.sum(), p))))
+    return np.vstack(edges).astype(np.intp)
+
+
+def _connect_rspath(
+    src: npt.NDArray[np.floating[Any]],
+    dst: npt.NDArray[np.floating[Any]],
+    configuration_space: ConfigurationSpace,
+    direction: Literal[1, 0, -1] = 0,
+    steer: float = 0.0,
+) -> Optional[RSPath]:
+    "The cheapest collision-free Reeds-Shepp path from `src` to `dst`"
+    pathes = solve_rspath(tuple(src), tuple(dst), Car.TARGET_MIN_TURNING_RADIUS, MOTION_RESOLUTION)
+    # the first collision-free path in the order of the cost is the cheapest one
+    for path in sorted(pathes, key=lambda path: calc_rspath_cost(path, direction, steer)):
+        poses = np.column_stack(path.coordinates_tuple())
+        if not configuration_space.check_collision_batch(poses, early_stop=True).any():
+            return path
+    return None
+
+
+class Roadmap:
+    """
+    A state lattice over a static map, whose nodes are the collision-free poses on a grid of `ROADMAP_XY_RESOLUTION`
+    and `ROADMAP_YAW_COUNT` headings, and whose edges are the collision-free Reeds-Shepp paths between nearby nodes.
+    It is built once per map and memory-mapped from the disk cache afterwards, so that a plan only connects the start
+    and the goal to the roadmap, and finds the cheapest path on it. The map may grow with the obstacles discovered
+    later, which only invalidate the edges around them.
+    """
+
+    def __init__(self, obstacles: Obstacles) -> None:
+        self._obstacles = obstacles
+        # only built if the roadmap is not cached yet, or the new obstacles are added to it
+        self._configuration_space = configuration_space = cache(
+            lambda: ConfigurationSpace(obstacles, CONFIGURATION_SPACE_RESOLUTION, CONFIGURATION_SPACE_YAW_RESOLUTION)
+        )
+        key = (obstacles.coordinates, _primitives_key(), Car.BACK_TO_CENTER, Car.COLLISION_LENGTH, Car.COLLISION_WIDTH)
+        self._nodes = cached_array(
+            "roadmap_nodes",
+            key,
+            lambda: _compute_nodes(configuration_space()),
+            mmap_mode="r",
+            max_entries=MAX_CACHE_ENTRIES,
+        )
+        self._edges = cached_array(
+            "roadmap_edges",
+            key,
+            lambda: _compute_edges(configuration_space(), self._nodes),
+            mmap_mode="r",
+            max_entries=MAX_CACHE_ENTRIES,
+        )
+        primitives, costs, self._waypoints = _lattice_primitives()
+        self._edge_directions = primitives[self._edges[:, 2], 4]
+        self._edge_costs = costs[self._edges[:, 2]]
+        # [m] the farthest distance from the source node of an edge that its footprint may reach
+        self._edge_reach = np.linalg.norm(self._waypoints[..., :2], axis=-1).max() + FOOTPRINT_RADIUS
+
+        # the edges colliding with the obstacles appended to the map, and the appended obstacles checked so far
+        self._invalid = np.zeros(len(self._edges), dtype=bool)
+        self._checked_coordinates = obstacles.coordinates[:0]
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self._nodes)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self._edges)
+
+    def _edge_waypoints(self, edges: npt.ArrayLike) -> npt.NDArray[np.floating[Any]]:
+        "returns [edge][step][x(m), y(m), yaw(rad)], excluding the poses of the source nodes"
+        source, primitive = self._edges[edges, 0], self._edges[edges, 2]
+        xy = self._nodes[source, :2]
+        return self._waypoints[primitive] + np.concatenate((xy, np.zeros_like(xy[..., :1])), axis=-1)[..., None, :]
+
+    def _invalidate(
+        self, new_coordinates: npt.NDArray[np.floating[Any]], configuration_space: ConfigurationSpace
+    ) -> None:
+        """
+        Check the edges around the obstacles appended to the map, where the ones checked by the last plan are skipped
+        if they are still the first ones of `new_coordinates`, since the obstacles are usually only discovered
+        """
+        checked = self._checked_coordinates
+        if len(checked) > len(new_coordinates) or not np.array_equal(new_coordinates[: len(checked)], checked):
+            self._invalid[:] = False
+            checked = checked[:0]
+        self._checked_coordinates = new_coordinates
+        if len(new_coordinates) == len(checked):
+            return
+
+        # only the new obstacles may collide with the edges, which are checked without the obstacles of the map
+        added = Obstacles(new_coordinates[len(checked) :])
+        distances, _ = added.kd_tree.query(self._nodes[:, :2], distance_upper_bound=self._edge_reach)
+        near = np.flatnonzero(np.isfinite(distances)[self._edges[:, 0]] & ~self._invalid)
+        # the cells whose centers may be within the collision radius of the car from the new obstacles
+        grid = self._obstacles.empty_grid(ROADMAP_CHECK_RESOLUTION).with_obstacles(
+            added.coordinates, Car.COLLISION_RADIUS + ROADMAP_CHECK_RESOLUTION * np.sqrt(2) / 2
+        )
+
+        def check_collision(poses: npt.NDArray[np.floating[Any]]) -> npt.NDArray[np.bool_]:
+            c, s = np.cos(poses[:, 2]), np.sin(poses[:, 2])
+            centers = poses[:, :2] + Car.BACK_TO_CENTER * np.column_stack((c, s))
+            i = np.floor((centers[:, 1] - grid.miny) / grid.resolution).astype(np.intp)
+            j = np.floor((centers[:, 0] - grid.minx) / grid.resolution).astype(np.intp)
+            inside = (0 <= i) & (i < grid.grid.shape[0]) & (0 <= j) & (j < grid.grid.shape[1])
+            collided = inside & grid.grid[np.where(inside, i, 0), np.where(inside, j, 0)]
+            collided[collided] = configuration_space.may_collide_batch(poses[collided])
+            collided[collided] = Car.check_collision_batch(poses[collided], added)
+            return collided
+
+        for edges in np.array_split(near, max(1, len(near) // ROADMAP_CHECK_BATCH_SIZE)):
+            poses = self._edge_waypoints(edges)
+            # the sparse waypoints are checked first, so that most of the colliding edges are found before the rest
+            free = np.ones(len(edges), dtype=bool)
+            for offset in range(ROADMAP_CHECK_STRIDE):
+                steps = poses[free, offset::ROADMAP_CHECK_STRIDE]
+                collided = check_collision(steps.reshape(-1, 3)).reshape(steps.shape[:2]).any(axis=1)
+                free[np.flatnonzero(free)[collided]] = False
+            self._invalid[edges[~free]] = True
+
+    def _connect(
+        self,
+        pose: npt.NDArray[np.floating[Any]],
+        to_roadmap: bool,
+        configuration_space: ConfigurationSpace,
+        direction: Literal[1, 0, -1] = 0,
+        steer: float = 0.0,
+    ) -> list[tuple[int, RSPath]]:
+        """
+        The cheapest collision-free Reeds-Shepp paths from the pose to the nearby nodes, or from them to the pose,
+        where the nodes are tried in the order of the distance to the pose, with the yaw difference as an arc
+        """
+        distances = np.linalg.norm(self._nodes[:, :2] - pose[:2], axis=1)
+        near = np.flatnonzero(distances <= ROADMAP_CONNECT_DISTANCE)
+        arcs = Car.TARGET_MIN_TURNING_RADIUS * np.abs(wrap_angle(self._nodes[near, 2] - pose[2]))
+        ret = []
+        for node in near[np.argsort(np.hypot(distances[near], arcs))]:
+            if len(ret) >= ROADMAP_MAX_CONNECTIONS:
+                break
+            node_pose = self._nodes[node, :3]
+            src, dst = (pose, node_pose) if to_roadmap else (node_pose, pose)
+            if (path := _connect_rspath(src, dst, configuration_space, direction, steer)) is not None:
+                ret.append((int(node), path))
+        return ret
+
+    def plan(
+        self,
+        start: npt.NDArray[np.floating[Any]],
+        goal: npt.NDArray[np.floating[Any]],
+        obstacles: Obstacles,
+        cancel_callback: Optional[Callable[[Node], SupportsBool]] = None,
+    ) -> Optional[npt.NDArray[np.floating[Any]]]:
+        """
+        Same as `hybrid_a_star`, but finds the path on the roadmap, which falls back to `hybrid_a_star` if
+        the obstacles are not the ones of the roadmap with new ones appended, or the start and the goal can't be
+        connected through the roadmap. `cancel_callback` is only called by `hybrid_a_star`.
+
+        returns [[x(m), y(m), yaw(rad), direction(1, -1)]]
+        """
+        n = len(self._obstacles.coordinates)
+        if len(obstacles.coordinates) < n or not np.array_equal(obstacles.coordinates[:n], self._obstacles.coordinates):
+            return hybrid_a_star(start, goal, obstacles, cancel_callback)
+        if Car(*goal).check_collision(obstacles):
+            return None
+        new_coordinates = obstacles.coordinates[n:]
+        (minx, miny), (maxx, maxy) = self._obstacles.coordinates.min(axis=0), self._obstacles.coordinates.max(axis=0)
+        if not len(new_coordinates):
+            configuration_space = self._configuration_space()
+        elif ((new_coordinates >= [minx, miny]) & (new_coordinates <= [maxx, maxy])).all():
+            configuration_space = self._configuration_space().with_obstacles(obstacles, new_coordinates)
+        else:
+            configuration_space = ConfigurationSpace(
+                obstacles, CONFIGURATION_SPACE_RESOLUTION, CONFIGURATION_SPACE_YAW_RESOLUTION
+            )
+        self._invalidate(new_coordinates, configuration_space)
+        start_trajectory, start_direction, start_steer = prepare_start(start)
+        start_pose = start_trajectory[-1, :3]
+
+        # the states of the graph are (node, direction of the last edge) of the roadmap, then the start and the goal
+        N = 2 * len(self._nodes)
+        START, GOAL = N, N + 1
+
+        def state(node: npt.ArrayLike, direction: npt.ArrayLike) -> npt.NDArray[np.intp]:
+            return 2 * np.asarray(node) + (np.asarray(direction) == -1)
+
+        # the cost of switching direction is added when an edge is entered with the other direction than the last one
+        valid = np.flatnonzero(~self._invalid)
+        rows, cols, costs, edges = [], [], [], []
+        for last_direction in (1, -1):
+            switch = np.where(self._edge_directions[valid] != last_direction, SWITCH_DIRECTION_COST, 0.0)
+            rows.append(state(self._edges[valid, 0], last_direction))
+            cols.append(state(self._edges[valid, 1], self._edge_directions[valid]))
+            costs.append(self._edge_costs[valid] + switch)
+            edges.append(valid)
+        # the Reeds-Shepp paths connecting the start and the goal, keyed by the pair of states they connect
+        rspaths: dict[tuple[int, int], RSPath] = {}
+        for node, path in self._connect(start_pose, True, configuration_space, start_direction, start_steer):
+            rspaths[START, int(state(node, path.segments[-1].direction))] = path
+        for node, path in self._connect(goal, False, configuration_space):
+            for last_direction in (1, -1):
+                rspaths[int(state(node, last_direction)), GOAL] = path
+        if np.linalg.norm(goal[:2] - start_pose[:2]) <= REEDS_SHEPP_MAX_DISTANCE:
+            path = _connect_rspath(start_pose, goal, configuration_space, start_direction, start_steer)
+            if path is not None:
+                rspaths[START, GOAL] = path
+        for (u, v), path in rspaths.items():
+            rows.append([u])
+            cols.append([v])
+            last_direction, last_steer = (start_direction, start_steer) if u == START else (1 - 2 * (u % 2), 0.0)
+            costs.append([calc_rspath_cost(path, last_direction, last_steer)])
+            edges.append([-1])
+        rows, cols, costs, edges = map(np.concatenate, (rows, cols, costs, edges))
+
+        # there is at most one edge between two states, since the primitives are unique
+        graph = scipy.sparse.csr_array((costs, (rows, cols)), shape=(N + 2, N + 2))
+        dist, predecessors = scipy.sparse.csgraph.dijkstra(graph, indices=START, return_predecessors=True)
+        if np.isinf(dist[GOAL]):
+            return hybrid_a_star(start, goal, obstacles, cancel_callback)
+
+        states = [GOAL]
+        while states[-1] != START:
+            states.append(int(predecessors[states[-1]]))
+        states.reverse()
+
+        if start_trajectory.shape[1] == 4:
+            segments = [start_trajectory]
+        else:
+            segments = [np.hstack((start_trajectory, np.full_like(start_trajectory[:, :1], start_direction)))]
+        for u, v in zip(states, states[1:]):
+            if (path := rspaths.get((u, v))) is not None:
+                # RSPath contains the start point, so we skip it using islice
+                segments.append([[p.x, p.y, p.yaw, p.driving_direction] for p in islice(path.waypoints(), 1, None)])
+            else:
+                edge = edges[np.flatnonzero((rows == u) & (cols == v))[0]]
+                waypoints = self._edge_waypoints(edge)
+                segments.append(np.hstack((waypoints, np.full_like(waypoints[:, :1], self._edge_directions[edge]))))
+        return join_segments(segments)
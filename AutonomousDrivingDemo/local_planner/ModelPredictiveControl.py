@@ -1,10 +1,13 @@
-from typing import Any, NamedTuple, Optional
+from functools import cache
+from typing import Any, Literal, NamedTuple, Optional
 
 import cvxpy
 import numpy as np
 import numpy.typing as npt
+import osqp
 import scipy.interpolate
 import scipy.optimize
+import scipy.sparse
 
 from ..constants import *
 from ..modeling.Car import Car
@@ -14,11 +17,17 @@ NEARIST_POINT_SEARCH_RANGE = 20.0  # [m]
 NEARIST_POINT_SEARCH_STEP = 0.1  # [m]
 
 HORIZON_LENGTH = 5  # simulate count
-MIN_HORIZON_DISTANCE = 0.3  # [m]
+MIN_HORIZON_SPEED = 1.0  # [m/s] minimum speed spacing the reference states, to start off from a stop
 
 MAX_ITER = 5
 DU_TH = 0.1  # iteration finish param
 
+# the solver of the linearized problem:
+# "cvxpy": the parameterized problem of `_LinearMPCProblem` solved by Clarabel through cvxpy
+# "osqp": the sparse QP of `_SparseMPCProblem` solved by OSQP directly, warm started from the previous result
+MPC_SOLVER: Literal["cvxpy", "osqp"] = "osqp"
+OSQP_EPS = 1e-6  # absolute and relative tolerances of OSQP
+
 
 # mpc parameters
 R = np.diag([0.01, 0.005])  # input cost matrix
@@ -80,6 +89,218 @@ def _predict_motion(state: Car, controls: npt.NDArray[np.floating[Any]], dt: flo
     return np.array(states)
 
 
+class _LinearMPCProblem:
+    """
+    The linearized problem of `_linear_mpc_control`, built once for a horizon length and dt with `cvxpy.Parameter`s
+    following the DPP rules, so that cvxpy only canonicalizes it on the first solve, and the later solves only update
+    the parameters before calling the solver.
+    """
+
+    def __init__(self, horizon_length: int, dt: float) -> None:
+        # Note: ndarrays in this class are transposed
+        self.x = cvxpy.Variable((NX, horizon_length + 1))  # [x, y, v, yaw]
+        self.u = cvxpy.Variable((NU, horizon_length))  # [accel, steer]
+        self.xref = cvxpy.Parameter((NX, horizon_length + 1))
+        self.x0 = cvxpy.Parameter(NX)
+        self.last_steer = cvxpy.Parameter()
+        self.A = [cvxpy.Parameter((NX, NX)) for _ in range(horizon_length)]
+        self.B = [cvxpy.Parameter((NX, NU)) for _ in range(horizon_length)]
+        self.C = [cvxpy.Parameter(NX) for _ in range(horizon_length)]
+        x, u = self.x, self.u
+
+        # quad_form(v, M) == sum_squares(cholesky(M).T @ v), since `cvxpy.quad_form` of a parameter is not DPP
+        def weighted(v: cvxpy.Expression, M: npt.NDArray[np.floating[Any]]) -> cvxpy.Expression:
+            return cvxpy.sum_squares(np.linalg.cholesky(M).T @ v)
+
+        cost = 0.0
+        constraints = []
+        for t in range(horizon_length):
+            # prefer control to be small
+            cost += cvxpy.quad_form(u[:, t], R)
+            if t != 0:
+                # prefer state to be close to reference
+                cost += weighted(self.xref[:, t] - x[:, t], Q)
+
+            # make sure the next state is transformed from the previous state using the approximated linear model
+            constraints.append(x[:, t + 1] == self.A[t] @ x[:, t] + self.B[t] @ u[:, t] + self.C[t])
+
+        # prefer final state to be close to reference
+        cost += weighted(self.xref[:, horizon_length] - x[:, horizon_length], Q_F)
+
+        if ALLOW_STEER_CHANGE_ON_FIRST_POINT:
+            # make sure steer change is within the maximum steer speed
+            cost += weighted((u[1:, 0] - self.last_steer) / dt, R_D[1:, 1:])
+            constraints.append(cvxpy.abs(u[1, 0] - self.last_steer) <= Car.MAX_STEER_SPEED * dt)
+        else:
+            constraints.append(u[1, 0] == self.last_steer)
+
+        for t in range(1, horizon_length):
+            # prefer control difference between two steps to be small
+            cost += cvxpy.quad_form((u[:, t] - u[:, t - 1]) / dt, R_D)
+
+            # make sure steer change is within the maximum steer speed
+            constraints.append(cvxpy.abs(u[1, t] - u[1, t - 1]) <= Car.MAX_STEER_SPEED * dt)
+
+        # make sure initial state is the current state
+        constraints.append(x[:, 0] == self.x0)
+        # make sure speed at every step is in range
+        constraints.append(x[2, :] <= Car.MAX_SPEED)
+        constraints.append(x[2, :] >= Car.MIN_SPEED)
+        # make sure acceleration at every step is in range
+        constraints.append(cvxpy.abs(u[0, :]) <= Car.MAX_ACCEL)
+        constraints.append(cvxpy.abs(u[1, :]) <= Car.MAX_STEER)
+
+        self.problem = cvxpy.Problem(cvxpy.Minimize(cost), constraints)
+
+
+@cache
+def _linear_mpc_problem(horizon_length: int, dt: float) -> _LinearMPCProblem:
+    return _LinearMPCProblem(horizon_length, dt)
+
+
+class _SparseMPCProblem:
+    """
+    The same problem as `_LinearMPCProblem`, assembled as a sparse QP for OSQP
+    >>> minimize 1/2 z^T P z + q^T z, subject to l <= M z <= h
+    where z = [x_0, ..., x_T, u_0, ..., u_{T-1}]. The sparsity patterns of P and M are fixed for a horizon length,
+    so OSQP only updates the numeric factorization between the solves, and starts from the previous solution.
+    """
+
+    def __init__(self, horizon_length: int, dt: float) -> None:
+        T = self._horizon_length = horizon_length
+        self._dt = dt
+        n = self._num_variables = NX * (T + 1) + NU * T
+
+        # quadratic cost, where only the terms of the reference states go into q
+        self._x_slices = [slice(NX * t, NX * (t + 1)) for t in range(T + 1)]
+        self._u_slices = [slice(NX * (T + 1) + NU * t, NX * (T + 1) + NU * (t + 1)) for t in range(T)]
+        self._weights = [np.zeros((NX, NX))] + [Q] * (T - 1) + [Q_F]
+        P = np.zeros((n, n))
+        for t in range(T + 1):
+            P[self._x_slices[t], self._x_slices[t]] += 2 * self._weights[t]
+        for t in range(T):
+            P[self._u_slices[t], self._u_slices[t]] += 2 * R
+        for t in range(1, T):
+            a, b = self._u_slices[t], self._u_slices[t - 1]
+            P[a, a] += 2 * R_D / dt**2
+            P[b, b] += 2 * R_D / dt**2
+            P[a, b] -= 2 * R_D / dt**2
+            P[b, a] -= 2 * R_D / dt**2
+        if ALLOW_STEER_CHANGE_ON_FIRST_POINT:
+            P[self._u_slices[0].start + 1, self._u_slices[0].start + 1] += 2 * R_D[1, 1] / dt**2
+
+        # constraints, where the entries of -A and -B of the dynamics come first to be updated on each solve
+        rows, cols, lower, upper = [], [], [], []
+
+        def add_rows(num: int, lo: npt.ArrayLike, hi: npt.ArrayLike) -> int:
+            start = len(lower)
+            lower.extend(np.broadcast_to(lo, num))
+            upper.extend(np.broadcast_to(hi, num))
+            return start
+
+        # x_{t+1} - A_t x_t - B_t u_t == C_t
+        self._dynamics_rows = slice(add_rows(NX * T, 0.0, 0.0), len(lower))
+        for t in range(T):
+            # the entries of [A_t, B_t] in row-major order
+            r = self._dynamics_rows.start + NX * t + np.arange(NX)
+            c = np.r_[self._x_slices[t], self._u_slices[t]]
+            i, j = np.meshgrid(r, c, indexing="ij")
+            rows.append(i.ravel())
+            cols.append(j.ravel())
+        entries = [np.zeros(NX * (NX + NU) * T)]
+        for t in range(T):
+            rows.append(self._dynamics_rows.start + NX * t + np.arange(NX))
+            cols.append(np.arange(self._x_slices[t + 1].start, self._x_slices[t + 1].stop))
+            entries.append(np.ones(NX))
+
+        def add_constraint(columns: npt.ArrayLike, values: npt.ArrayLike, lo: float, hi: float) -> int:
+            row = add_rows(1, lo, hi)
+            cols.append(np.atleast_1d(columns))
+            rows.append(np.full(len(cols[-1]), row))
+            entries.append(np.atleast_1d(values).astype(float))
+            return row
+
+        # x_0 == the current state
+        self._initial_rows = [add_constraint(self._x_slices[0].start + k, 1.0, 0.0, 0.0) for k in range(NX)]
+        # the steer of the first step is the current steer, or within the maximum steer speed of it
+        self._first_steer_row = add_constraint(self._u_slices[0].start + 1, 1.0, 0.0, 0.0)
+        for t in range(1, T):
+            steers = [self._u_slices[t].start + 1, self._u_slices[t - 1].start + 1]
+            add_constraint(steers, [1.0, -1.0], -Car.MAX_STEER_SPEED * dt, Car.MAX_STEER_SPEED * dt)
+        for t in range(T + 1):
+            add_constraint(self._x_slices[t].start + 2, 1.0, Car.MIN_SPEED, Car.MAX_SPEED)
+        for t in range(T):
+            add_constraint(self._u_slices[t].start, 1.0, -Car.MAX_ACCEL, Car.MAX_ACCEL)
+            add_constraint(self._u_slices[t].start + 1, 1.0, -Car.MAX_STEER, Car.MAX_STEER)
+
+        # the order of the entries in the CSC matrix, to update the entries of the model in place
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        order = np.arange(1, len(rows) + 1, dtype=float)
+        M = scipy.sparse.csc_matrix((order, (rows, cols)), shape=(len(lower), n))
+        self._csc_order = M.data.astype(np.intp) - 1
+        self._entries = np.concatenate(entries)
+        M.data = self._entries[self._csc_order]
+        self._lower, self._upper = np.array(lower), np.array(upper)
+
+        self._solver = osqp.OSQP()
+        self._solver.setup(
+            scipy.sparse.triu(P, format="csc"),
+            np.zeros(n),
+            M,
+            self._lower,
+            self._upper,
+            eps_abs=OSQP_EPS,
+            eps_rel=OSQP_EPS,
+            polishing=True,
+            warm_starting=True,
+            verbose=False,
+        )
+
+    def solve(
+        self,
+        xref: npt.NDArray[np.floating[Any]],
+        xbar: npt.NDArray[np.floating[Any]],
+        ubar: Optional[npt.NDArray[np.floating[Any]]],
+        last_steer: float,
+    ) -> Optional[tuple[npt.NDArray[np.floating[Any]], npt.NDArray[np.floating[Any]]]]:
+        "Same as `_linear_mpc_control`, but warm started from the states xbar and the controls ubar if given"
+        # Note: ndarrays in this function are transposed
+        T, dt = self._horizon_length, self._dt
+        q = np.zeros(self._num_variables)
+        for t in range(1, T + 1):
+            q[self._x_slices[t]] = -2 * self._weights[t] @ xref[:, t]
+        model_entries, offsets = self._entries[: NX * (NX + NU) * T].reshape(T, NX, NX + NU), []
+        for t in range(T):
+            A, B, C = _get_linear_model_matrix(xbar[2, t], xbar[3, t], last_steer, dt)
+            model_entries[t, :, :NX], model_entries[t, :, NX:] = -A, -B
+            offsets.append(C)
+        self._lower[self._dynamics_rows] = self._upper[self._dynamics_rows] = np.concatenate(offsets)
+        self._lower[self._initial_rows] = self._upper[self._initial_rows] = xbar[:, 0]
+        if ALLOW_STEER_CHANGE_ON_FIRST_POINT:
+            q[self._u_slices[0].start + 1] = -2 * R_D[1, 1] / dt**2 * last_steer
+            steer_range = Car.MAX_STEER_SPEED * dt
+            self._lower[self._first_steer_row] = last_steer - steer_range
+            self._upper[self._first_steer_row] = last_steer + steer_range
+        else:
+            self._lower[self._first_steer_row] = self._upper[self._first_steer_row] = last_steer
+
+        self._solver.update(q=q, l=self._lower, u=self._upper, Ax=self._entries[self._csc_order])
+        if ubar is not None:
+            self._solver.warm_start(x=np.concatenate((xbar.T.ravel(), ubar.T.ravel())))
+        res = self._solver.solve()
+        if res.info.status_val not in (osqp.SolverStatus.OSQP_SOLVED, osqp.SolverStatus.OSQP_SOLVED_INACCURATE):
+            print(f"Error: Cannot solve mpc: {res.info.status}")
+            return None
+        x = res.x[: NX * (T + 1)].reshape(T + 1, NX).T
+        u = res.x[NX * (T + 1) :].reshape(T, NU).T
+        return u, x
+
+
+@cache
+def _sparse_mpc_problem(horizon_length: int, dt: float) -> _SparseMPCProblem:
+    return _SparseMPCProblem(horizon_length, dt)
+
+
 def _linear_mpc_control(
     xref: npt.NDArray[np.floating[Any]], xbar: npt.NDArray[np.floating[Any]], last_steer: float, dt: float
 ) -> Optional[tuple[npt.NDArray[np.floating[Any]], npt.NDArray[np.floating[Any]]]]:
@@ -92,55 +313,20 @@ def _linear_mpc_control(
     https://github.com/AtsushiSakai/PythonRobotics/blob/master/PathTracking/model_predictive_speed_and_steer_control/model_predictive_speed_and_steer_control.py
     """
     # Note: ndarrays in this function are transposed
-    x = cvxpy.Variable((NX, HORIZON_LENGTH + 1))  # [x, y, v, yaw]
-    u = cvxpy.Variable((NU, HORIZON_LENGTH))  # [accel, steer]
-
-    cost = 0.0
-    constraints = []
-    for t in range(HORIZON_LENGTH):
-        # prefer control to be small
-        cost += cvxpy.quad_form(u[:, t], R)
-        if t != 0:
-            # prefer state to be close to reference
-            cost += cvxpy.quad_form(xref[:, t] - x[:, t], Q)
-
-        # make sure the next state is transformed from the previous state using the approximated linear model
+    mpc = _linear_mpc_problem(xref.shape[1] - 1, dt)
+    for t in range(xref.shape[1] - 1):
         A, B, C = _get_linear_model_matrix(xbar[2, t], xbar[3, t], last_steer, dt)
-        constraints.append(x[:, t + 1] == A @ x[:, t] + B @ u[:, t] + C)
-
-    # prefer final state to be close to reference
-    cost += cvxpy.quad_form(xref[:, HORIZON_LENGTH] - x[:, HORIZON_LENGTH], Q_F)
-
-    if ALLOW_STEER_CHANGE_ON_FIRST_POINT:
-        # make sure steer change is within the maximum steer speed
-        cost += cvxpy.quad_form((u[1:, 0] - last_steer) / dt, R_D[1:, 1:])
-        constraints.append(cvxpy.abs(u[1, 0] - last_steer) <= Car.MAX_STEER_SPEED * dt)
-    else:
-        constraints.append(u[1, 0] == last_steer)
-
-    for t in range(1, HORIZON_LENGTH):
-        # prefer control difference between two steps to be small
-        cost += cvxpy.quad_form((u[:, t] - u[:, t - 1]) / dt, R_D)
-
-        # make sure steer change is within the maximum steer speed
-        constraints.append(cvxpy.abs(u[1, t] - u[1, t - 1]) <= Car.MAX_STEER_SPEED * dt)
-
-    # make sure initial state is the current state
-    constraints.append(x[:, 0] == xbar[:, 0])
-    # make sure speed at every step is in range
-    constraints.append(x[2, :] <= Car.MAX_SPEED)
-    constraints.append(x[2, :] >= Car.MIN_SPEED)
-    # make sure acceleration at every step is in range
-    constraints.append(cvxpy.abs(u[0, :]) <= Car.MAX_ACCEL)
-    constraints.append(cvxpy.abs(u[1, :]) <= Car.MAX_STEER)
+        mpc.A[t].value, mpc.B[t].value, mpc.C[t].value = A, B, C
+    mpc.xref.value = xref
+    mpc.x0.value = xbar[:, 0]
+    mpc.last_steer.value = last_steer
 
     # solve the problem
-    prob = cvxpy.Problem(cvxpy.Minimize(cost), constraints)
-    prob.solve(solver=cvxpy.CLARABEL, verbose=False)
-    if prob.status not in (cvxpy.OPTIMAL, cvxpy.OPTIMAL_INACCURATE):
-        print(f"Error: Cannot solve mpc: {prob.status}")
+    mpc.problem.solve(solver=cvxpy.CLARABEL, verbose=False)
+    if mpc.problem.status not in (cvxpy.OPTIMAL, cvxpy.OPTIMAL_INACCURATE):
+        print(f"Error: Cannot solve mpc: {mpc.problem.status}")
         return None
-    return u.value, x.value
+    return mpc.u.value, mpc.x.value
 
 
 def _get_curvature(
@@ -222,6 +408,7 @@ class ModelPredictiveControl:
         self._u_limit = u[-1]
 
         self._brake = self._braked = False
+        self._last_controls: Optional[npt.NDArray[np.floating[Any]]] = None
 
     def _find_nearist_point(self, state: Car) -> None:
         "find the nearist point on the reference trajectory to the given state"
@@ -239,6 +426,19 @@ class ModelPredictiveControl:
                 break
         self._cur_u = min_u
 
+    def _horizon_ticks(self, speed: float, dt: float) -> npt.NDArray[np.floating[Any]]:
+        """
+        The ticks of the reference states within the horizon, spaced by the speed accelerating from the current one
+        towards the reference speeds, so that a long horizon reaches as far as the car can drive, and the reference
+        states pile up before the stops and the curvature speed limits ahead.
+        """
+        ref_u = np.full(HORIZON_LENGTH + 1, self._cur_u)
+        for i in range(HORIZON_LENGTH):
+            ref_speed = abs(scipy.interpolate.splev(min(ref_u[i], self._u_limit), self._tck)[2])
+            speed = min(speed + DESIRED_MAX_ACCEL_RATIO * Car.MAX_ACCEL * dt, ref_speed)
+            ref_u[i + 1] = ref_u[i] + max(speed, MIN_HORIZON_SPEED) * dt
+        return ref_u
+
     def _find_xref(self, state: Car, dt: float) -> npt.NDArray[np.floating[Any]]:
         "find the closest point in the reference trajectory, and interpolate the reference trajectory within a horizon"
         while True:
@@ -246,8 +446,7 @@ class ModelPredictiveControl:
 
             # interpolate the reference trajectory
             v = np.sign(scipy.interpolate.splev(self._cur_u, self._tck)[2]) * state.velocity
-            length = max(MIN_HORIZON_DISTANCE, max(0, v) * dt * HORIZON_LENGTH)
-            ref_u = np.linspace(self._cur_u, self._cur_u + length, HORIZON_LENGTH + 1)
+            ref_u = self._horizon_ticks(max(0, v), dt)
             ref_u = np.clip(ref_u, a_min=None, a_max=self._u_limit)
             xref = np.array(scipy.interpolate.splev(ref_u, self._tck)).T
 
@@ -301,10 +500,16 @@ class ModelPredictiveControl:
 
         # iteratively solve the linearized problem
         controls, states = np.zeros((HORIZON_LENGTH, NU)), np.zeros((HORIZON_LENGTH + 1, NX))
+        if MPC_SOLVER == "osqp" and self._last_controls is not None:
+            # start from the previous result shifted by one step, which is usually close to the new one
+            controls = np.vstack((self._last_controls[1:], self._last_controls[-1:]))
         for _ in range(MAX_ITER):
             xbar = _predict_motion(state, controls, dt)
             pre_controls = controls.copy()
-            res = _linear_mpc_control(xref.T, xbar.T, state.steer, dt)
+            if MPC_SOLVER == "osqp":
+                res = _sparse_mpc_problem(HORIZON_LENGTH, dt).solve(xref.T, xbar.T, controls.T, state.steer)
+            else:
+                res = _linear_mpc_control(xref.T, xbar.T, state.steer, dt)
             if res is None:
                 break
             controls, states = res[0].T, res[1].T
@@ -313,10 +518,24 @@ class ModelPredictiveControl:
                 break
         else:
             print("Warning: Cannot converge mpc")
+        self._last_controls = controls
 
         return MPCResult(
             controls, states[:, [0, 1, 3, 2]], xref[:, [0, 1, 3, 2]], self._brake_trajectory[:, [0, 1, 3, 2]]
         )
 
+    def repaired(self, ref_trajectory: npt.NDArray[np.floating[Any]]) -> "ModelPredictiveControl":
+        """
+        The controller following the repaired reference trajectory, which has the same part as the current one
+        before the car, so the tracking continues from the current progress instead of searching from the start.
+        The brake is released, since the car only brakes before the collided part while the trajectory is repaired.
+        """
+        mpc = ModelPredictiveControl(ref_trajectory)
+        if self._cur_u <= mpc._u_limit and np.allclose(
+            scipy.interpolate.splev(self._cur_u, self._tck)[:2], scipy.interpolate.splev(self._cur_u, mpc._tck)[:2]
+        ):
+            mpc._cur_u = self._cur_u
+        return mpc
+
     def brake(self) -> None:
         self._brake = True
@@ -1,6 +1,9 @@
 from dataclasses import dataclass, replace
+from itertools import chain
+from typing import Any
 
 import numpy as np
+import numpy.typing as npt
 
 from ..utils.wrap_angle import wrap_angle
 from .Obstacles import Obstacles
@@ -43,6 +46,8 @@ class Car:
 
     SCAN_RADIUS = 15.0  # [m]
 
+    EARLY_STOP_CHUNK_SIZE = 32  # number of poses checked at once by `check_collision_batch` with `early_stop`
+
     def align_yaw(self, target_yaw: float) -> None:
         "align the car's yaw to the target yaw, ensuring the angular distance is less than pi"
         self.yaw = target_yaw + wrap_angle(self.yaw - target_yaw)
@@ -85,7 +90,7 @@ class Car:
 
         if isinstance(obstacles, Obstacles):
             # query the obstacles within the collision radius
-            ids = obstacles.kd_tree.query_ball_point([center_x, center_y], self.COLLISION_RADIUS)
+            ids = obstacles.query_ball_point([center_x, center_y], self.COLLISION_RADIUS)
             candidates = obstacles.coordinates[ids]
         else:
             # the input is already the coordinates of the obstacles
@@ -100,3 +105,43 @@ class Car:
                 np.abs(candidates[:, 1]) < self.COLLISION_WIDTH / 2,
             )
         )
+
+    @classmethod
+    def check_collision_batch(
+        cls, poses: npt.NDArray[np.floating[Any]], obstacles: Obstacles, early_stop: bool = False
+    ) -> npt.NDArray[np.bool_]:
+        """
+        Same as calling `Car(x, y, yaw).check_collision(obstacles)` for each pose, but with only one radius query
+        and one rectangle test for all the poses.
+
+        poses: [[x(m), y(m), yaw(rad)]], returns [collided]
+        early_stop: if True, the poses are checked in order in chunks of `EARLY_STOP_CHUNK_SIZE`, and the ones after
+            the chunk of the first collided pose are not checked and returned as False, for the callers only needing
+            whether any pose collides, or the first collided one
+        """
+        if early_stop:
+            collided = np.zeros(len(poses), dtype=bool)
+            for i in range(0, len(poses), cls.EARLY_STOP_CHUNK_SIZE):
+                chunk = slice(i, i + cls.EARLY_STOP_CHUNK_SIZE)
+                collided[chunk] = cls.check_collision_batch(poses[chunk], obstacles)
+                if collided[chunk].any():
+                    break
+            return collided
+
+        c, s = np.cos(poses[:, 2]), np.sin(poses[:, 2])
+        centers = poses[:, :2] + cls.BACK_TO_CENTER * np.column_stack((c, s))
+
+        ids = obstacles.query_ball_point(centers, cls.COLLISION_RADIUS)
+        counts = np.fromiter(map(len, ids), dtype=int, count=len(ids))
+        if not counts.any():
+            return np.zeros(len(poses), dtype=bool)
+        pose_ids = np.repeat(np.arange(len(poses)), counts)
+        obstacle_ids = np.fromiter(chain.from_iterable(ids), dtype=int, count=len(pose_ids))
+        candidates = obstacles.coordinates[obstacle_ids] - centers[pose_ids]
+
+        # rotate the candidates to the local frame of their own car
+        c, s = c[pose_ids], s[pose_ids]
+        local_x = candidates[:, 0] * c + candidates[:, 1] * s
+        local_y = candidates[:, 1] * c - candidates[:, 0] * s
+        inside = np.logical_and(np.abs(local_x) < cls.COLLISION_LENGTH / 2, np.abs(local_y) < cls.COLLISION_WIDTH / 2)
+        return np.bincount(pose_ids[inside], minlength=len(poses)) > 0
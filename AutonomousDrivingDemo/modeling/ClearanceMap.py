@@ -0,0 +1,109 @@
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+from scipy.ndimage import distance_transform_edt
+
+from .Car import Car
+from .Obstacles import Obstacles
+
+
+class ClearanceMap:
+    """
+    Collision checker based on a Euclidean distance transform raster of the obstacles.
+
+    The collision rectangle of the car is covered by `NUM_COVER_CIRCLES` circles along its longitudinal axis,
+    a pose is collision-free if the clearance of every circle center is larger than the circle radius, and
+    is collided if the clearance of the car center is smaller than half of the collision width. Only the
+    poses in between are checked with the exact rectangle test, so the result is the same as `Car.check_collision`.
+    """
+
+    NUM_COVER_CIRCLES = 3
+
+    # [m], offsets of the cover circle centers from the middle of the rear wheels along the car
+    COVER_CIRCLE_OFFSETS = Car.BACK_TO_CENTER + Car.COLLISION_LENGTH * (
+        (np.arange(NUM_COVER_CIRCLES) + 0.5) / NUM_COVER_CIRCLES - 0.5
+    )
+    COVER_CIRCLE_RADIUS = np.hypot(Car.COLLISION_LENGTH / NUM_COVER_CIRCLES / 2, Car.COLLISION_WIDTH / 2)  # [m]
+
+    # the center of the car moves at most this distance when the middle of the rear wheels moves 1m
+    CENTER_MOTION_RATIO = np.hypot(1.0, Car.BACK_TO_CENTER * np.tan(Car.MAX_STEER) / Car.WHEEL_BASE)
+
+    def __init__(self, obstacles: Obstacles, resolution: float) -> None:
+        self._obstacles = obstacles
+        self._resolution = resolution
+
+        # the raster covers the obstacles with a margin, so every point outside of it has a clearance of at least the margin
+        coordinates = obstacles.coordinates
+        self._margin = Car.COLLISION_RADIUS + resolution
+        self._minx, self._miny = coordinates.min(axis=0) - self._margin
+        maxx, maxy = coordinates.max(axis=0) + self._margin
+        x_count = int(np.ceil((maxx - self._minx) / resolution))
+        y_count = int(np.ceil((maxy - self._miny) / resolution))
+
+        occupied = np.zeros((y_count, x_count), dtype=bool)
+        occupied[self._calc_indices(coordinates)] = True
+
+        # distance from the center of each cell to the center of the nearest occupied cell
+        self._distance = distance_transform_edt(~occupied) * resolution
+        # both the obstacle and the queried point are at most half of a cell diagonal away from their cell centers
+        self._error = resolution * np.sqrt(2)
+
+    @property
+    def obstacles(self) -> Obstacles:
+        return self._obstacles
+
+    def _calc_indices(self, xy: npt.NDArray[np.floating[Any]]) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        return (
+            np.floor((xy[..., 1] - self._miny) / self._resolution).astype(np.intp),
+            np.floor((xy[..., 0] - self._minx) / self._resolution).astype(np.intp),
+        )
+
+    def clearance(self, xy: npt.NDArray[np.floating[Any]]) -> tuple[npt.NDArray[np.floating[Any]], ...]:
+        """
+        The lower and upper bounds of the distance from each point to its nearest obstacle.
+
+        xy: [..., [x(m), y(m)]], returns (lower, upper) of shape [...]
+        """
+        i, j = self._calc_indices(xy)
+        H, W = self._distance.shape
+        inside = (0 <= i) & (i < H) & (0 <= j) & (j < W)
+        distance = np.where(inside, self._distance[np.where(inside, i, 0), np.where(inside, j, 0)], np.inf)
+        lower = np.where(inside, np.maximum(distance - self._error, 0.0), self._margin)
+        return lower, distance + self._error
+
+    def check_collision_batch(
+        self, poses: npt.NDArray[np.floating[Any]], early_stop: bool = False
+    ) -> npt.NDArray[np.bool_]:
+        """
+        Same as calling `Car(x, y, yaw).check_collision(obstacles)` for each pose.
+
+        poses: [[x(m), y(m), yaw(rad)]], returns [collided]
+        early_stop: if True, only whether any pose collides is exact, see `Car.check_collision_batch`
+        """
+        directions = np.column_stack((np.cos(poses[:, 2]), np.sin(poses[:, 2])))
+        circles = poses[:, None, :2] + self.COVER_CIRCLE_OFFSETS[:, None] * directions[:, None, :]
+        free = (self.clearance(circles)[0] > self.COVER_CIRCLE_RADIUS).all(axis=1)
+
+        centers = poses[:, :2] + Car.BACK_TO_CENTER * directions
+        collided = self.clearance(centers)[1] < Car.COLLISION_WIDTH / 2
+
+        # fall back to the exact rectangle test when the clearance is ambiguous
+        if early_stop and collided.any():
+            return collided
+        if (ambiguous := ~free & ~collided).any():
+            collided[ambiguous] = Car.check_collision_batch(poses[ambiguous], self._obstacles, early_stop)
+        return collided
+
+    def check_collision(self, x: float, y: float, yaw: float) -> bool:
+        "Same as `Car(x, y, yaw).check_collision(obstacles)`"
+        return bool(self.check_collision_batch(np.array([[x, y, yaw]]))[0])
+
+    def free_distance(self, x: float, y: float, yaw: float) -> float:
+        """
+        The distance in meters that the car can move from the pose along any feasible path without collision,
+        so the poses within this distance can be skipped from checking.
+        """
+        center = np.array([x + Car.BACK_TO_CENTER * np.cos(yaw), y + Car.BACK_TO_CENTER * np.sin(yaw)])
+        lower, _ = self.clearance(center)
+        return max(0.0, float(lower) - Car.COLLISION_RADIUS) / self.CENTER_MOTION_RATIO
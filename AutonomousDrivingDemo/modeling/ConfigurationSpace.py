@@ -0,0 +1,159 @@
+from copy import copy
+from functools import cache
+from typing import Any
+
+import cv2 as cv
+import numpy as np
+import numpy.typing as npt
+
+from ..utils.cached_array import cached_array
+from ..utils.wrap_angle import wrap_angle
+from .Car import Car
+from .Obstacles import Obstacles
+
+YAW_SAMPLE_RESOLUTION = np.deg2rad(1.0)  # [rad] resolution to sample the footprint within a yaw bin
+MAX_CACHE_ENTRIES = 8  # number of configuration spaces kept in the disk cache
+
+# [m] the farthest distance from the middle of the rear wheels to the collision rectangle
+FOOTPRINT_RADIUS = np.hypot(Car.BACK_TO_CENTER + Car.COLLISION_LENGTH / 2, Car.COLLISION_WIDTH / 2)
+
+
+@cache
+def _footprint_kernel(resolution: float, yaw_min: float, yaw_max: float) -> npt.NDArray[np.uint8]:
+    """
+    The cells that the collision rectangle of the car may overlap, when the middle of the rear wheels is anywhere
+    within the center cell of the kernel, and the yaw is anywhere within [yaw_min, yaw_max].
+    """
+    # both the pose and the obstacle are at most half of a cell diagonal away from their cell centers,
+    # and the footprint moves at most this distance between two sampled yaws
+    margin = resolution * np.sqrt(2) + FOOTPRINT_RADIUS * YAW_SAMPLE_RESOLUTION / 2
+
+    r = int(np.ceil((FOOTPRINT_RADIUS + margin) / resolution))
+    offsets = np.arange(-r, r + 1) * resolution
+    dx, dy = np.meshgrid(offsets, offsets)  # dx[i][j] = offsets[j], dy[i][j] = offsets[i]
+
+    kernel = np.zeros(dx.shape, dtype=bool)
+    num_samples = int(np.ceil((yaw_max - yaw_min) / YAW_SAMPLE_RESOLUTION)) + 1
+    for yaw in np.linspace(yaw_min, yaw_max, num_samples):
+        # distance from each cell center to the collision rectangle, in the local frame of the car
+        c, s = np.cos(yaw), np.sin(yaw)
+        local_x, local_y = dx * c + dy * s - Car.BACK_TO_CENTER, dy * c - dx * s
+        distance = np.hypot(
+            np.maximum(np.abs(local_x) - Car.COLLISION_LENGTH / 2, 0.0),
+            np.maximum(np.abs(local_y) - Car.COLLISION_WIDTH / 2, 0.0),
+        )
+        kernel |= distance <= margin
+    return kernel.astype(np.uint8)
+
+
+class ConfigurationSpace:
+    """
+    Collision checker based on the configuration space of the car, which has one occupancy bitmap for each yaw bin.
+    A bitmap is the obstacle grid dilated by the footprint of the car swept over the whole yaw bin, so
+    a single array read proves a pose is collision-free. Only the poses marked as occupied are checked with
+    the exact rectangle test, so the result is the same as `Car.check_collision`.
+    """
+
+    def __init__(self, obstacles: Obstacles, resolution: float, yaw_resolution: float) -> None:
+        self._obstacles = obstacles
+        self._resolution = resolution
+        self._yaw_resolution = yaw_resolution
+        self._yaw_count = int(2 * np.pi / yaw_resolution)
+
+        # same range as `Obstacles.downsampling_to_grid`, padded by the size of the footprint kernels
+        self._padding = int(np.ceil(2 * FOOTPRINT_RADIUS / resolution))
+        self._minx, self._miny = obstacles.coordinates.min(axis=0) - resolution / 2 - self._padding * resolution
+
+        key = (
+            obstacles.coordinates,
+            resolution,
+            yaw_resolution,
+            Car.BACK_TO_CENTER,
+            Car.COLLISION_LENGTH,
+            Car.COLLISION_WIDTH,
+        )
+        self._occupied = cached_array(
+            "configuration_space", key, lambda: self._compute(obstacles), max_entries=MAX_CACHE_ENTRIES
+        )
+
+    def _compute(self, obstacles: Obstacles) -> npt.NDArray[np.bool_]:
+        "returns occupied[yaw_bin][i][j]"
+        # the cell containing an obstacle always has its center within half of a cell diagonal of the obstacle
+        grid = obstacles.downsampling_to_grid(self._resolution, self._resolution * np.sqrt(2) / 2)
+        return self._dilate(np.pad(grid.grid, self._padding))
+
+    def _dilate(self, src: npt.NDArray[np.bool_]) -> npt.NDArray[np.bool_]:
+        "returns occupied[yaw_bin][i][j] of the padded obstacle grid"
+        src = src.astype(np.uint8)
+        occupied = np.empty((self._yaw_count, *src.shape), dtype=bool)
+        for k in range(self._yaw_count):
+            kernel = _footprint_kernel(self._resolution, k * self._yaw_resolution, (k + 1) * self._yaw_resolution)
+            # dst[i][j] = max(src[i + di][j + dj]) for every (di, dj) of the kernel
+            occupied[k] = cv.dilate(src, kernel, borderType=cv.BORDER_CONSTANT, borderValue=0).astype(bool)
+        return occupied
+
+    def with_obstacles(self, obstacles: Obstacles, coordinates: npt.NDArray[np.floating[Any]]) -> "ConfigurationSpace":
+        """
+        The configuration space of `obstacles`, which are the obstacles of this one with the new `coordinates`
+        appended within the same range. Since dilating the union of two grids is the union of dilating each of them,
+        only the new obstacles are dilated in the window around them, and the result is the same as building a new one.
+        """
+        grid = obstacles.empty_grid(self._resolution)
+        assert (
+            grid.minx - self._padding * self._resolution == self._minx
+            and grid.miny - self._padding * self._resolution == self._miny
+            and (np.array(grid.grid.shape) + 2 * self._padding == self._occupied.shape[1:]).all()
+        ), "The new obstacles must be within the range of the old ones"
+        grid = grid.with_obstacles(coordinates, self._resolution * np.sqrt(2) / 2)
+        src = np.pad(grid.grid, self._padding)
+        rows, cols = np.flatnonzero(src.any(axis=1)), np.flatnonzero(src.any(axis=0))
+
+        ret = copy(self)
+        ret._obstacles = obstacles
+        ret._occupied = self._occupied.copy()
+        if len(rows):
+            # only the cells within the radius of the kernels around the new obstacles are dilated
+            r = max(
+                len(_footprint_kernel(self._resolution, k * self._yaw_resolution, (k + 1) * self._yaw_resolution)) // 2
+                for k in range(self._yaw_count)
+            )
+            window = np.s_[max(rows[0] - r, 0) : rows[-1] + r + 1, max(cols[0] - r, 0) : cols[-1] + r + 1]
+            ret._occupied[:, *window] |= self._dilate(src[window])
+        return ret
+
+    @property
+    def obstacles(self) -> Obstacles:
+        return self._obstacles
+
+    def may_collide_batch(self, poses: npt.NDArray[np.floating[Any]]) -> npt.NDArray[np.bool_]:
+        """
+        Check whether the car at each pose may collide with the obstacles with only the bitmaps,
+        i.e. `False` means collision-free, while `True` means the pose is in or close to the obstacles.
+
+        poses: [[x(m), y(m), yaw(rad)]], returns [may_collide]
+        """
+        K, H, W = self._occupied.shape
+        i = np.floor((poses[:, 1] - self._miny) / self._resolution).astype(np.intp)
+        j = np.floor((poses[:, 0] - self._minx) / self._resolution).astype(np.intp)
+        k = np.minimum((wrap_angle(poses[:, 2], zero_to_2pi=True) // self._yaw_resolution).astype(np.intp), K - 1)
+        # poses outside of the padded grid are too far away from any obstacle to collide
+        inside = (0 <= i) & (i < H) & (0 <= j) & (j < W)
+        return inside & self._occupied[k, np.where(inside, i, 0), np.where(inside, j, 0)]
+
+    def check_collision_batch(
+        self, poses: npt.NDArray[np.floating[Any]], early_stop: bool = False
+    ) -> npt.NDArray[np.bool_]:
+        """
+        Same as calling `Car(x, y, yaw).check_collision(obstacles)` for each pose.
+
+        poses: [[x(m), y(m), yaw(rad)]], returns [collided]
+        early_stop: same as the one of `Car.check_collision_batch`
+        """
+        collided = self.may_collide_batch(poses)
+        if collided.any():
+            collided[collided] = Car.check_collision_batch(poses[collided], self._obstacles, early_stop)
+        return collided
+
+    def check_collision(self, x: float, y: float, yaw: float) -> bool:
+        "Same as `Car(x, y, yaw).check_collision(obstacles)`"
+        return bool(self.check_collision_batch(np.array([[x, y, yaw]]))[0])
@@ -0,0 +1,218 @@
+from abc import ABC, abstractmethod
+from typing import Any, Literal
+
+import numpy as np
+import numpy.typing as npt
+from scipy.spatial import KDTree
+
+GRID_INDEX_CELL_SIZE = 2.0  # [m] cell size of the grid based indices, close to the collision radius of the car
+HASH_TABLE_LOAD_FACTOR = 0.5  # maximum ratio of the occupied cells to the slots of the hash table
+
+ObstacleIndexBackend = Literal["kd_tree", "grid_hash", "raster"]
+
+
+def _group(
+    shape: tuple[int, ...], query_ids: npt.NDArray[np.intp], point_ids: npt.NDArray[np.intp]
+) -> list[int] | npt.NDArray[np.object_]:
+    "The ids of the points of each query, as a list for a single query, or an object array of lists like `KDTree`"
+    if shape == ():
+        return point_ids.tolist()
+    ids = point_ids[np.argsort(query_ids, kind="stable")].tolist()
+    ends = np.cumsum(np.bincount(query_ids, minlength=int(np.prod(shape)))).tolist()
+    ret = np.empty(len(ends), dtype=object)
+    start = 0
+    for k, end in enumerate(ends):
+        ret[k], start = ids[start:end], end
+    return ret.reshape(shape)
+
+
+class KDTreeIndex:
+    """
+    `scipy.spatial.KDTree` of the obstacles.
+
+    Cost: O(n log n) to build and O(n) memory for n obstacles. A radius or a box query costs O(log n + k) for the k
+    points found, independent of the radius and of how the obstacles are spread, but with the largest constant.
+    """
+
+    def __init__(self, coordinates: npt.NDArray[np.floating[Any]]) -> None:
+        self.tree = KDTree(coordinates)
+
+    def query_ball_point(self, x: npt.ArrayLike, r: float) -> list[int] | npt.NDArray[np.object_]:
+        return self.tree.query_ball_point(x, r)
+
+    def query_box(
+        self, mins: npt.NDArray[np.floating[Any]], maxs: npt.NDArray[np.floating[Any]]
+    ) -> list[int] | npt.NDArray[np.object_]:
+        # the box is within the ball of the Chebyshev distance of its largest half extent around its center
+        radii = (maxs - mins).max(axis=-1) / 2
+        ids = self.tree.query_ball_point((mins + maxs) / 2, radii, p=np.inf)
+        if isinstance(ids, list):
+            points = self.tree.data[ids].reshape(-1, 2)
+            return np.asarray(ids)[((mins <= points) & (points <= maxs)).all(axis=1)].tolist()
+        query_ids = np.repeat(np.arange(ids.size), np.fromiter(map(len, ids.flat), dtype=np.intp, count=ids.size))
+        point_ids = np.fromiter((i for l in ids.flat for i in l), dtype=np.intp, count=len(query_ids))
+        points, lo, hi = self.tree.data[point_ids], mins.reshape(-1, 2)[query_ids], maxs.reshape(-1, 2)[query_ids]
+        inside = ((lo <= points) & (points <= hi)).all(axis=1)
+        return _group(ids.shape, query_ids[inside], point_ids[inside])
+
+
+class _GridIndex(ABC):
+    """
+    The obstacles sorted by the `GRID_INDEX_CELL_SIZE` cells containing them, where each cell is a slice of them.
+    The queries of a batch are processed at once with NumPy, so a single query is dominated by its constant overhead.
+    """
+
+    def __init__(self, coordinates: npt.NDArray[np.floating[Any]]) -> None:
+        self._coordinates = coordinates
+        self._min = coordinates.min(axis=0) if len(coordinates) else np.zeros(2)
+        i, j = self._cells(coordinates)
+        self._shape = (int(i.max(initial=0)) + 1, int(j.max(initial=0)) + 1)
+        cells = np.ravel_multi_index((i, j), self._shape)
+        self._order = np.argsort(cells, kind="stable")
+        self._cells_sorted = cells[self._order]
+
+    def _cells(self, xy: npt.NDArray[np.floating[Any]]) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        ij = np.floor((xy - self._min) / GRID_INDEX_CELL_SIZE).astype(np.intp)
+        return ij[..., 1], ij[..., 0]
+
+    @abstractmethod
+    def _ranges(self, cells: npt.NDArray[np.intp]) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        "returns the start and the end of the slices of the sorted obstacles in the given flat cells of the grid"
+
+    def _cell_ranges(
+        self, mins: npt.NDArray[np.floating[Any]], maxs: npt.NDArray[np.floating[Any]]
+    ) -> tuple[npt.NDArray[np.intp], ...]:
+        "returns i0, j0, rows, cols of the cells overlapping each of the boxes, clipped to the grid"
+        i0, j0 = self._cells(mins)
+        i1, j1 = self._cells(maxs)
+        i0, j0 = np.maximum(i0, 0), np.maximum(j0, 0)
+        i1, j1 = np.minimum(i1, self._shape[0] - 1), np.minimum(j1, self._shape[1] - 1)
+        return i0, j0, np.maximum(i1 - i0 + 1, 0), np.maximum(j1 - j0 + 1, 0)
+
+    def _gather(
+        self, query_ids: npt.NDArray[np.intp], start: npt.NDArray[np.intp], end: npt.NDArray[np.intp]
+    ) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        "returns [query_id], [point_id] of the slices of the sorted obstacles, each of which belongs to a query"
+        counts = end - start
+        query_ids = np.repeat(query_ids, counts)
+        local = np.arange(len(query_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return query_ids, self._order[np.repeat(start, counts) + local]
+
+    def _candidates(
+        self, mins: npt.NDArray[np.floating[Any]], maxs: npt.NDArray[np.floating[Any]]
+    ) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        "returns [query_id], [point_id] of the obstacles in the cells overlapping each of the boxes"
+        i0, j0, rows, cols = self._cell_ranges(mins, maxs)
+        # enumerate the cells of all the boxes at once
+        counts = rows * cols
+        query_ids = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(len(query_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cols = np.maximum(cols, 1)[query_ids]
+        cells = np.ravel_multi_index((i0[query_ids] + local // cols, j0[query_ids] + local % cols), self._shape)
+        return self._gather(query_ids, *self._ranges(cells))
+
+    def query_ball_point(self, x: npt.ArrayLike, r: float) -> list[int] | npt.NDArray[np.object_]:
+        x = np.asarray(x, dtype=float)
+        centers = x.reshape(-1, 2)
+        query_ids, point_ids = self._candidates(centers - r, centers + r)
+        d = self._coordinates[point_ids] - centers[query_ids]
+        inside = np.einsum("ij,ij->i", d, d) <= r * r
+        return _group(x.shape[:-1], query_ids[inside], point_ids[inside])
+
+    def query_box(
+        self, mins: npt.NDArray[np.floating[Any]], maxs: npt.NDArray[np.floating[Any]]
+    ) -> list[int] | npt.NDArray[np.object_]:
+        lo, hi = mins.reshape(-1, 2), maxs.reshape(-1, 2)
+        query_ids, point_ids = self._candidates(lo, hi)
+        points = self._coordinates[point_ids]
+        inside = ((lo[query_ids] <= points) & (points <= hi[query_ids])).all(axis=1)
+        return _group(mins.shape[:-1], query_ids[inside], point_ids[inside])
+
+
+class GridHashIndex(_GridIndex):
+    """
+    Uniform grid of `GRID_INDEX_CELL_SIZE` cells, where only the occupied cells are stored in an open addressing hash
+    table with linear probing.
+
+    Cost: O(n) to build with a sort, and O(n) memory independent of the extent of the map. A query costs one hash
+    lookup for each of the O((r / h + 1)^2) cells overlapping its bounding box with cell size h, plus O(k') for the
+    k' points in those cells. Best for sparse obstacles spread over a large map.
+    """
+
+    def __init__(self, coordinates: npt.NDArray[np.floating[Any]]) -> None:
+        super().__init__(coordinates)
+        keys, starts = np.unique(self._cells_sorted, return_index=True)
+        ends = np.append(starts[1:], len(self._cells_sorted))
+
+        size = 1 << int(np.ceil(np.log2(max(len(keys), 1) / HASH_TABLE_LOAD_FACTOR)))
+        self._mask = size - 1
+        self._keys = np.full(size, -1, dtype=np.intp)
+        self._starts, self._ends = np.zeros(size, dtype=np.intp), np.zeros(size, dtype=np.intp)
+        pending, slots = np.arange(len(keys)), self._hash(keys)
+        while len(pending):
+            # the first one of the pending keys probing each empty slot takes it, and the rest probe the next slots
+            free = self._keys[slots[pending]] == -1
+            _, first = np.unique(slots[pending[free]], return_index=True)
+            taken = pending[free][first]
+            self._keys[slots[taken]], self._starts[slots[taken]], self._ends[slots[taken]] = (
+                keys[taken],
+                starts[taken],
+                ends[taken],
+            )
+            pending = np.setdiff1d(pending, taken, assume_unique=True)
+            slots[pending] = (slots[pending] + 1) & self._mask
+
+    def _hash(self, keys: npt.NDArray[np.intp]) -> npt.NDArray[np.intp]:
+        # Fibonacci hashing of the flat cell indices
+        return ((keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)).astype(np.intp) & self._mask
+
+    def _ranges(self, cells: npt.NDArray[np.intp]) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        slots = self._hash(cells)
+        found = np.full(len(cells), -1, dtype=np.intp)
+        active = np.arange(len(cells))
+        while len(active):
+            keys = self._keys[slots[active]]
+            hit = keys == cells[active]
+            found[active[hit]] = slots[active[hit]]
+            active = active[~hit & (keys != -1)]  # an empty slot ends the probing of a missing cell
+            slots[active] = (slots[active] + 1) & self._mask
+        empty = found < 0
+        start, end = self._starts[found], self._ends[found]
+        start[empty] = end[empty] = 0
+        return start, end
+
+
+class RasterIndex(_GridIndex):
+    """
+    Dense raster of `GRID_INDEX_CELL_SIZE` cells over the bounding box of the obstacles, storing where the obstacles
+    of each cell start in the sorted ones, so that an occupancy lookup is a single array read.
+
+    Cost: O(n + A / h^2) to build and memory for the area A of the bounding box with cell size h. A query costs one
+    array read for each of the O(r / h + 1) rows of cells overlapping its bounding box, plus O(k') for the k' points in
+    those cells. Best for dense obstacles within a compact map, and for a large volume of queries.
+    """
+
+    def __init__(self, coordinates: npt.NDArray[np.floating[Any]]) -> None:
+        super().__init__(coordinates)
+        self._cell_starts = np.searchsorted(self._cells_sorted, np.arange(np.prod(self._shape) + 1))
+
+    def _ranges(self, cells: npt.NDArray[np.intp]) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        return self._cell_starts[cells], self._cell_starts[cells + 1]
+
+    def _candidates(
+        self, mins: npt.NDArray[np.floating[Any]], maxs: npt.NDArray[np.floating[Any]]
+    ) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+        # the obstacles of the consecutive cells in a row are consecutive in the sorted ones as well
+        i0, j0, rows, cols = self._cell_ranges(mins, maxs)
+        rows[cols == 0] = 0
+        query_ids = np.repeat(np.arange(len(rows)), rows)
+        i = i0[query_ids] + np.arange(len(query_ids)) - np.repeat(np.cumsum(rows) - rows, rows)
+        first = i * self._shape[1] + j0[query_ids]
+        return self._gather(query_ids, self._cell_starts[first], self._cell_starts[first + cols[query_ids]])
+
+
+OBSTACLE_INDEX_BACKENDS: dict[ObstacleIndexBackend, type[KDTreeIndex | GridHashIndex | RasterIndex]] = {
+    "kd_tree": KDTreeIndex,
+    "grid_hash": GridHashIndex,
+    "raster": RasterIndex,
+}
@@ -1,9 +1,30 @@
-from typing import Any, NamedTuple
+from copy import copy
+from typing import Any, NamedTuple, Optional
 
+import cv2 as cv
 import numpy as np
 import numpy.typing as npt
 from scipy.spatial import KDTree
 
+from .ObstacleIndex import OBSTACLE_INDEX_BACKENDS, ObstacleIndexBackend
+
+# the appended obstacles are merged into the main index once they outnumber this fraction of the ones in it
+DELTA_MERGE_RATIO = 0.1
+# the spatial index of the obstacles by default, see `ObstacleIndex.py` for the cost model of each of them
+OBSTACLE_INDEX_BACKEND: ObstacleIndexBackend = "kd_tree"
+
+
+def _concat_ids(
+    ids: list[int] | npt.NDArray[np.object_], delta_ids: list[int] | npt.NDArray[np.object_], offset: int
+) -> list[int] | npt.NDArray[np.object_]:
+    "The results of the same queries on the main and the delta indices, with the delta ones offset"
+    if isinstance(ids, list):
+        return ids + [i + offset for i in delta_ids]
+    ret = np.empty(ids.shape, dtype=object)
+    for k, (a, b) in enumerate(zip(ids.flat, delta_ids.flat)):
+        ret.flat[k] = a + [i + offset for i in b] if b else a
+    return ret
+
 
 class ObstacleGrid(NamedTuple):
     minx: float
@@ -17,42 +38,136 @@ class ObstacleGrid(NamedTuple):
         x, y = xy
         return int((y - self.miny) / self.resolution), int((x - self.minx) / self.resolution)
 
+    def cell_centers(self) -> tuple[npt.NDArray[np.floating[Any]], npt.NDArray[np.floating[Any]]]:
+        "x of the center of each column, and y of the center of each row, same as `Obstacles.downsampling_to_grid`"
+        half_res = self.resolution / 2
+        return (
+            np.arange(self.minx + half_res, self.maxx, self.resolution),
+            np.arange(self.miny + half_res, self.maxy, self.resolution),
+        )
+
+    def with_obstacles(self, coordinates: npt.NDArray[np.floating[Any]], radius: float) -> "ObstacleGrid":
+        """
+        Mark the cells whose centers are within `radius` of the new obstacles, which must be within the range of
+        the grid. The result is the same as downsampling all the obstacles to the grid, but only the window around
+        the new obstacles is touched.
+
+        The obstacles are binned into their cells, which are dilated by two disk kernels: the cells within `radius` of
+        the whole source cell are occupied for sure, and the ones within `radius` of some part of it may be occupied.
+        Only the cells in between are checked with the distance to the nearest obstacle, so the memory is bounded by
+        the size of the window instead of a meshgrid of all its cell centers.
+        """
+        res = self.resolution
+        H, W = self.grid.shape
+        i = np.clip(np.floor((coordinates[:, 1] - self.miny) / res).astype(np.intp), 0, H - 1)
+        j = np.clip(np.floor((coordinates[:, 0] - self.minx) / res).astype(np.intp), 0, W - 1)
+
+        # the kernels of the offsets from the source cells to the dilated cells
+        r = int(np.ceil(radius / res)) + 1
+        offsets = np.arange(-r, r + 1) * res
+        dx, dy = np.meshgrid(np.abs(offsets), np.abs(offsets))
+        near = np.hypot(np.maximum(dx - res / 2, 0.0), np.maximum(dy - res / 2, 0.0)) <= radius
+        far = np.hypot(dx + res / 2, dy + res / 2) <= radius
+
+        window = np.s_[max(i.min() - r, 0) : min(i.max() + r + 1, H), max(j.min() - r, 0) : min(j.max() + r + 1, W)]
+        src = np.zeros((window[0].stop - window[0].start, window[1].stop - window[1].start), dtype=np.uint8)
+        src[i - window[0].start, j - window[1].start] = 1
+        sure = cv.dilate(src, far.astype(np.uint8)).astype(bool) if far.any() else np.zeros(src.shape, dtype=bool)
+        maybe = cv.dilate(src, near.astype(np.uint8)).astype(bool) & ~sure
+
+        xs, ys = self.cell_centers()
+        mi, mj = np.nonzero(maybe)
+        points = np.column_stack((xs[window[1]][mj], ys[window[0]][mi]))
+        dist, _ = KDTree(coordinates).query(points, k=1, distance_upper_bound=radius + res)
+        sure[mi, mj] = dist <= radius
+
+        grid = self.grid.copy()
+        grid[window] |= sure
+        return self._replace(grid=grid)
+
 
 class Obstacles:
-    def __init__(self, coordinates: npt.NDArray[np.floating[Any]]) -> None:
+    """
+    The obstacles indexed by a static spatial index of the `backend`, plus a small delta index of the obstacles
+    appended afterwards, which are merged into the static one once they outnumber `DELTA_MERGE_RATIO` of it.
+    So appending m obstacles to n ones only indexes the m ones most of the time, instead of all the n + m ones.
+    """
+
+    def __init__(
+        self, coordinates: npt.NDArray[np.floating[Any]], backend: ObstacleIndexBackend = OBSTACLE_INDEX_BACKEND
+    ) -> None:
         assert coordinates.ndim == 2 and coordinates.shape[1] == 2, "Coordinates must be a 2D array of shape (n, 2)"
         self._coordinates = coordinates
-        self._kd_tree = KDTree(coordinates)
+        self._backend = backend
+        self._index = OBSTACLE_INDEX_BACKENDS[backend](coordinates)
+        self._num_indexed = len(coordinates)
+        self._delta_index = None  # of coordinates[self._num_indexed :]
+        self._kd_tree: Optional[KDTree] = self._index.tree if backend == "kd_tree" else None
+
+    def appended(self, coordinates: npt.NDArray[np.floating[Any]]) -> "Obstacles":
+        "The obstacles with the new `coordinates` appended, sharing the static index of this one"
+        assert coordinates.ndim == 2 and coordinates.shape[1] == 2, "Coordinates must be a 2D array of shape (n, 2)"
+        ret = copy(self)
+        ret._coordinates = np.vstack((self._coordinates, coordinates))
+        ret._kd_tree = None
+        delta = ret._coordinates[self._num_indexed :]
+        if len(delta) > DELTA_MERGE_RATIO * self._num_indexed:
+            ret._index, ret._num_indexed, ret._delta_index = (
+                OBSTACLE_INDEX_BACKENDS[self._backend](ret._coordinates),
+                len(ret._coordinates),
+                None,
+            )
+            if self._backend == "kd_tree":
+                ret._kd_tree = ret._index.tree
+        else:
+            ret._delta_index = OBSTACLE_INDEX_BACKENDS[self._backend](delta)
+        return ret
 
     @property
     def coordinates(self) -> npt.NDArray[np.floating[Any]]:
         return self._coordinates
 
+    @property
+    def backend(self) -> ObstacleIndexBackend:
+        return self._backend
+
     @property
     def kd_tree(self) -> KDTree:
+        "The KD-tree of all the obstacles, which is built on the first access unless it is the index already"
+        if self._kd_tree is None:
+            self._kd_tree = KDTree(self._coordinates)
         return self._kd_tree
 
-    def downsampling_to_grid(self, resolution: float, radius: float) -> ObstacleGrid:
-        "downsample the obstacles to a grid with a given resolution in meters, and a given collision radius."
+    def query_ball_point(self, x: npt.ArrayLike, r: float) -> list[int] | npt.NDArray[np.object_]:
+        "Same as `self.kd_tree.query_ball_point(x, r)`, but queried with the index of the backend"
+        ids = self._index.query_ball_point(x, r)
+        if self._delta_index is None:
+            return ids
+        return _concat_ids(ids, self._delta_index.query_ball_point(x, r), self._num_indexed)
+
+    def query_box(
+        self, mins: npt.NDArray[np.floating[Any]], maxs: npt.NDArray[np.floating[Any]]
+    ) -> list[int] | npt.NDArray[np.object_]:
+        """
+        The ids of the obstacles within each of the axis-aligned boxes, in the same format as `query_ball_point`.
+
+        mins, maxs: [..., [x(m), y(m)]] of the lower left and the upper right corners of the boxes
+        """
+        ids = self._index.query_box(mins, maxs)
+        if self._delta_index is None:
+            return ids
+        return _concat_ids(ids, self._delta_index.query_box(mins, maxs), self._num_indexed)
+
+    def empty_grid(self, resolution: float) -> ObstacleGrid:
+        "The grid covering the obstacles with a given resolution in meters, where no cell is occupied yet"
         # calculate the range and the size of the grid
         half_res = resolution / 2
         minx, maxx = np.min(self.coordinates[:, 0]) - half_res, np.max(self.coordinates[:, 0]) + half_res
         miny, maxy = np.min(self.coordinates[:, 1]) - half_res, np.max(self.coordinates[:, 1]) + half_res
         x_count, y_count = round((maxx - minx) / resolution), round((maxy - miny) / resolution)
         maxx, maxy = minx + x_count * resolution, miny + y_count * resolution
+        return ObstacleGrid(minx, maxx, miny, maxy, resolution, np.zeros((y_count, x_count), dtype=bool))
 
-        # generate a meshgrid of center points of each cell of the grid
-        points = np.array(
-            np.meshgrid(
-                np.arange(minx + half_res, maxx, resolution),
-                np.arange(miny + half_res, maxy, resolution),
-                indexing="ij",
-            )
-        ).T.reshape(-1, 2)
-
-        # query the obstacles within the collision radius of each point of the grid, determine whether
-        # the center of a cell is within the collision radius of any obstacle
-        dist, _ = self.kd_tree.query(points, k=1, distance_upper_bound=radius + resolution)
-        grid = (dist <= radius).reshape(y_count, x_count)
-
-        return ObstacleGrid(minx, maxx, miny, maxy, resolution, grid)
+    def downsampling_to_grid(self, resolution: float, radius: float) -> ObstacleGrid:
+        "downsample the obstacles to a grid with a given resolution in meters, and a given collision radius."
+        return self.empty_grid(resolution).with_obstacles(self.coordinates, radius)
@@ -0,0 +1,90 @@
+import heapq
+from collections.abc import Hashable
+from typing import Optional, override
+
+
+class PriorityQueue:
+    """
+    Min-priority queue of plain (f, g, item) tuples, ordered by f, then g, then item, e.g. the open list of A*
+    with the total cost, the cost from the start and the node id.
+
+    Pushing an item with a key supersedes all the items pushed with the same key before, e.g. a cheaper node
+    of the same grid cell. The superseded items are not removed from the queue, but discarded lazily when popped.
+    """
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[float, float, int, Optional[Hashable]]] = []
+        self._latest: dict[Hashable, int] = {}  # key -> the only valid item with the key in the queue
+        self._size = 0  # number of the valid items in the queue
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, f: float, g: float, item: int, key: Optional[Hashable] = None) -> None:
+        if key is not None:
+            if key not in self._latest:
+                self._size += 1
+            self._latest[key] = item
+        else:
+            self._size += 1
+        self._push((f, g, item, key))
+
+    def pop(self) -> tuple[float, float, int]:
+        "Pop the valid item with the smallest (f, g, item), raises IndexError if the queue is empty"
+        if not self._size:
+            raise IndexError("pop from an empty priority queue")
+        while True:
+            f, g, item, key = self._pop()
+            if key is None:
+                break
+            if self._latest.get(key) == item:
+                del self._latest[key]
+                break
+        self._size -= 1
+        return f, g, item
+
+    def _push(self, entry: tuple[float, float, int, Optional[Hashable]]) -> None:
+        heapq.heappush(self._heap, entry)
+
+    def _pop(self) -> tuple[float, float, int, Optional[Hashable]]:
+        return heapq.heappop(self._heap)
+
+
+class BucketPriorityQueue(PriorityQueue):
+    """
+    Same as `PriorityQueue`, but the entries are put into the buckets of f quantized by `bucket_width`.
+    Only the bucket with the smallest f is kept as a heap, the others are unordered lists which are heapified
+    when they become the smallest, so pushing an entry with a larger f is a list append instead of a heap push.
+    """
+
+    def __init__(self, bucket_width: float) -> None:
+        super().__init__()
+        self._bucket_width = bucket_width
+        self._buckets: dict[int, list[tuple[float, float, int, Optional[Hashable]]]] = {}
+        self._bucket_indices: list[int] = []  # heap of the indices of the non-empty buckets
+        self._active = None  # index of the bucket that is currently a heap
+
+    @override
+    def _push(self, entry: tuple[float, float, int, Optional[Hashable]]) -> None:
+        index = int(entry[0] // self._bucket_width)
+        if (bucket := self._buckets.get(index)) is None:
+            self._buckets[index] = [entry]
+            heapq.heappush(self._bucket_indices, index)
+        elif index == self._active:
+            heapq.heappush(bucket, entry)
+        else:
+            bucket.append(entry)
+
+    @override
+    def _pop(self) -> tuple[float, float, int, Optional[Hashable]]:
+        index = self._bucket_indices[0]
+        bucket = self._buckets[index]
+        if index != self._active:
+            heapq.heapify(bucket)
+            self._active = index
+        entry = heapq.heappop(bucket)
+        if not bucket:
+            del self._buckets[index]
+            heapq.heappop(self._bucket_indices)
+            self._active = None
+        return entry
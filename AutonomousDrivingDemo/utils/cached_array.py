@@ -0,0 +1,62 @@
+import hashlib
+import os
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, Literal, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+CACHE_DIR = Path(__file__).absolute().parent.parent / ".cache"
+
+
+def _update_hash(hasher: "hashlib._Hash", key: Any) -> None:
+    if isinstance(key, np.ndarray):
+        hasher.update(f"ndarray{key.dtype}{key.shape}".encode())
+        hasher.update(np.ascontiguousarray(key).tobytes())
+    elif isinstance(key, (tuple, list)):
+        hasher.update(f"{type(key).__name__}{len(key)}".encode())
+        for item in key:
+            _update_hash(hasher, item)
+    else:
+        hasher.update(repr(key).encode())
+
+
+def cached_array(
+    name: str,
+    key: Any,
+    compute: Callable[[], npt.NDArray[Any]],
+    *,
+    cache_dir: Path = CACHE_DIR,
+    mmap_mode: Optional[Literal["r", "r+", "c"]] = None,
+    max_entries: Optional[int] = None,
+) -> npt.NDArray[Any]:
+    """
+    Load the array `name` computed with the parameters `key` from the disk cache, or compute and save it if it is
+    not cached yet. `key` can be nested tuples and lists of ndarrays (hashed by content) and other values (hashed by repr).
+    If `max_entries` is given, only that many most recently saved arrays of `name` are kept on disk.
+    """
+    hasher = hashlib.sha1()
+    _update_hash(hasher, key)
+    path = cache_dir / f"{name}-{hasher.hexdigest()}.npy"
+    try:
+        return np.load(path, mmap_mode=mmap_mode)
+    except (OSError, ValueError):  # not cached yet, or the cache file is broken
+        pass
+
+    array = compute()
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so that other processes never read a partially written file
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        if max_entries is not None:
+            entries = sorted(cache_dir.glob(f"{name}-*.npy"), key=lambda p: p.stat().st_mtime, reverse=True)
+            for entry in entries[max_entries:]:
+                entry.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"Warning: Cannot save cache file {path}: {e}")
+        return array
+    return np.load(path, mmap_mode=mmap_mode) if mmap_mode is not None else array